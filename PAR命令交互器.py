@@ -1,72 +1,216 @@
-import serial
-import binascii
+"""
+PAR20-4H 串口命令交互器
+
+交互模式：输入数据正文（ASCII字符），自动加上 ENQ/ETX/校验和发送，并显示设备回显的数据
+批量模式：从脚本文件或标准输入逐行读取数据正文，上一条指令的应答完整后立刻发送下一条，最后打印每条指令的往返时间和总吞吐量
+
+用法：
+    python PAR命令交互器.py --port COM47                          # 交互模式
+    python PAR命令交互器.py --port COM47 --script regression.txt  # 批量模式
+    echo AST4 | python PAR命令交互器.py --port /dev/ttyUSB0 --script -
+
+脚本每行一条数据正文，例如 AVA1.500、AST4；空行和 # 开头的行会被跳过，sleep 0.5 表示等待0.5秒
+"""
+import argparse
+import json
+import os
+import sys
 import time
-# 函数：计算校验和
-def calculate_checksum(data):
-    etx = 0x03  # ETX字节
-    checksum = (sum(data) + etx) & 0xFF  # 校验和是数据正文与ETX的和的低8位
-    return checksum
-
-# 打开串口COM47，波特率9600，无校验
-ser = serial.Serial(
-    port='COM47',           # 根据实际情况替换为您的串口号
-    baudrate=9600,          # 波特率设置为9600
-    bytesize=serial.SEVENBITS,  # 数据位设置为7
-    parity=serial.PARITY_EVEN,  # 设置偶校验
-    stopbits=serial.STOPBITS_ONE,  # 停止位设置为1
-    timeout=1               # 超时时间设置为1秒
-)
+
+import serial
+
+from TEXIO_PAR_Codec import NAK, acknowledgement, answered, encode_frame, response_complete, response_valid
+from TEXIO_PAR_Stats import percentile
+
+
 # 函数：打印回显数据（以HEX和ASCII格式显示）
 def print_echo(data):
     hex_data = data.hex(" ")
     ascii_data = ''.join([chr(byte) if 32 <= byte <= 126 else '.' for byte in data])  # 转换为ASCII，非打印字符用'.'表示
     print(f"\n回显数据 (ASCII): {ascii_data}")
     print(f"回显数据 (HEX): {hex_data}\n")
-    
-def decimal_to_custom_bytearray(decimal_value):
-    # 将十进制值转换为十六进制字符串，并去掉前缀'0x'，同时确保始终有两位数
-    hex_str = format(decimal_value, '02X')
-    
-    # 将每个字符转换为其ASCII值，并形成bytearray
-    byte_array = bytearray([ord(hex_str[0])]) + bytearray([ord(hex_str[1])])
-    
-    return byte_array
-
-# 死循环：持续等待用户输入，发送指令并回显接收到的数据
-while True:
-    # 用户输入数据正文
-    data_input = input("请输入数据正文（ASCII字符）：")
-
-    # 将输入的 ASCII 字符转换为字节数组
-    data = bytearray(data_input, 'ascii')
-
-    # 计算校验和
-    checksum = calculate_checksum(data)
-
-    # 构造完整指令：ENQ + 数据正文 + ETX + 校验和
-    enq = 0x05  # ENQ字节
-    etx = 0x03  # ETX字节
-
-    # 创建最终的指令：ENQ + 数据正文 + ETX + 校验和（拆分后的高低位ASCII）
-    instruction = bytearray([enq]) + data + bytearray([etx]) + decimal_to_custom_bytearray(checksum)
-
-    # 打印发送的指令，优化输出为 %02X %02X 格式
-    print("发送的指令: " + instruction.hex(" "))
-
-    # 发送指令到串口
+
+
+def open_port(port):
+    # 波特率9600，7位数据位，偶校验，1位停止位
+    return serial.Serial(
+        port=port,
+        baudrate=9600,
+        bytesize=serial.SEVENBITS,
+        parity=serial.PARITY_EVEN,
+        stopbits=serial.STOPBITS_ONE,
+        timeout=0.05  # 单次read的最长阻塞时间，整体超时由 exchange 控制
+    )
+
+
+def exchange(ser, body, timeout):
+    """
+    发送一条指令并等待应答完整，返回 (接收到的数据, 结果, 往返时间)
+    结果：ack / nak / corrupt（应答不完整或校验和错误）/ timeout（设备没有应答）
+    查询指令（单元字符后面是 ST）等到完整的响应帧，其他指令等到 ACK/NAK
+    """
+    instruction = encode_frame(body)
+    unit = body[:1] or "A"
+    need_response = body[1:3] == "ST"
+    ser.reset_input_buffer()
+    start = time.perf_counter()
     ser.write(instruction)
-    
-    接收计时器 = time.time()
     接收缓冲区 = bytearray()
-    while time.time() - 接收计时器 < 0.3:
-        # 从串口读取一个字节
-        byte = ser.read(1)
-        if byte:
-            接收缓冲区 += byte
-            接收计时器 = time.time()
-            
-    # 打印回显数据
-    print_echo(接收缓冲区)
-
-# 关闭串口
-ser.close()
+    # 应答完整就立刻返回，超时只用来兜底设备无应答的情况
+    while not response_complete(接收缓冲区, need_response, unit):
+        if time.perf_counter() - start >= timeout:
+            break
+        接收缓冲区 += ser.read(ser.in_waiting or 1)
+    rtt = time.perf_counter() - start
+    if acknowledgement(接收缓冲区, unit) == NAK:
+        outcome = "nak"
+    elif not response_complete(接收缓冲区, need_response, unit):
+        outcome = "corrupt" if answered(接收缓冲区, instruction) else "timeout"
+    elif response_valid(接收缓冲区, need_response, unit):
+        outcome = "ack"
+    else:
+        outcome = "corrupt"
+    return 接收缓冲区, outcome, rtt
+
+
+def iter_script(lines):
+    """依次返回脚本中的 ("send", 数据正文) 或 ("sleep", 秒数)"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("sleep "):
+            try:
+                yield "sleep", float(line[6:])
+            except ValueError:
+                raise ValueError(f"第 {number} 行: 无效的等待时间 {line!r}") from None
+            continue
+        try:
+            line.encode("ascii")
+        except UnicodeEncodeError:
+            raise ValueError(f"第 {number} 行: 数据正文只能包含ASCII字符 {line!r}") from None
+        yield "send", line
+
+
+def latency_stats(values):
+    values = sorted(values)
+    return {"n": len(values), "min_ms": values[0] * 1000, "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000, "max_ms": values[-1] * 1000,
+            "mean_ms": sum(values) / len(values) * 1000}
+
+
+def run_batch(ser, steps, timeout, repeat=1, verbose=False):
+    """按顺序执行脚本 repeat 遍，返回每条指令的结果和汇总"""
+    results = []
+    bytes_sent = bytes_received = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for action, value in steps:
+            if action == "sleep":
+                time.sleep(value)
+                continue
+            接收缓冲区, outcome, rtt = exchange(ser, value, timeout)
+            bytes_sent += len(encode_frame(value))
+            bytes_received += len(接收缓冲区)
+            results.append({"command": value, "outcome": outcome, "rtt_ms": rtt * 1000})
+            ascii_data = ''.join(chr(byte) if 32 <= byte <= 126 else '.' for byte in 接收缓冲区)
+            print(f"{value:<16} {outcome:<8} {rtt * 1000:8.2f} ms  {ascii_data}")
+            if verbose:
+                print_echo(接收缓冲区)
+    elapsed = time.perf_counter() - start
+
+    summary = {"commands": len(results), "elapsed_s": elapsed,
+               "commands_per_s": len(results) / elapsed if elapsed > 0 else None,
+               "bytes_sent": bytes_sent, "bytes_received": bytes_received,
+               "bytes_per_s": (bytes_sent + bytes_received) / elapsed if elapsed > 0 else None,
+               "outcomes": {}, "rtt": None, "by_command": {}}
+    for r in results:
+        summary["outcomes"][r["outcome"]] = summary["outcomes"].get(r["outcome"], 0) + 1
+    if results:
+        summary["rtt"] = latency_stats([r["rtt_ms"] / 1000 for r in results])
+        # 按指令类型（单元字符后面的两个字母）分别统计
+        by_type = {}
+        for r in results:
+            by_type.setdefault(r["command"][1:3], []).append(r["rtt_ms"] / 1000)
+        summary["by_command"] = {name: latency_stats(values) for name, values in sorted(by_type.items())}
+    return results, summary
+
+
+def print_summary(summary):
+    print(f"\n共 {summary['commands']} 条指令，用时 {summary['elapsed_s']:.3f} 秒，"
+          f"{summary['commands_per_s'] or 0:.2f} 条/秒，{summary['bytes_per_s'] or 0:.0f} 字节/秒"
+          f"（发送 {summary['bytes_sent']}，接收 {summary['bytes_received']}）")
+    print("结果: " + ", ".join(f"{name} {count}" for name, count in sorted(summary["outcomes"].items())))
+    rows = ([("全部", summary["rtt"])] if summary["rtt"] else []) + list(summary["by_command"].items())
+    for name, stats in rows:
+        print(f"{name:<6} n {stats['n']:5d}  min {stats['min_ms']:8.2f} ms  p50 {stats['p50_ms']:8.2f} ms  "
+              f"p95 {stats['p95_ms']:8.2f} ms  max {stats['max_ms']:8.2f} ms")
+
+
+def interactive(ser, timeout):
+    # 死循环：持续等待用户输入，发送指令并回显接收到的数据
+    while True:
+        try:
+            # 用户输入数据正文
+            data_input = input("请输入数据正文（ASCII字符）：").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+        if not data_input:
+            continue
+
+        # 打印发送的指令，优化输出为 %02X %02X 格式
+        print("发送的指令: " + encode_frame(data_input).hex(" "))
+        接收缓冲区, outcome, rtt = exchange(ser, data_input, timeout)
+        print(f"{outcome}，往返时间 {rtt * 1000:.2f} ms")
+
+        # 打印回显数据
+        print_echo(接收缓冲区)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 串口命令交互器")
+    parser.add_argument("--port", default=os.environ.get("PAR_PORT", "COM47"),
+                        help="串口号，默认读取环境变量 PAR_PORT（COM47）")
+    parser.add_argument("--script", help="批量模式：逐行读取数据正文的脚本文件，- 表示标准输入")
+    parser.add_argument("--repeat", type=int, default=1, help="批量模式下脚本执行的遍数")
+    parser.add_argument("--timeout", type=float, default=1.0, help="每条指令等待应答的最长时间（秒）")
+    parser.add_argument("--json", help="批量模式下把每条指令的结果和汇总保存为 JSON 文件")
+    parser.add_argument("-v", "--verbose", action="store_true", help="批量模式下打印每条应答的 HEX/ASCII")
+    args = parser.parse_args()
+
+    if args.script is None:
+        ser = open_port(args.port)
+        try:
+            interactive(ser, args.timeout)
+        finally:
+            # 关闭串口
+            ser.close()
+        return
+
+    if args.script == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.script, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    try:
+        steps = list(iter_script(lines))
+    except ValueError as e:
+        parser.error(str(e))
+
+    ser = open_port(args.port)
+    try:
+        results, summary = run_batch(ser, steps, args.timeout, args.repeat, args.verbose)
+    finally:
+        ser.close()
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"port": args.port, "summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+    # 有指令失败时返回非零退出码，方便在回归测试脚本中判断
+    if any(r["outcome"] != "ack" for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+PAR20-4H 驱动性能基准测试
+
+逐个测量 DeviceController 每个公开方法的单次延时（p50/p95/p99）和连续执行时的每秒指令数，
+异步控制器还测量有排队负载时关闭输出（安全指令）的延时（off_under_load），
+同时覆盖 Web API 服务器里的异步控制器和 呼吸灯DEMO 里的同步控制器。
+结果保存为 JSON，可以用 --compare 和之前的结果对比。
+
+用法：
+    python TEXIO_PAR_Benchmark.py                      # 自动启动软件模拟器
+    python TEXIO_PAR_Benchmark.py --port /dev/ttyUSB0  # 使用实物电源（测试过程中输出保持关闭）
+    python TEXIO_PAR_Benchmark.py --compare old.json
+    python TEXIO_PAR_Benchmark.py --codec                 # 协议编解码微基准：TEXIO_PAR_Codec 与原来的 scanf 解析对比
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+from TEXIO_PAR_Stats import percentile
+
+# 每个被测方法的调用方式，i 为第几次调用；实物电源上测试时输出始终保持关闭
+BENCHMARKS = [
+    ("set_voltage", lambda c, i: c.set_voltage(1.0 + (i % 10) * 0.1)),
+    ("set_current", lambda c, i: c.set_current(0.1 + (i % 10) * 0.01)),
+    ("select_output", lambda c, i: c.select_output("workspace")),
+    ("control_output", lambda c, i: c.control_output(False)),
+    ("getOutputStatus", lambda c, i: c.getOutputStatus()),
+    ("getSystemStatus", lambda c, i: c.getSystemStatus()),
+    ("getMemoryPreset", lambda c, i: c.getMemoryPreset()),
+]
+
+
+def summarize(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        "n": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "mean_ms": sum(values) / len(values) * 1000,
+        "max_ms": values[-1] * 1000,
+        "cmds_per_s": len(values) / elapsed if elapsed > 0 else None,
+    }
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """驱动程序会打印每条收发数据，测试时把它们丢掉，避免终端输出干扰结果"""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+async def bench_async(controller, iterations, verbose):
+    results = {}
+    for name, call in BENCHMARKS:
+        if not hasattr(controller, name):
+            print(f"async  {name:<16} 该控制器没有这个方法，跳过")
+            continue
+        latencies = []
+        start = time.perf_counter()
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            with quiet(not verbose):
+                await call(controller, i)
+            latencies.append(time.perf_counter() - t0)
+        results[name] = summarize(latencies, time.perf_counter() - start)
+        print_row("async", name, results[name])
+    return results
+
+
+async def bench_emergency(controller, iterations, verbose, load_tasks=4):
+    """
+    关闭输出在负载下的延时：load_tasks 个任务连续发送设定电压和 AST5 查询，让设备锁前排起长队，
+    同时每隔 0.1 秒调用一次 control_output(False)；优先级调度下它只需要等正在进行的一次收发
+    """
+    stop = asyncio.Event()
+
+    async def load(k):
+        i = 0
+        while not stop.is_set():
+            if k % 2:
+                await controller.getMemoryPreset()
+            else:
+                await controller.set_voltage(1.0 + (i % 10) * 0.1)
+            i += 1
+
+    with quiet(not verbose):
+        tasks = [asyncio.create_task(load(k)) for k in range(load_tasks)]
+        await asyncio.sleep(0.5)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            await controller.control_output(False)
+            latencies.append(time.perf_counter() - t0)
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    stats = summarize(latencies, elapsed)
+    print_row("async", "off_under_load", stats)
+    return stats
+
+
+def bench_sync(controller, iterations, verbose):
+    results = {}
+    for name, call in BENCHMARKS:
+        if not hasattr(controller, name):
+            print(f"sync   {name:<16} 该控制器没有这个方法，跳过")
+            continue
+        latencies = []
+        start = time.perf_counter()
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            with quiet(not verbose):
+                call(controller, i)
+            latencies.append(time.perf_counter() - t0)
+        results[name] = summarize(latencies, time.perf_counter() - start)
+        print_row("sync", name, results[name])
+    return results
+
+
+def print_row(controller_name, method, stats):
+    print(f"{controller_name:<6} {method:<16} p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  "
+          f"p99 {stats['p99_ms']:8.2f} ms  {stats['cmds_per_s']:7.2f} 条/秒")
+
+
+def run_async_controller(port, iterations, verbose):
+    # Web API 服务器在导入时按 PAR_PORT 创建全局控制器
+    os.environ["PAR_PORT"] = port
+    with quiet(not verbose):
+        server = importlib.import_module("TEXIO_PAR_WebAPI_Server")
+    try:
+        async def run():
+            results = await bench_async(server.controller, iterations, verbose)
+            results["off_under_load"] = await bench_emergency(server.controller, iterations, verbose)
+            return results
+        return asyncio.run(run())
+    finally:
+        server.controller.close()
+
+
+def run_sync_controller(port, iterations, verbose):
+    demo = importlib.import_module("TEXIO_PAR呼吸灯DEMO")
+    controller = demo.DeviceController(port=port)
+    try:
+        return bench_sync(controller, iterations, verbose)
+    finally:
+        controller.close()
+
+
+# 微基准使用的应答数据：回显的指令 + ACK + 响应帧，与实物返回的格式一致
+CODEC_SAMPLES = {
+    "MS2": ("AST2", "@MS2,01,1,0,1,0,0,0", "MS2,%d,%d,%d,%d,%d,%d,%d"),
+    "MS4": ("AST4", "@MS4,01,3.300,0.150,21.500,1000", "MS4,%d,%f,%f,%f,%d"),
+    "MS5": ("AST5", "@MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152",
+            "MS5,%d,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f"),
+}
+
+
+def bench_codec(iterations):
+    """比较 TEXIO_PAR_Codec 的预编译解析器与原来 find + scanf 的解析耗时（微秒/次）"""
+    import TEXIO_PAR_Codec as codec
+    try:
+        from scanf import scanf
+    except ImportError:
+        scanf = None
+        print("未安装 scanf 库，只测量 TEXIO_PAR_Codec")
+
+    parsers = {"MS2": codec.parse_system_status, "MS4": codec.parse_output_status, "MS5": codec.parse_memory_preset}
+    results = {}
+    for tag, (command, reply, scanf_format) in CODEC_SAMPLES.items():
+        received_data = bytearray(codec.encode_frame(command) + bytes([codec.ACK]) + b"A" + codec.encode_frame(reply))
+        parse = parsers[tag]
+
+        def scanf_path():
+            # 原来的解析方式：查找起始位置后用 scanf 解析
+            start_index = received_data.find(tag.encode('ascii'))
+            return scanf(scanf_format, received_data[start_index:].decode())
+
+        stats = {"codec_us": min(timeit.repeat(lambda: parse(received_data), number=iterations, repeat=5))
+                 / iterations * 1e6}
+        if scanf is not None:
+            stats["scanf_us"] = min(timeit.repeat(scanf_path, number=iterations, repeat=5)) / iterations * 1e6
+            stats["speedup"] = stats["scanf_us"] / stats["codec_us"]
+            print(f"codec  {tag:<16} scanf {stats['scanf_us']:8.2f} us  codec {stats['codec_us']:8.2f} us  "
+                  f"快 {stats['speedup']:.1f} 倍")
+        else:
+            print(f"codec  {tag:<16} codec {stats['codec_us']:8.2f} us")
+        results[tag] = stats
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    print("\n与基准结果对比（p50，负数表示变快）:")
+    for controller_name, methods in current["results"].items():
+        for method, stats in methods.items():
+            old = baseline.get("results", {}).get(controller_name, {}).get(method)
+            if not old or "p50_ms" not in stats:
+                continue
+            delta = stats["p50_ms"] - old["p50_ms"]
+            ratio = delta / old["p50_ms"] * 100 if old["p50_ms"] else 0
+            print(f"{controller_name:<6} {method:<16} {old['p50_ms']:8.2f} -> {stats['p50_ms']:8.2f} ms "
+                  f"({delta:+.2f} ms, {ratio:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 驱动性能基准测试")
+    parser.add_argument("--port", help="串口号；不指定时自动启动软件模拟器")
+    parser.add_argument("--controllers", default="async,sync", help="要测试的控制器，逗号分隔：async,sync")
+    parser.add_argument("--iterations", type=int, default=20, help="每个方法调用的次数")
+    parser.add_argument("--output", default="benchmark_results.json", help="结果保存路径（JSON）")
+    parser.add_argument("--compare", help="与之前保存的结果文件对比")
+    parser.add_argument("--codec", action="store_true", help="只运行协议编解码微基准，不连接设备")
+    parser.add_argument("--processing-delay", type=float, default=0.02, help="模拟器的设备处理延时（秒）")
+    parser.add_argument("--no-wire-delay", action="store_true", help="模拟器不模拟线路传输时间")
+    parser.add_argument("-v", "--verbose", action="store_true", help="保留驱动程序的收发打印")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "port": args.port or "simulator",
+            "simulator_processing_delay": None if args.port else args.processing_delay,
+            "simulator_wire_delay": None if args.port else not args.no_wire_delay,
+            "iterations": args.iterations,
+        },
+        "results": {},
+    }
+    runners = {"async": run_async_controller, "sync": run_sync_controller}
+    if args.codec:
+        report["meta"]["port"] = None
+        report["results"]["codec"] = bench_codec(max(args.iterations, 1000))
+    for name in ([] if args.codec else args.controllers.split(",")):
+        name = name.strip()
+        if name not in runners:
+            parser.error(f"未知的控制器: {name}")
+        simulator = None
+        port = args.port
+        if port is None:
+            # 每个控制器使用一个全新的模拟器，设备状态互不影响
+            from TEXIO_PAR_Simulator import PARSimulator
+            simulator = PARSimulator(processing_delay=args.processing_delay,
+                                     wire_delay=not args.no_wire_delay).start()
+            port = simulator.port
+            print(f"使用软件模拟器: {port}")
+        try:
+            report["results"][name] = runners[name](port, args.iterations, args.verbose)
+        finally:
+            if simulator is not None:
+                simulator.stop()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+"""
+PAR20-4H 多进程 Web API：串口代理进程 + 多个 HTTP 工作进程
+
+串口只能被一个进程打开，所以 TEXIO_PAR_WebAPI_Server.py 不能直接用多个 uvicorn worker 运行。这个模式下：
+    代理进程（broker）  唯一持有 DeviceController 和串口，在进程内运行原来的 Web API 应用（所有接口、校验和错误处理不变），
+                        每次后台轮询得到新结果时，把所有设备的最新状态写入共享内存
+    HTTP 工作进程        查询接口（get_output_status / getSystemStatus / get_memory_preset）和实时数据流直接读共享内存，
+                        不需要与代理进程通信；其他接口通过本地套接字转发给代理进程
+读取状态的吞吐量因此随 CPU 核数增加，指令仍然只有代理进程一个出口，优先级调度、合并模式等照常生效。
+
+共享内存用序号锁（seqlock）保护：写入前后序号各加一，读取时序号为奇数或前后不一致就重读，读写双方都不加锁。
+套接字上每行一个 JSON，请求和应答带 id，一个工作进程的所有请求共用一条连接。
+
+用法：
+    python TEXIO_PAR_Broker.py --workers 4 --port 8000       # 启动代理进程和 4 个 HTTP 工作进程
+    python TEXIO_PAR_Broker.py --broker-only                  # 只启动代理进程，工作进程另外用
+    uvicorn TEXIO_PAR_Broker:app --workers 4 --port 8000      # 启动（工作进程中不会打开串口）
+
+环境变量：
+    PAR_BROKER_ADDRESS   代理进程的套接字，POSIX 上默认为 Unix 套接字 /tmp/texio_par_broker.sock，
+                         Windows 上默认为 127.0.0.1:8765；写成 主机:端口 时使用 TCP
+    PAR_BROKER_SHM       共享内存的名字（默认 texio_par_snapshot）
+    PAR_BROKER_SHM_SIZE  共享内存的大小（字节，默认 1048576）
+    PAR_BROKER_TIMEOUT   工作进程等待代理进程应答的最长时间（秒，默认 60）
+代理进程没有配置 PAR_POLL_INTERVAL 时按 0.5 秒轮询，工作进程读到的状态默认不超过两个轮询间隔。
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+DEFAULT_ADDRESS = "127.0.0.1:8765" if sys.platform == "win32" else "/tmp/texio_par_broker.sock"
+QUERIES = ("output_status", "system_status", "memory_preset")  # 与 TelemetryCache.QUERIES 相同
+MAX_LINE = 64 * 1024 * 1024  # 套接字上单个请求/应答的最大长度（字节），批量指令的结果可能比较大
+
+_MAGIC = b"PARSNAP1"
+_HEADER = struct.Struct("<8sQQ")  # 标识, 序号（奇数表示正在写入）, 数据长度
+
+
+def broker_address():
+    return os.environ.get("PAR_BROKER_ADDRESS", DEFAULT_ADDRESS)
+
+
+def _tcp_address(address):
+    """主机:端口 形式的地址返回 (主机, 端口)，否则为 Unix 套接字路径，返回 None"""
+    match = re.fullmatch(r"([\w.\-]+):(\d+)", address)
+    return (match.group(1), int(match.group(2))) if match else None
+
+
+class SnapshotWriter:
+    """代理进程一侧：创建共享内存，每次 publish() 写入一份完整的状态快照"""
+
+    def __init__(self, name, size=1 << 20):
+        try:
+            # 上一次代理进程异常退出时留下的共享内存
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.sequence = 0
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, 0, 0)
+
+    def publish(self, data):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        if _HEADER.size + len(payload) > self.shm.size:
+            raise ValueError(f"状态快照（{len(payload)} 字节）超过共享内存大小，请调大 PAR_BROKER_SHM_SIZE")
+        _, _, length = _HEADER.unpack_from(self.shm.buf, 0)
+        # 序号变为奇数：读取方看到后会等写入完成再读
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, self.sequence + 1, length)
+        self.shm.buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+        self.sequence += 2
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, self.sequence, len(payload))
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SnapshotReader:
+    """工作进程一侧：读取代理进程写入的状态快照，序号没有变化时直接返回上次解析的结果"""
+
+    def __init__(self, name):
+        self.name = name
+        self.shm = None
+        self._sequence = None
+        self._data = None
+
+    def _attach(self):
+        try:
+            self.shm = shared_memory.SharedMemory(self.name, track=False)
+        except TypeError:  # Python 3.12 及以前没有 track 参数
+            self.shm = shared_memory.SharedMemory(self.name)
+            if os.name == "posix":
+                # 否则工作进程退出时 resource_tracker 会把代理进程的共享内存删掉
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    def read(self):
+        """返回最新的快照，代理进程还没有启动时返回 None"""
+        if self.shm is None:
+            try:
+                self._attach()
+            except FileNotFoundError:
+                return None
+        buf = self.shm.buf
+        for _ in range(1000):
+            magic, sequence, length = _HEADER.unpack_from(buf, 0)
+            if magic != _MAGIC or sequence == 0:
+                return None
+            if sequence == self._sequence:
+                return self._data
+            if sequence % 2:
+                continue
+            payload = bytes(buf[_HEADER.size:_HEADER.size + length])
+            if _HEADER.unpack_from(buf, 0)[1] == sequence:
+                self._sequence, self._data = sequence, json.loads(payload)
+                return self._data
+        return self._data
+
+    def sequence(self):
+        """快照的当前序号，用来判断有没有新数据，不解析内容"""
+        if self.shm is None:
+            return None
+        return _HEADER.unpack_from(self.shm.buf, 0)[1]
+
+
+# ---------------------------------------------------------------- 代理进程
+
+async def call_app(app, method, path, query, body, content_type):
+    """在进程内调用 ASGI 应用处理一个请求，返回 (状态码, Content-Type, 响应正文)"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+        "method": method, "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": query.encode(), "headers": [(b"content-type", content_type.encode())] if content_type else [],
+        "client": ("broker", 0), "server": ("broker", 0),
+    }
+    request_sent = False
+    response_done = asyncio.Event()
+    status, headers, chunks = 500, [], []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, headers
+        if message["type"] == "http.response.start":
+            status, headers = message["status"], message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_done.set()
+
+    await app(scope, receive, send)
+    content_type = next((value.decode() for name, value in headers if name.lower() == b"content-type"), None)
+    return status, content_type, b"".join(chunks)
+
+
+class Broker:
+    """
+    代理进程：持有 Web API 服务器的 ControllerRegistry，处理工作进程转发来的请求，并把最新状态写入共享内存
+    server: TEXIO_PAR_WebAPI_Server 模块
+    """
+
+    def __init__(self, server, address, writer):
+        self.server = server
+        self.address = address
+        self.writer = writer
+        self.sequences = {}  # (设备ID, key) -> 这项状态最近一次更新的序号，作为实时数据流的事件 id
+        self.requests = 0
+        self._changed = asyncio.Event()
+
+    def snapshot(self):
+        registry = self.server.registry
+        devices = {}
+        for device_id, device in registry.controllers.items():
+            telemetry = {}
+            for key, (timestamp, response) in device.telemetry.snapshot.items():
+                telemetry[key] = {"sequence": self.sequences.get((device_id, key), 0), "timestamp": timestamp,
+                                  "response": response}
+            devices[device_id] = {"max_age": device.telemetry.max_age, "telemetry": telemetry}
+        return {"default": registry.default_id, "published": time.time(), "devices": devices}
+
+    async def _watch(self, device_id, device):
+        """订阅一台设备的状态更新，有新结果时通知发布任务"""
+        subscriber = device.telemetry.subscribe(QUERIES, maxlen=64)
+        try:
+            while True:
+                sequence, key, _ = await subscriber.get()
+                self.sequences[(device_id, key)] = sequence
+                self._changed.set()
+        finally:
+            subscriber.close()
+
+    async def _publish(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                self.writer.publish(self.snapshot())
+            except ValueError as e:
+                print(e)
+
+    async def _handle(self, line, writer):
+        request = json.loads(line)
+        body = request.get("body")
+        try:
+            status, content_type, content = await call_app(
+                self.server.app, request["method"], request["path"], request.get("query", ""),
+                body.encode("utf-8") if body is not None else b"", request.get("content_type"))
+        except Exception as e:
+            status, content_type = 500, "application/json"
+            content = json.dumps({"code": -1, "msg": f"{type(e).__name__}: {e}"}).encode()
+        reply = {"id": request["id"], "status": status, "content_type": content_type,
+                 "body": content.decode("utf-8", errors="replace")}
+        # 一行完整的应答一次写入，多个请求的应答不会交错
+        writer.write(json.dumps(reply, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    async def _serve_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requests += 1
+                # 每个请求一个任务，同一条连接上的请求并发处理，由设备锁和优先级调度排队
+                task = asyncio.create_task(self._handle(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # 代理进程退出时结束连接，不再向上抛出（否则 asyncio 会打印一条无用的错误）
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def run(self, ready=None):
+        server = self.server
+        if os.name == "posix":
+            # 被 terminate() 结束时也走正常的退出流程：停止后台任务、删除共享内存和套接字文件
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        async with server.lifespan(server.app):
+            watchers = [asyncio.create_task(self._watch(device_id, device))
+                        for device_id, device in server.registry.controllers.items()]
+            publisher = asyncio.create_task(self._publish())
+            self.writer.publish(self.snapshot())
+            tcp = _tcp_address(self.address)
+            if tcp is not None:
+                listener = await asyncio.start_server(self._serve_connection, *tcp, limit=MAX_LINE)
+            else:
+                if os.path.exists(self.address):
+                    os.remove(self.address)
+                listener = await asyncio.start_unix_server(self._serve_connection, self.address, limit=MAX_LINE)
+            print(f"串口代理进程已启动: {self.address}，设备 {', '.join(server.registry.controllers)}")
+            if ready is not None:
+                ready.set()
+            try:
+                async with listener:
+                    await listener.serve_forever()
+            finally:
+                for task in watchers + [publisher]:
+                    task.cancel()
+                if tcp is None and os.path.exists(self.address):
+                    os.remove(self.address)
+
+
+def run_broker(ready=None):
+    """代理进程的入口：导入 Web API 服务器（在这里才打开串口）并处理工作进程的请求，直到进程被结束"""
+    # 工作进程只读共享内存里的状态，代理进程需要后台轮询
+    os.environ.setdefault("PAR_POLL_INTERVAL", "0.5")
+    import TEXIO_PAR_WebAPI_Server as server
+    writer = SnapshotWriter(os.environ.get("PAR_BROKER_SHM", "texio_par_snapshot"),
+                            int(os.environ.get("PAR_BROKER_SHM_SIZE", 1 << 20)))
+    try:
+        asyncio.run(Broker(server, broker_address(), writer).run(ready))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+        for device in server.registry.controllers.values():
+            device.close()
+
+
+# ---------------------------------------------------------------- HTTP 工作进程
+
+class BrokerUnavailable(ConnectionError):
+    pass
+
+
+class BrokerClient:
+    """工作进程到代理进程的连接，所有请求共用一条连接，按 id 匹配应答；连接断开后下一个请求时重新连接"""
+
+    def __init__(self, address, timeout=60.0):
+        self.address = address
+        self.timeout = timeout
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}  # id -> future
+        self._next_id = 0
+        self._connecting = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connecting:
+            if self._writer is not None:
+                return
+            tcp = _tcp_address(self.address)
+            try:
+                if tcp is not None:
+                    reader, writer = await asyncio.open_connection(*tcp, limit=MAX_LINE)
+                else:
+                    reader, writer = await asyncio.open_unix_connection(self.address, limit=MAX_LINE)
+            except OSError as e:
+                raise BrokerUnavailable(f"Broker {self.address} unavailable: {e}") from e
+            self._writer = writer
+            self._reader_task = asyncio.create_task(self._read_replies(reader))
+
+    async def _read_replies(self, reader):
+        error = BrokerUnavailable(f"Broker {self.address} closed the connection")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                future = self._pending.pop(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, ValueError) as e:
+            error = BrokerUnavailable(f"Broker {self.address} connection lost: {e}")
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def request(self, method, path, query="", body=None, content_type=None):
+        """转发一个 HTTP 请求，返回代理进程的应答 {"status", "content_type", "body"}"""
+        if self._writer is None:
+            await self._connect()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        message = {"id": request_id, "method": method, "path": path, "query": query, "body": body,
+                   "content_type": content_type}
+        self._writer.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise BrokerUnavailable(f"Broker {self.address} did not answer within {self.timeout} s") from None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+snapshots = SnapshotReader(os.environ.get("PAR_BROKER_SHM", "texio_par_snapshot"))
+client = None  # 工作进程里第一次转发请求时创建（需要在事件循环中创建）
+
+# 文档页面也转发给代理进程，显示的是完整的接口
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # 生产环境中建议设置具体的域名
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.exception_handler(BrokerUnavailable)
+async def broker_unavailable_handler(request, exc):
+    return JSONResponse(status_code=503, content={"code": -1, "msg": str(exc)})
+
+
+async def forward(request: Request):
+    global client
+    if client is None:
+        client = BrokerClient(broker_address(), float(os.environ.get("PAR_BROKER_TIMEOUT", 60)))
+    body = await request.body()
+    reply = await client.request(request.method, request.url.path, request.url.query,
+                                 body.decode("utf-8") if body else None, request.headers.get("content-type"))
+    return Response(content=reply["body"], status_code=reply["status"], media_type=reply["content_type"])
+
+
+def snapshot_device(device_id):
+    """共享内存中设备的状态，代理进程还没有发布时返回 None"""
+    snapshot = snapshots.read()
+    if snapshot is None:
+        return None
+    device_id = device_id or snapshot["default"]
+    device = snapshot["devices"].get(device_id)
+    if device is None:
+        raise HTTPException(status_code=404, detail=f"Unknown device: {device_id}")
+    return device
+
+
+async def read_status(key, request, max_age, device_id):
+    """缓存足够新时直接返回共享内存中的状态，否则转发给代理进程查询设备"""
+    device = snapshot_device(device_id)
+    if device is not None:
+        entry = device["telemetry"].get(key)
+        max_age = device["max_age"] if max_age is None else max_age
+        if entry is not None and time.time() - entry["timestamp"] <= max_age:
+            return dict(entry["response"], timestamp=entry["timestamp"])
+    return await forward(request)
+
+
+@app.get("/api/get_output_status")
+@app.get("/api/devices/{device_id}/get_output_status")
+async def get_output_status(request: Request, max_age: Optional[float] = None, device_id: Optional[str] = None):
+    return await read_status("output_status", request, max_age, device_id)
+
+
+@app.get("/api/getSystemStatus")
+@app.get("/api/devices/{device_id}/getSystemStatus")
+async def getSystemStatus(request: Request, max_age: Optional[float] = None, device_id: Optional[str] = None):
+    return await read_status("system_status", request, max_age, device_id)
+
+
+@app.get("/api/get_memory_preset")
+@app.get("/api/devices/{device_id}/get_memory_preset")
+async def get_memory_preset(request: Request, max_age: Optional[float] = None, device_id: Optional[str] = None):
+    return await read_status("memory_preset", request, max_age, device_id)
+
+
+@app.get("/api/stream")
+@app.get("/api/devices/{device_id}/stream")
+async def stream(keys: str = "output_status,system_status", device_id: Optional[str] = None, interval: float = 0.02):
+    """实时数据流：按 interval 秒检查共享内存的序号，有新结果时推送，事件格式与单进程服务器相同"""
+    keys = [key for key in keys.split(",") if key]
+    if not keys or any(key not in QUERIES for key in keys):
+        raise HTTPException(status_code=400, detail=f"keys should be chosen from {', '.join(QUERIES)}")
+    if snapshot_device(device_id) is None:
+        raise BrokerUnavailable("Broker has not published any telemetry yet")
+
+    async def events():
+        sent = {}  # key -> 已推送的序号
+        last_sequence = None
+        last_event = time.monotonic()
+        while True:
+            sequence = snapshots.sequence()
+            if sequence != last_sequence:
+                last_sequence = sequence
+                telemetry = snapshot_device(device_id)["telemetry"]
+                for key in keys:
+                    entry = telemetry.get(key)
+                    if entry is not None and entry["sequence"] != sent.get(key):
+                        sent[key] = entry["sequence"]
+                        last_event = time.monotonic()
+                        data = json.dumps(dict(entry["response"], timestamp=entry["timestamp"]), ensure_ascii=False)
+                        yield f"id: {entry['sequence']}\nevent: {key}\ndata: {data}\n\n"
+            if time.monotonic() - last_event >= 15:
+                # 定期发送注释行保持连接，同时及时发现已经断开的客户端
+                last_event = time.monotonic()
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# 其他接口都转发给代理进程
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def forward_all(request: Request, path: str):
+    return await forward(request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 多进程 Web API：串口代理进程 + 多个 HTTP 工作进程")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="HTTP 工作进程数，默认为 CPU 核数")
+    parser.add_argument("--broker-only", action="store_true", help="只启动代理进程")
+    args = parser.parse_args()
+
+    if args.broker_only:
+        run_broker()
+        return
+
+    import multiprocessing
+    import uvicorn
+    ready = multiprocessing.Event()
+    broker = multiprocessing.Process(target=run_broker, args=(ready,), name="par-broker")
+    broker.start()
+    # 等代理进程打开套接字和共享内存后再启动工作进程
+    while not ready.wait(0.1):
+        if not broker.is_alive():
+            sys.exit("串口代理进程启动失败")
+    try:
+        uvicorn.run("TEXIO_PAR_Broker:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        broker.terminate()
+        broker.join()
+
+
+if __name__ == "__main__":
+    main()
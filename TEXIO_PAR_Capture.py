@@ -0,0 +1,411 @@
+"""
+PAR20-4H 串口通信抓包与回放
+
+把串口上收发的原始字节按 时间戳 + 方向 + 数据 追加写入二进制文件，写入只是一次 struct.pack 和一次带缓冲的 write，
+开着抓包也不会拖慢指令；每条发送记录同时在索引文件（抓包文件名 + .idx）中记下 时间戳 和 文件偏移，回放时可以直接跳到指定时间。
+
+抓包文件：文件头 "PARCAP01" + 开始抓包时的 time.time()（double），之后是一条条记录：
+    距离开始抓包的秒数（double，time.monotonic() 计时） + 方向（0 发送，1 接收） + 数据长度（uint16） + 数据
+索引文件：每条发送记录一项 (时间戳 double, 文件偏移 uint64)
+
+用法：
+    python TEXIO_PAR_Capture.py dump capture.parcap [--start 12.5] [--end 20]       # 逐条打印收发数据（HEX/ASCII）
+    python TEXIO_PAR_Capture.py parse capture.parcap [--speed 1]                     # 把应答重新交给协议解析器，统计延时和解析错误
+    python TEXIO_PAR_Capture.py replay capture.parcap [--speed 10] [--port COM47]   # 按录制时的节奏把指令重新发给模拟器或电源
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+from typing import NamedTuple
+
+import TEXIO_PAR_Codec as codec
+from TEXIO_PAR_Codec import NAK, ProtocolError, acknowledgement, iter_frames
+from TEXIO_PAR_Stats import percentile
+
+_MAGIC = b"PARCAP01"
+_HEADER = struct.Struct("<8sd")  # 标识, 开始抓包时的 time.time()
+_RECORD = struct.Struct("<dBH")  # 距离开始的秒数, 方向, 数据长度
+_INDEX = struct.Struct("<dQ")  # 时间戳, 记录在抓包文件中的偏移
+TX, RX = 0, 1
+MAX_CHUNK = 0xFFFF  # 一条记录最多的数据字节数，更长的数据拆成多条
+
+# 查询指令对应的解析函数
+PARSERS = {"ST2": codec.parse_system_status, "ST4": codec.parse_output_status, "ST5": codec.parse_memory_preset}
+
+
+class CaptureRecord(NamedTuple):
+    time: float  # 距离开始抓包的秒数
+    direction: int  # TX / RX
+    data: bytes
+
+
+class Transaction(NamedTuple):
+    """一条指令和它之后（下一条指令之前）收到的所有数据"""
+    time: float
+    instruction: bytes
+    response: bytes
+    rx_times: tuple  # 每段接收数据的时间戳，与 response 中的各段依次对应
+    rx_sizes: tuple
+
+
+class CaptureWriter:
+    """
+    path: 抓包文件，已经存在时覆盖
+    buffer_size: 写入缓冲区大小，数据先留在内存里，攒够一块或 flush()/close() 时才写入磁盘
+    """
+
+    def __init__(self, path, buffer_size=65536):
+        self.path = path
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._index = open(path + ".idx", "wb", buffering=4096)
+        self._file.write(_HEADER.pack(_MAGIC, self.start_time))
+        self._offset = _HEADER.size
+        self.records = 0
+        self.bytes = {TX: 0, RX: 0}
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def write(self, direction, data, timestamp=None):
+        """追加一条记录，timestamp 为 time.monotonic()，不指定时取当前时刻"""
+        if self._file is None or not data:
+            return
+        t = (time.monotonic() if timestamp is None else timestamp) - self._start
+        for i in range(0, len(data), MAX_CHUNK):
+            chunk = data[i:i + MAX_CHUNK]
+            if direction == TX:
+                self._index.write(_INDEX.pack(t, self._offset))
+            self._file.write(_RECORD.pack(t, direction, len(chunk)))
+            self._file.write(chunk)
+            self._offset += _RECORD.size + len(chunk)
+            self.records += 1
+        self.bytes[direction] += len(data)
+
+    def tx(self, data, timestamp=None):
+        self.write(TX, data, timestamp)
+
+    def rx(self, data, timestamp=None):
+        self.write(RX, data, timestamp)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+            self._index.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._index.close()
+        self._file = None
+        self._index = None
+
+    def status(self):
+        return {"path": self.path, "active": self._file is not None, "start_time": self.start_time,
+                "duration": round(time.monotonic() - self._start, 3), "records": self.records,
+                "tx_bytes": self.bytes[TX], "rx_bytes": self.bytes[RX]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    """读取抓包文件；文件末尾写到一半的记录（例如程序被强制结束）会被忽略"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) != _HEADER.size or header[:8] != _MAGIC:
+            raise ValueError(f"{path} 不是抓包文件")
+        _, self.start_time = _HEADER.unpack(header)
+        self._index = None
+
+    def index(self):
+        """[(时间戳, 文件偏移)]，每条发送记录一项；索引文件缺失或不完整时扫描抓包文件重建"""
+        if self._index is not None:
+            return self._index
+        entries = []
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                data = f.read()
+            entries = [entry for entry in _INDEX.iter_unpack(data[:len(data) - len(data) % _INDEX.size])]
+        except OSError:
+            pass
+        size = os.path.getsize(self.path)
+        if not entries or entries[-1][1] >= size:
+            entries = [(t, offset) for offset, (t, direction, _) in self._scan() if direction == TX]
+        self._index = entries
+        return entries
+
+    def _scan(self, offset=_HEADER.size):
+        """依次返回 (偏移, 记录)"""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                head = f.read(_RECORD.size)
+                if len(head) < _RECORD.size:
+                    return
+                t, direction, length = _RECORD.unpack(head)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield offset, CaptureRecord(t, direction, data)
+                offset += _RECORD.size + length
+
+    def records(self, start=None, end=None):
+        """时间范围 [start, end] 内的记录，start 通过索引直接定位到之前最近的一条发送记录"""
+        offset = _HEADER.size
+        if start is not None:
+            for t, position in self.index():
+                if t > start:
+                    break
+                offset = position
+        for _, record in self._scan(offset):
+            if start is not None and record.time < start:
+                continue
+            if end is not None and record.time > end:
+                return
+            yield record
+
+    __iter__ = records
+
+    def transactions(self, start=None, end=None):
+        """把记录按发送分组，每条指令连同下一条指令之前收到的数据组成一个 Transaction"""
+        current = None
+        for record in self.records(start, end):
+            if record.direction == TX:
+                if current is not None:
+                    yield _transaction(*current)
+                current = [record.time, record.data, [], []]
+            elif current is not None:
+                current[2].append(record.time)
+                current[3].append(record.data)
+        if current is not None:
+            yield _transaction(*current)
+
+
+def _transaction(t, instruction, rx_times, chunks):
+    return Transaction(t, instruction, b"".join(chunks), tuple(rx_times), tuple(len(c) for c in chunks))
+
+
+def command_of(instruction):
+    """从指令帧中取出 (单元字符, 不含单元字符的指令)，不是完整的指令帧时返回 (None, None)"""
+    for body, _ in iter_frames(instruction):
+        text = body.decode("ascii", errors="replace")
+        return text[:1], text[1:]
+    return None, None
+
+
+def complete(buffer, need_response, unit):
+    """应答是否完整；抓包里没有记录设备地址，总线同一时间只有一条指令，任何地址的响应帧都算数"""
+    if acknowledgement(buffer, unit) == NAK or not need_response:
+        return acknowledgement(buffer, unit) is not None
+    return any(body.startswith(b'@MS') for body, _ in iter_frames(buffer))
+
+
+def completion_time(transaction, need_response, unit):
+    """按录制的接收时刻，应答变得完整的时间（距离发送的秒数），应答不完整时返回 None"""
+    buffer = bytearray()
+    for t, size in zip(transaction.rx_times, transaction.rx_sizes):
+        buffer += transaction.response[len(buffer):len(buffer) + size]
+        if complete(buffer, need_response, unit):
+            return t - transaction.time
+    return None
+
+
+def analyze(transaction):
+    """把一条录制的指令和应答重新交给协议解析器，返回结果字典"""
+    unit, command = command_of(transaction.instruction)
+    result = {"time": round(transaction.time, 4), "command": command, "outcome": None, "latency_ms": None,
+              "result": None}
+    if command is None:
+        result["outcome"] = "invalid"
+        return result
+    need_response = command in PARSERS
+    latency = completion_time(transaction, need_response, unit)
+    if acknowledgement(transaction.response, unit) == NAK:
+        result["outcome"] = "nak"
+    elif latency is None:
+        result["outcome"] = "timeout"
+    else:
+        result["outcome"] = "ack"
+    if latency is not None:
+        result["latency_ms"] = round(latency * 1000, 2)
+    if need_response and result["outcome"] == "ack":
+        try:
+            result["result"] = PARSERS[command](transaction.response).to_dict()
+        except ProtocolError as e:
+            result["outcome"] = "parse_error"
+            result["result"] = str(e)
+    return result
+
+
+def pace(first_time, origin, t, speed):
+    """按 speed 倍速等到录制时刻 t 对应的回放时刻，speed 为 0 时不等待"""
+    if speed > 0:
+        delay = origin + (t - first_time) / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def summarize(results):
+    outcomes = {}
+    for r in results:
+        outcomes[r["outcome"]] = outcomes.get(r["outcome"], 0) + 1
+    latencies = sorted(r["latency_ms"] for r in results if r["latency_ms"] is not None)
+    summary = {"transactions": len(results), "outcomes": outcomes}
+    if latencies:
+        summary["latency_ms"] = {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                                 "max": latencies[-1]}
+    gaps = [b["time"] - a["time"] - (a["latency_ms"] or 0) / 1000 for a, b in zip(results, results[1:])]
+    if gaps:
+        summary["min_gap_ms"] = round(min(gaps) * 1000, 2)
+    return summary
+
+
+def parse_capture(reader, start=None, end=None, speed=0.0, verbose=True):
+    """把抓包中的应答按录制时的节奏（speed 倍速，0 为不等待）交给解析器，返回每条指令的结果"""
+    results = []
+    origin = time.monotonic()
+    first_time = None
+    for transaction in reader.transactions(start, end):
+        if first_time is None:
+            first_time = transaction.time
+        pace(first_time, origin, transaction.time, speed)
+        result = analyze(transaction)
+        results.append(result)
+        if verbose:
+            print_result(result)
+    return results
+
+
+def replay_capture(reader, ser, start=None, end=None, speed=1.0, ack_timeout=0.5, response_timeout=1.0,
+                   verbose=True):
+    """
+    按录制时的节奏把抓包中的指令重新发送到串口 ser（模拟器或实物电源），返回每条指令录制时和回放时的结果
+    上一条指令的应答还没收完时下一条不会提前发送，与驱动程序的行为一致
+    """
+    results = []
+    origin = time.monotonic()
+    first_time = None
+    for transaction in reader.transactions(start, end):
+        unit, command = command_of(transaction.instruction)
+        if command is None:
+            continue
+        if first_time is None:
+            first_time = transaction.time
+        pace(first_time, origin, transaction.time, speed)
+        need_response = command in PARSERS
+        timeout = response_timeout if need_response else ack_timeout
+        ser.reset_input_buffer()
+        sent = time.monotonic()
+        ser.write(transaction.instruction)
+        buffer = bytearray()
+        chunks = []
+        while not complete(buffer, need_response, unit) and time.monotonic() - sent < timeout:
+            data = ser.read(ser.in_waiting or 1)
+            if data:
+                buffer += data
+                chunks.append((time.monotonic() - sent, data))
+        replayed = analyze(Transaction(0.0, transaction.instruction, bytes(buffer),
+                                       tuple(t for t, _ in chunks), tuple(len(d) for _, d in chunks)))
+        replayed["time"] = round(sent - origin, 4)
+        result = {"recorded": analyze(transaction), "replayed": replayed}
+        results.append(result)
+        if verbose:
+            print_result(result["recorded"], replayed)
+    return results
+
+
+def print_result(result, replayed=None):
+    latency = f"{result['latency_ms']:8.2f} ms" if result["latency_ms"] is not None else "       - ms"
+    line = f"{result['time']:10.4f}  {result['command'] or '?':<12} {result['outcome']:<11} {latency}"
+    if replayed is not None:
+        replay_latency = f"{replayed['latency_ms']:8.2f} ms" if replayed["latency_ms"] is not None else "       - ms"
+        line += f"  ->  {replayed['outcome']:<11} {replay_latency}"
+        if replayed["result"] != result["result"]:
+            line += "  结果不同"
+    elif result["result"] is not None:
+        line += f"  {result['result']}"
+    print(line)
+
+
+def format_record(record):
+    ascii_data = "".join(chr(byte) if 32 <= byte <= 126 else "." for byte in record.data)
+    return (f"{record.time:10.4f}  {'TX' if record.direction == TX else 'RX'}  {len(record.data):4d}  "
+            f"{ascii_data:<40}  {record.data.hex(' ')}")
+
+
+def open_serial(port):
+    import serial
+    return serial.Serial(port=port, baudrate=9600, bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN,
+                         stopbits=serial.STOPBITS_ONE, timeout=0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 串口抓包查看与回放")
+    sub = parser.add_subparsers(dest="action", required=True)
+    for name, help_text in (("dump", "逐条打印收发数据"), ("parse", "把录制的应答交给协议解析器"),
+                            ("replay", "把录制的指令重新发给模拟器或电源")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("path", help="抓包文件")
+        p.add_argument("--start", type=float, help="从录制的第几秒开始")
+        p.add_argument("--end", type=float, help="到录制的第几秒结束")
+        if name != "dump":
+            p.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    sub.choices["parse"].add_argument("--speed", type=float, default=0.0, help="回放倍速，0 为不等待（默认）")
+    replay = sub.choices["replay"]
+    replay.add_argument("--speed", type=float, default=1.0, help="回放倍速，1 为录制时的节奏，0 为不等待")
+    replay.add_argument("--port", help="串口号；不指定时自动启动软件模拟器")
+    replay.add_argument("--units", default="A:01", help="模拟器上的电源，单元字符:设备地址，逗号分隔")
+    replay.add_argument("--processing-delay", type=float, default=0.02, help="模拟器的设备处理延时（秒）")
+    replay.add_argument("--min-gap", type=float, default=0.0, help="模拟器要求的最小指令间隔（秒）")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.path)
+    print(f"抓包文件: {args.path}，开始于 {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.start_time))}",
+          file=sys.stderr)
+    if args.action == "dump":
+        for record in reader.records(args.start, args.end):
+            print(format_record(record))
+        return
+
+    if args.action == "parse":
+        results = parse_capture(reader, args.start, args.end, args.speed, verbose=not args.json)
+        summary = summarize(results)
+    else:
+        simulator = None
+        port = args.port
+        if port is None:
+            from TEXIO_PAR_Simulator import PARSimulator
+            simulator = PARSimulator(units=dict(item.split(":") for item in args.units.split(",")),
+                                     processing_delay=args.processing_delay, min_gap=args.min_gap).start()
+            port = simulator.port
+            print(f"使用软件模拟器: {port}", file=sys.stderr)
+        ser = open_serial(port)
+        try:
+            results = replay_capture(reader, ser, args.start, args.end, args.speed, verbose=not args.json)
+        finally:
+            ser.close()
+            if simulator is not None:
+                simulator.stop()
+        summary = {"recorded": summarize([r["recorded"] for r in results]),
+                   "replayed": summarize([r["replayed"] for r in results])}
+    if args.json:
+        import json
+        print(json.dumps({"summary": summary, "results": results}, ensure_ascii=False, indent=2))
+    else:
+        print(f"\n统计: {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+PAR20-4H 串口协议编解码
+
+指令帧：ENQ + 数据正文 + ETX + 2字符校验和
+应答：[回显的指令] ACK/NAK + 单元字符 [ENQ + @MSx,2字符设备地址,… + ETX + 2字符校验和]
+校验和是数据正文与ETX的和的低8位，以2个十六进制ASCII字符发送，指令和响应帧都一样
+
+命令交互器、呼吸灯DEMO、Web API 服务器和模拟器共用这里的编码、校验和与响应解析
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+ENQ, ETX, ACK, NAK = 0x05, 0x03, 0x06, 0x15  # 协议控制字符
+
+# 存储区代码：设置电压、电流（1mA档）、电流（0.1mA档/微安档）和选择输出时使用
+MEMORY_OBJECTS = ("workspace", "memory1", "memory2", "memory3")
+VOLTAGE_CODES = {"workspace": "A", "memory1": "E", "memory2": "J", "memory3": "N"}
+CURRENT_CODES = {"workspace": "A", "memory1": "E", "memory2": "J", "memory3": "N"}
+CURRENT_UA_CODES = {"workspace": "B", "memory1": "F", "memory2": "K", "memory3": "P"}
+PRESET_CODES = {"workspace": "0", "memory1": "1", "memory2": "2", "memory3": "3"}
+
+# 0~255 对应的2字符十六进制ASCII校验和
+_CHECKSUM_TABLE = [format(i, '02X').encode('ascii') for i in range(256)]
+
+
+class ProtocolError(Exception):
+    """应答无法解析：没有找到响应帧、设备地址不匹配或校验和错误"""
+
+
+def calculate_checksum(data):
+    """校验和是数据正文与ETX的和的低8位，返回2个十六进制ASCII字符"""
+    return _CHECKSUM_TABLE[(sum(data) + ETX) & 0xFF]
+
+
+@lru_cache(maxsize=512)
+def encode_frame(body):
+    """把数据正文（str）编码为完整的指令帧，常用指令的编码结果会被缓存"""
+    data = body.encode('ascii')
+    return bytes([ENQ]) + data + bytes([ETX]) + _CHECKSUM_TABLE[(sum(data) + ETX) & 0xFF]
+
+
+def iter_frames(buffer):
+    """依次取出缓冲区中所有完整的帧，返回 (数据正文, 校验和是否正确)"""
+    pos = 0
+    while True:
+        enq_index = buffer.find(ENQ, pos)
+        if enq_index == -1:
+            return
+        etx_index = buffer.find(ETX, enq_index)
+        if etx_index == -1 or len(buffer) < etx_index + 3:
+            return
+        body = bytes(buffer[enq_index + 1:etx_index])
+        yield body, buffer[etx_index + 1:etx_index + 3] == calculate_checksum(body)
+        pos = etx_index + 3
+
+
+def response_complete(buffer, need_response, unit="A"):
+    """
+    判断接收缓冲区里指定设备的应答是否已经完整
+    设置类指令等到 ACK/NAK+单元字符即可；查询类指令要等到完整的 @MSx 响应帧（回显的指令正文不以 @ 开头，会被跳过）
+    响应帧的设备地址不在这里检查：地址不符的完整响应帧也算收完了，由 response_valid / foreign_response 判断
+    """
+    unit = unit.encode('ascii')
+    # NAK 说明设备拒绝了指令，不用再等了
+    if buffer.find(bytes([NAK]) + unit) != -1:
+        return True
+    if not need_response:
+        return buffer.find(bytes([ACK]) + unit) != -1
+    for body, _ in iter_frames(buffer):
+        if body.startswith(b'@MS'):
+            return True
+    return False
+
+
+def acknowledgement(buffer, unit="A"):
+    """返回设备对指令的应答：ACK 或 NAK，还没有收到时返回 None"""
+    unit = unit.encode('ascii')
+    if buffer.find(bytes([NAK]) + unit) != -1:
+        return NAK
+    if buffer.find(bytes([ACK]) + unit) != -1:
+        return ACK
+    return None
+
+
+def response_valid(buffer, need_response, unit="A", address=None):
+    """
+    应答是否正确：设置类指令收到 ACK；查询类指令还要收到响应帧并且校验和正确
+    address 不为 None 时只接受该地址的响应帧
+    NAK、校验和错误或者还没收完都返回 False，调用方可以立刻重发
+    """
+    if acknowledgement(buffer, unit) != ACK:
+        return False
+    if not need_response:
+        return True
+    prefix = address.encode('ascii') + b',' if address is not None else b''
+    for body, checksum_ok in iter_frames(buffer):
+        if body.startswith(b'@MS') and body[5:].startswith(prefix):
+            return checksum_ok
+    return False
+
+
+def foreign_response(buffer, address):
+    """
+    收到的响应帧校验和正确，但都是其他设备地址的：设备地址配置错了，重发也不会变，调用方不应重试
+    """
+    found = False
+    for body, checksum_ok in iter_frames(buffer):
+        if not body.startswith(b'@MS'):
+            continue
+        if body[5:8] == address.encode('ascii') + b',' or not checksum_ok:
+            return False
+        found = True
+    return found
+
+
+def answered(buffer, instruction):
+    """去掉设备回显的指令后缓冲区里还有数据，说明设备应答了（哪怕应答不完整或有错），而不是没有响应"""
+    return len(buffer) > len(instruction) or (bool(buffer) and not instruction.startswith(bytes(buffer)))
+
+
+def find_response(buffer, tag, address=None):
+    """
+    在接收数据中找到 tag（MS2/MS4/MS5）类型的响应帧，返回数据正文
+    address 不为 None 时只接受该地址的响应帧；校验和错误时抛出 ProtocolError
+    """
+    head = b'@' + tag.encode('ascii') + b','
+    found_other_address = False
+    for body, checksum_ok in iter_frames(buffer):
+        if not body.startswith(head):
+            continue
+        if address is not None and body[len(head):len(head) + 3] != address.encode('ascii') + b',':
+            found_other_address = True
+            continue
+        if not checksum_ok:
+            raise ProtocolError("校验和错误")
+        return body
+    if found_other_address:
+        raise ProtocolError("设备地址不匹配")
+    raise ProtocolError("未找到有效数据起始位置")
+
+
+class SystemStatus(NamedTuple):
+    """MS2：系统状态"""
+    address: str
+    ovp_display: int  # OVP/电压电流显示
+    is_output_on: bool
+    is_protection_on: bool
+    tracking: int  # トラッキング
+    memory_preset: int  # 0：工作区，1：记忆1，2：记忆2，3：记忆3
+    is_ua_accuracy: bool
+
+    def to_dict(self):
+        # 保持与原来接口返回的字段名和取值一致
+        return {"OVP/电压电流显示": self.ovp_display, "is_output_on": int(self.is_output_on),
+                "is_protection_on": int(self.is_protection_on), "トラッキング": self.tracking,
+                "memory_preset": self.memory_preset, "is_ua_accuracy": int(self.is_ua_accuracy)}
+
+
+class OutputStatus(NamedTuple):
+    """MS4：输出状态"""
+    address: str
+    voltage: float
+    current: float
+    ovp: float
+    is_cc: bool  # 设备返回 1000 表示恒流
+
+    def to_dict(self):
+        return {"voltage": self.voltage, "current": self.current, "OVP": self.ovp, "is_CC": self.is_cc}
+
+
+class PresetValues(NamedTuple):
+    voltage: float
+    current: float  # 1mA档
+    current_ua: float  # 0.1mA档
+
+
+class MemoryPreset(NamedTuple):
+    """MS5：工作区和3个记忆的预设值"""
+    address: str
+    workspace: PresetValues
+    memory1: PresetValues
+    memory2: PresetValues
+    memory3: PresetValues
+
+    def to_dict(self):
+        return {name: getattr(self, name)._asdict() for name in MEMORY_OBJECTS}
+
+
+# 每种响应帧一个预编译的正则：ENQ + (@MSx,地址,字段…) + ETX + 2字符校验和，一次 search 同时完成定位和取出校验和，字段再用 split 拆分
+def _frame_pattern(tag):
+    return re.compile(rb'\x05(@' + tag + rb',(\w\w),([^\x03\x05]*))\x03([0-9A-F]{2})')
+
+
+_MS2_PATTERN = _frame_pattern(b'MS2')
+_MS4_PATTERN = _frame_pattern(b'MS4')
+_MS5_PATTERN = _frame_pattern(b'MS5')
+
+
+def _match(pattern, buffer, tag, address, field_count):
+    """找到本设备的响应帧并校验，返回 (设备地址, 字段列表)"""
+    address = address.encode('ascii') if address is not None else None
+    match = pattern.search(buffer)
+    while match is not None:
+        body, frame_address, fields, checksum = match.groups()
+        if address is None or frame_address == address:
+            if _CHECKSUM_TABLE[(sum(body) + ETX) & 0xFF] != checksum:
+                raise ProtocolError("校验和错误")
+            fields = fields.split(b',')
+            if len(fields) != field_count:
+                raise ProtocolError("响应数据格式错误")
+            return frame_address.decode('ascii'), fields
+        match = pattern.search(buffer, match.end())
+    # 没有匹配的帧时再逐帧检查，给出具体原因
+    find_response(buffer, tag, address.decode('ascii') if address is not None else None)
+    raise ProtocolError("响应数据格式错误")
+
+
+def parse_system_status(buffer, address=None):
+    """解析 AST2 的应答：@MS2,地址,OVP/电压电流显示,输出开启,输出保护开启,トラッキング,记忆预设,微安档"""
+    address, fields = _match(_MS2_PATTERN, buffer, "MS2", address, 6)
+    try:
+        return SystemStatus(address, int(fields[0]), fields[1] == b'1', fields[2] == b'1',
+                            int(fields[3]), int(fields[4]), fields[5] == b'1')
+    except ValueError:
+        raise ProtocolError("响应数据格式错误") from None
+
+
+def parse_output_status(buffer, address=None):
+    """解析 AST4 的应答：@MS4,地址,电压,电流,OVP,CC状态"""
+    address, fields = _match(_MS4_PATTERN, buffer, "MS4", address, 4)
+    try:
+        return OutputStatus(address, float(fields[0]), float(fields[1]), float(fields[2]), int(fields[3]) == 1000)
+    except ValueError:
+        raise ProtocolError("响应数据格式错误") from None
+
+
+def parse_memory_preset(buffer, address=None):
+    """
+    解析 AST5 的应答
+    @MS5,设备地址,工作区电压，工作区电流1ma档，工作区电流0.1ma档，记忆1电压，记忆1电流1ma档，记忆1电流0.1ma档，
+    记忆2电压，记忆2电流1ma档，记忆2电流0.1ma档，记忆3电压，记忆3电流1ma档，记忆3电流0.1ma档
+    """
+    address, fields = _match(_MS5_PATTERN, buffer, "MS5", address, 12)
+    try:
+        values = list(map(float, fields))
+    except ValueError:
+        raise ProtocolError("响应数据格式错误") from None
+    return MemoryPreset(address, PresetValues._make(values[0:3]), PresetValues._make(values[3:6]),
+                        PresetValues._make(values[6:9]), PresetValues._make(values[9:12]))
@@ -0,0 +1,95 @@
+"""
+PAR20-4H 输出电能和电量累计
+
+控制器每次 AST4 查询得到电压、电流和 CC 状态后调用 EnergyMeter.add()，相邻两个采样点之间按梯形积分累加：
+    电能 Wh += (V1·I1 + V2·I2) / 2 · Δt / 3600
+    电量 Ah += (I1 + I2) / 2 · Δt / 3600
+两个采样点都处于恒流（CC）或恒压（CV）时这段时间计入对应状态，状态不同时各计一半。
+相邻采样点间隔超过 max_gap 秒（轮询停止、串口断开等）时不跨过这段空白积分，只记录空白的次数和时长，
+这时累计值是下限，report() 里的 coverage 表示有多少时间被采样覆盖。
+
+同步控制器（呼吸灯DEMO）和 Web API 服务器共用这里的实现，精度取决于轮询间隔（PAR_POLL_INTERVAL）。
+"""
+import time
+
+
+class EnergyMeter:
+    """
+    max_gap: 相邻采样点的最大间隔（秒），超过时视为数据空白，不参与积分
+    """
+
+    def __init__(self, max_gap=5.0):
+        if max_gap <= 0:
+            raise ValueError("max_gap 必须大于0")
+        self.max_gap = max_gap
+        self._clear()
+
+    def reset(self):
+        """清零所有累计值，返回清零前的统计"""
+        report = self.report()
+        last = self._last
+        self._clear()
+        now = time.monotonic()
+        if last is not None and now - last[0] <= self.max_gap:
+            # 从清零的时刻接着积分，下一个采样点之前的这段时间不会丢失
+            self._last = (now,) + last[1:]
+        return report
+
+    def _clear(self):
+        self.reset_at = time.time()  # 开始累计的时刻（Unix 时间戳）
+        self._reset_monotonic = time.monotonic()
+        self.energy_wh = 0.0
+        self.charge_ah = 0.0
+        self.integrated_s = 0.0  # 参与积分的总时长
+        self.cc_s = 0.0
+        self.cv_s = 0.0
+        self.samples = 0
+        self.gaps = 0
+        self.gap_s = 0.0
+        self.peak_power_w = 0.0
+        self.last_sample_at = None  # 最后一个采样点的 Unix 时间戳
+        self._last = None  # (time.monotonic(), 电压, 电流, 是否CC)
+
+    def add(self, voltage, current, is_cc, now=None):
+        """加入一个采样点，now 为采样时刻的 time.monotonic()"""
+        now = time.monotonic() if now is None else now
+        self.samples += 1
+        self.last_sample_at = time.time()
+        self.peak_power_w = max(self.peak_power_w, voltage * current)
+        last = self._last
+        self._last = (now, voltage, current, is_cc)
+        if last is None:
+            return
+        last_time, last_voltage, last_current, last_cc = last
+        dt = now - last_time
+        if dt <= 0:
+            return
+        if dt > self.max_gap:
+            self.gaps += 1
+            self.gap_s += dt
+            return
+        self.energy_wh += (last_voltage * last_current + voltage * current) / 2 * dt / 3600
+        self.charge_ah += (last_current + current) / 2 * dt / 3600
+        self.integrated_s += dt
+        self.cc_s += dt * (bool(last_cc) + bool(is_cc)) / 2
+        self.cv_s += dt * ((not last_cc) + (not is_cc)) / 2
+
+    def report(self):
+        elapsed = time.monotonic() - self._reset_monotonic
+        return {
+            "energy_wh": self.energy_wh,
+            "charge_ah": self.charge_ah,
+            "average_power_w": self.energy_wh * 3600 / self.integrated_s if self.integrated_s > 0 else None,
+            "peak_power_w": self.peak_power_w,
+            "cc_s": self.cc_s,
+            "cv_s": self.cv_s,
+            "integrated_s": self.integrated_s,
+            "elapsed_s": elapsed,
+            "coverage": self.integrated_s / elapsed if elapsed > 0 else None,
+            "samples": self.samples,
+            "gaps": self.gaps,
+            "gap_s": self.gap_s,
+            "max_gap_s": self.max_gap,
+            "reset_at": self.reset_at,
+            "last_sample_at": self.last_sample_at,
+        }
@@ -0,0 +1,182 @@
+"""
+PAR20-4H 输出状态历史记录
+
+每次 AST4 查询得到的 时间戳、电压、电流、OVP、CC状态 追加到固定大小的环形缓冲区，写满后覆盖最旧的记录。
+每一列是一段连续的定长数组（时间戳 double，电压/电流/OVP float，CC状态 1字节），每条记录 21 字节；
+指定文件路径时缓冲区映射到文件（mmap），服务重启后历史记录还在。
+
+查询时按时间范围把记录分成若干个等宽的时间段，每段返回 最小/最大/平均值，浏览器只需要加载画图需要的点数。
+"""
+import bisect
+import mmap
+import os
+import struct
+
+_MAGIC = b"PARHIST1"
+_HEADER = struct.Struct("<8sIIQ")  # 标识, 容量, 保留, 累计写入的记录数
+_HEADER_SIZE = 32
+# (列名, 类型码, 每个元素的字节数)，按这个顺序依次存放
+_COLUMNS = (("timestamp", "d", 8), ("voltage", "f", 4), ("current", "f", 4), ("ovp", "f", 4), ("cc", "B", 1))
+RECORD_SIZE = sum(size for _, _, size in _COLUMNS)
+
+
+class TelemetryHistory:
+    """
+    capacity: 最多保存的记录数
+    path: 保存历史记录的文件，不指定时只保存在内存中；文件的容量与 capacity 不一致时会重新创建
+    """
+
+    def __init__(self, capacity=100000, path=None):
+        if capacity <= 0:
+            raise ValueError("历史记录容量必须大于0")
+        self.capacity = capacity
+        self.path = path
+        size = _HEADER_SIZE + RECORD_SIZE * capacity
+        self._file = None
+        if path is None:
+            self._buffer = bytearray(size)
+            self.count = 0
+        else:
+            self._file = open(path, "a+b")
+            self._file.seek(0)
+            header = self._file.read(_HEADER.size)
+            reuse = len(header) == _HEADER.size and os.fstat(self._file.fileno()).st_size == size
+            if reuse:
+                magic, file_capacity, _, count = _HEADER.unpack(header)
+                reuse = magic == _MAGIC and file_capacity == capacity
+            if not reuse:
+                if header:
+                    print(f"历史记录文件 {path} 的格式或容量不一致，重新创建")
+                self._file.truncate(0)
+                self._file.truncate(size)
+                count = 0
+            self._buffer = mmap.mmap(self._file.fileno(), size)
+            self.count = count
+        self._view = memoryview(self._buffer)
+        self.columns = {}
+        offset = _HEADER_SIZE
+        for name, typecode, item_size in _COLUMNS:
+            self.columns[name] = self._view[offset:offset + item_size * capacity].cast(typecode)
+            offset += item_size * capacity
+        self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._buffer, 0, _MAGIC, self.capacity, 0, self.count)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, voltage, current, ovp, is_cc):
+        """追加一条记录，缓冲区写满后覆盖最旧的一条"""
+        index = self.count % self.capacity
+        columns = self.columns
+        columns["timestamp"][index] = timestamp
+        columns["voltage"][index] = voltage
+        columns["current"][index] = current
+        columns["ovp"][index] = ovp
+        columns["cc"][index] = 1 if is_cc else 0
+        # 最后才更新记录数，写到一半时中断也不会读到不完整的记录
+        self.count += 1
+        self._write_header()
+
+    def _physical(self, position):
+        """第 position 旧的记录在数组中的下标"""
+        return (self.count - len(self) + position) % self.capacity
+
+    def _timestamp_at(self, position):
+        return self.columns["timestamp"][self._physical(position)]
+
+    def _bisect(self, timestamp):
+        """第一条时间戳不小于 timestamp 的记录的位置（从最旧的记录算起）"""
+        return bisect.bisect_left(_Positions(self), timestamp)
+
+    def _segments(self, lo, hi):
+        """位置 [lo, hi) 对应的数组下标区间，跨过缓冲区末尾时分成两段"""
+        if lo >= hi:
+            return []
+        start = self._physical(lo)
+        end = start + (hi - lo)
+        if end <= self.capacity:
+            return [(start, end)]
+        return [(start, self.capacity), (0, end - self.capacity)]
+
+    def _aggregate(self, name, segments, count):
+        column = self.columns[name]
+        parts = [column[a:b] for a, b in segments]
+        return (min(min(part) for part in parts), max(max(part) for part in parts),
+                sum(sum(part) for part in parts) / count)
+
+    def query(self, start=None, end=None, points=500):
+        """
+        返回 [start, end] 时间范围内的记录，按时间分成最多 points 段，每段给出 最小/最大/平均值
+        cc 为该段中处于恒流状态的记录所占的比例；范围内的记录不超过 points 条时直接返回原始记录（最小=最大=平均）
+        """
+        if points <= 0:
+            raise ValueError("points 必须大于0")
+        n = len(self)
+        lo = 0 if start is None else self._bisect(start)
+        hi = n if end is None else bisect.bisect_right(_Positions(self), end)
+        result = {"start": start, "end": end, "samples": max(hi - lo, 0), "raw": True, "timestamp": [],
+                  "voltage": {"min": [], "max": [], "mean": []}, "current": {"min": [], "max": [], "mean": []},
+                  "ovp": {"min": [], "max": [], "mean": []}, "cc": []}
+        if lo >= hi:
+            return result
+        first, last = self._timestamp_at(lo), self._timestamp_at(hi - 1)
+        if hi - lo <= points or last <= first:
+            bounds = [(i, i + 1) for i in range(lo, hi)]
+        else:
+            result["raw"] = False
+            width = (last - first) / points
+            edges = [lo] + [self._bisect(first + width * k) for k in range(1, points)] + [hi]
+            bounds = [(a, b) for a, b in zip(edges, edges[1:]) if b > a]
+        for a, b in bounds:
+            segments = self._segments(a, b)
+            count = b - a
+            result["timestamp"].append(round(self._aggregate("timestamp", segments, count)[2], 3))
+            for name in ("voltage", "current", "ovp"):
+                # float 只有约7位有效数字，舍入到设备的显示精度以外一位，避免 3.299999952 这样的输出
+                low, high, mean = self._aggregate(name, segments, count)
+                result[name]["min"].append(round(low, 4))
+                result[name]["max"].append(round(high, 4))
+                result[name]["mean"].append(round(mean, 4))
+            result["cc"].append(round(self._aggregate("cc", segments, count)[2], 4))
+        return result
+
+    def latest(self):
+        """最新的一条记录，没有记录时返回 None"""
+        if not self.count:
+            return None
+        index = (self.count - 1) % self.capacity
+        return {name: round(column[index], 3 if name == "timestamp" else 4) for name, column in self.columns.items()}
+
+    def clear(self):
+        self.count = 0
+        self._write_header()
+
+    def flush(self):
+        if self._file is not None:
+            self._buffer.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        for column in self.columns.values():
+            column.release()
+        self._view.release()
+        self._buffer.flush()
+        self._buffer.close()
+        self._file.close()
+        self._file = None
+
+
+class _Positions:
+    """把环形缓冲区按时间顺序包装成序列，供 bisect 二分查找时间戳"""
+
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, position):
+        return self.history._timestamp_at(position)
@@ -0,0 +1,150 @@
+"""
+PAR20-4H 运行指标（Prometheus 文本格式）
+
+不依赖 prometheus_client，只实现驱动需要的三种指标：
+    Counter   只增不减的计数，例如发送的字节数、超时次数
+    Gauge     当前值，可以在抓取时由函数计算，例如排队的请求数
+    Histogram 按上限分桶的分布，例如每类指令的延时
+每个指标可以带标签，例如 device、command；记录一次只是一次字典查找和加法，可以放在指令的热路径上。
+"""
+import bisect
+import math
+import threading
+
+# 默认的延时分桶（秒）：覆盖 9600 波特下单条指令的几毫秒到超时的 1 秒以上
+DEFAULT_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # 标签取值的元组 -> 值
+        self._lock = threading.Lock()  # Windows 上阻塞读取串口的工作线程也会记录指标
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 的标签应为 {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "", key, None, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.help)}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_labels_text(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """function 不为 None 时，每次抓取调用它得到 {标签取值的元组: 值}，不用在每次变化时更新"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        values = self._values if self.function is None else self.function()
+        for key, value in sorted(values.items()):
+            yield "", tuple(map(str, key)), None, value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶的计数（不累加，输出时再累加）+ 超过最大上限的计数, 总和
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", key, ("le", _format_value(float(bound))), cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"指标 {metric.name} 已经存在")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        return self._add(Gauge(name, help_text, labelnames, function))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
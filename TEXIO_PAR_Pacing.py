@@ -0,0 +1,145 @@
+"""
+PAR20-4H 指令间隔控制
+
+日文版手册推荐两条指令之间间隔 500ms，但大部分指令设备处理得远比这快。
+自适应模式按指令类型（单元字符后面的两个字母，例如 VA、ST、SW）分别学习最小间隔：
+    - 收到 ACK：间隔按比例缩小，逐步逼近设备能接受的最快速度
+    - ACK 明显比平时慢：说明设备忙，间隔适当放大
+    - 收到 NAK 或超时：间隔加倍，并把出错时的间隔记为这类指令的下限，之后下限会缓慢回落重新试探
+    - 应答不完整或校验和错误（设备应答了，但数据在线路上受到干扰）：与间隔无关，只计数
+固定模式对所有指令使用同一个间隔（默认 500ms），作为保守的兜底方案。
+
+间隔从上一条指令收到应答的时刻算起。同步控制器（呼吸灯DEMO）和 Web API 服务器共用这里的策略。
+"""
+import time
+
+ADAPTIVE, FIXED = "adaptive", "fixed"
+
+
+class _CommandStats:
+    def __init__(self, gap):
+        self.gap = gap  # 当前使用的间隔（秒）
+        self.floor = 0.0  # 从出错中学到的间隔下限（秒）
+        self.latency = None  # ACK/响应延时的指数移动平均（秒）
+        self.sent = 0
+        self.naks = 0
+        self.timeouts = 0
+        self.slow_acks = 0
+        self.corrupt = 0
+
+
+class CommandPacer:
+    """
+    mode: adaptive 自适应；fixed 固定间隔
+    fixed_gap: 固定模式的间隔
+    initial_gap: 自适应模式下新出现的指令类型的初始间隔，已经从其他指令学到更大的下限时使用那个下限
+    min_gap / max_gap: 自适应模式下间隔的范围
+    """
+    decrease = 0.7  # 每次成功后间隔缩小的比例
+    increase = 2.0  # NAK/超时后间隔放大的倍数
+    floor_decay = 0.98  # 每次成功后学到的下限回落的比例
+    slow_ack_factor = 3.0  # 延时超过平均值的这个倍数（并且多出 slow_ack_margin 秒以上）算作 ACK 偏慢
+    slow_ack_margin = 0.05
+    deadline_factor = 3.0  # 重发前单次等待应答的时间为平均延时的这个倍数再加上 deadline_margin 秒
+    deadline_margin = 0.03
+    min_deadline = 0.05
+
+    def __init__(self, mode=ADAPTIVE, fixed_gap=0.5, initial_gap=0.05, min_gap=0.0, max_gap=2.0):
+        if mode not in (ADAPTIVE, FIXED):
+            raise ValueError(f"未知的指令间隔模式: {mode}")
+        self.mode = mode
+        self.fixed_gap = fixed_gap
+        self.initial_gap = initial_gap
+        self.min_gap = min_gap
+        self.max_gap = max_gap
+        self.last_complete = 0.0  # 上一条指令收到应答（或超时）的时刻，time.monotonic()
+        self.commands = {}  # 指令类型 -> _CommandStats
+
+    @staticmethod
+    def command_type(command):
+        """command 为不含单元字符的指令，例如 VA1.000 -> VA"""
+        return command[:2]
+
+    def _stats(self, command_type):
+        stats = self.commands.get(command_type)
+        if stats is None:
+            # 同一台设备上其他指令出错学到的下限，对新指令也是一个合理的起点
+            learned = max((other.floor for other in self.commands.values()), default=0.0)
+            stats = self.commands[command_type] = _CommandStats(max(self.initial_gap, learned))
+        return stats
+
+    def gap(self, command_type):
+        """这类指令当前使用的间隔（秒）"""
+        if self.mode == FIXED:
+            return self.fixed_gap
+        return self._stats(command_type).gap
+
+    def deadline(self, command_type, timeout):
+        """
+        还可以重发时单次等待应答的时间（秒）：按这类指令的平均延时估算，应答丢失或不完整时很快就能重发
+        还没有学到延时时使用 timeout
+        """
+        stats = self.commands.get(command_type)
+        if stats is None or stats.latency is None:
+            return timeout
+        return min(timeout, max(self.min_deadline, stats.latency * self.deadline_factor + self.deadline_margin))
+
+    def delay(self, command_type, now=None):
+        """发送这类指令之前还需要等待的时间（秒）"""
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.last_complete + self.gap(command_type) - now)
+
+    def record(self, command_type, outcome, latency, idle, now=None):
+        """
+        记录一条指令的结果
+        outcome: ack / nak / timeout（设备没有应答）/ corrupt（应答不完整或校验和错误）
+        latency: 从发送到收到完整应答的时间（秒）
+        idle: 发送时距离上一条指令完成过了多久（秒），用来判断出错是不是因为发得太快
+        """
+        self.last_complete = time.monotonic() if now is None else now
+        stats = self._stats(command_type)
+        stats.sent += 1
+        if outcome == "ack":
+            slow = (stats.latency is not None and latency > stats.latency * self.slow_ack_factor
+                    and latency - stats.latency > self.slow_ack_margin)
+            stats.latency = latency if stats.latency is None else stats.latency * 0.8 + latency * 0.2
+            if slow:
+                stats.slow_acks += 1
+                stats.gap = min(self.max_gap, max(stats.gap * 1.5, 0.01))
+            else:
+                stats.floor *= self.floor_decay
+                stats.gap = max(self.min_gap, stats.floor, stats.gap * self.decrease)
+                if stats.gap < 0.001:
+                    stats.gap = self.min_gap
+            return
+        if outcome == "corrupt":
+            stats.corrupt += 1
+            return
+        if outcome == "nak":
+            stats.naks += 1
+        else:
+            stats.timeouts += 1
+        if idle < self.max_gap:
+            # 间隔太短导致的出错：这个间隔以下都不安全
+            stats.floor = min(self.max_gap, max(stats.floor, idle * 1.5 + 0.01))
+        stats.gap = min(self.max_gap, max(stats.gap * self.increase, stats.floor, 0.01))
+
+    def report(self):
+        """每类指令当前使用的间隔和统计（毫秒）"""
+        return {
+            "mode": self.mode,
+            "fixed_gap_ms": self.fixed_gap * 1000,
+            "commands": {
+                command_type: {
+                    "gap_ms": self.gap(command_type) * 1000,
+                    "floor_ms": stats.floor * 1000,
+                    "latency_ms": stats.latency * 1000 if stats.latency is not None else None,
+                    "sent": stats.sent,
+                    "naks": stats.naks,
+                    "timeouts": stats.timeouts,
+                    "slow_acks": stats.slow_acks,
+                    "corrupt": stats.corrupt,
+                }
+                for command_type, stats in sorted(self.commands.items())
+            },
+        }
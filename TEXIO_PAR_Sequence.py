@@ -0,0 +1,205 @@
+"""
+PAR20-4H 定时测试序列
+
+把上电/断电、切换预设这类测试写成一个 JSON 序列交给 Web API 服务器，在服务器上按时间表执行，
+步骤之间的时间不再受客户端和网络延时的影响。序列由三种步骤组成：
+    {"op": "control_output", "args": {"enable": true}}   执行一个操作（操作名和参数与 /api/batch 相同）
+    {"wait": 3}                                          等待 3 秒
+    {"loop": 5, "steps": [...]}                          重复执行其中的步骤 5 次
+操作步骤可以带 "at": 秒数，表示相对所在层（序列开始或本次循环开始）的时刻，用来写绝对时间表。
+
+提交时先把循环展开成一张时间表，每一步都有相对序列开始的计划时刻；执行时按截止时间等待，
+不是在上一步完成后再等 wait 秒，所以指令本身的耗时不会让后面的步骤越拖越晚。
+同一时刻的多个操作依次执行，后面的步骤会晚上前面指令的耗时，这部分也记录在延迟里。
+每一步记录计划时刻、调用时刻、指令实际发送到串口的时刻、完成时刻和结果（都是相对序列开始的毫秒数）。
+"""
+import asyncio
+import time
+import uuid
+
+from TEXIO_PAR_Stats import summary
+
+MAX_STEPS = 10000  # 展开循环后最多的操作步骤数，防止嵌套循环写错时占满内存
+# 展开时最多处理的步骤数（wait 和每一次循环都算），只有 wait 的循环次数写得很大时也不会长时间占用事件循环
+MAX_EXPANSION = MAX_STEPS * 10
+SPIN_TIME = 0.002  # 截止时间前最后这段时间不用 asyncio.sleep（精度约1ms），改为让出事件循环的忙等
+
+
+def compile_steps(steps, validate, max_steps=MAX_STEPS, max_expansion=MAX_EXPANSION):
+    """
+    把序列展开成时间表 [(计划时刻（秒）, 操作名, 解析后的参数, 步骤路径), ...]
+    validate(操作名, 参数) 返回 (解析后的参数, 错误信息)；步骤格式或参数不合法时抛出 ValueError，错误信息带步骤路径
+    循环中至少要有一个操作步骤
+    """
+    timeline = []
+    processed = 0
+
+    def has_op(block):
+        return isinstance(block, list) and any(
+            isinstance(step, dict) and ("op" in step or ("loop" in step and step["loop"] and has_op(step.get("steps"))))
+            for step in block)
+
+    def number(step, key, path, integer=False):
+        value = step[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (integer and not isinstance(value, int)):
+            raise ValueError(f"{path}.{key}: 应为{'整数' if integer else '数字'}")
+        if value < 0:
+            raise ValueError(f"{path}.{key}: 不能为负数")
+        return value
+
+    def expand(block, start, prefix, emit=True):
+        """emit 为 False 时只检查步骤，不生成时间表（用于 loop 为 0 的循环体）"""
+        nonlocal processed
+        if not isinstance(block, list):
+            raise ValueError(f"{prefix or 'steps'}: 应为步骤数组")
+        cursor = start
+        for i, step in enumerate(block):
+            path = f"{prefix}[{i}]" if prefix else f"steps[{i}]"
+            if not isinstance(step, dict):
+                raise ValueError(f"{path}: 步骤应为对象")
+            processed += 1
+            if processed > max_expansion:
+                raise ValueError(f"展开循环后超过 {max_expansion} 个步骤")
+            kinds = [key for key in ("op", "wait", "loop") if key in step]
+            if len(kinds) != 1:
+                raise ValueError(f"{path}: 每一步只能是 op、wait、loop 之一")
+            if "wait" in step:
+                cursor += number(step, "wait", path)
+            elif "loop" in step:
+                count = number(step, "loop", path, integer=True)
+                if not has_op(step.get("steps")):
+                    raise ValueError(f"{path}.steps: 循环中至少需要一个操作步骤")
+                if count == 0 or not emit:
+                    expand(step["steps"], cursor, f"{path}.steps", emit=False)
+                    continue
+                for _ in range(count):
+                    cursor = expand(step["steps"], cursor, f"{path}.steps")
+            else:
+                if "at" in step:
+                    at = start + number(step, "at", path)
+                    if at < cursor:
+                        raise ValueError(f"{path}.at: 早于前面步骤的时刻")
+                    cursor = at
+                parsed, error = validate(step["op"], step.get("args", {}))
+                if error is not None:
+                    raise ValueError(f"{path} ({step['op']}): {error}")
+                if not emit:
+                    continue
+                if len(timeline) >= max_steps:
+                    raise ValueError(f"展开循环后超过 {max_steps} 个操作步骤")
+                timeline.append((cursor, step["op"], parsed, path))
+        return cursor
+
+    try:
+        duration = expand(steps, 0.0, "")
+    except RecursionError:
+        raise ValueError("循环嵌套层数过多") from None
+    return timeline, duration
+
+
+async def sleep_until(deadline):
+    """等到 time.monotonic() 达到 deadline：先 asyncio.sleep 到截止前 SPIN_TIME，剩下的时间让出事件循环忙等"""
+    remaining = deadline - time.monotonic()
+    if remaining > SPIN_TIME:
+        await asyncio.sleep(remaining - SPIN_TIME)
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+class SequenceRun:
+    """
+    一次序列执行，执行过程中可以随时用 report() 查看进度
+    timeline / duration: compile_steps() 的结果
+    stop_on_error: 某一步失败后跳过剩下的步骤
+    """
+
+    def __init__(self, timeline, duration, name=None, stop_on_error=True):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.timeline = timeline
+        self.duration = duration
+        self.stop_on_error = stop_on_error
+        self.status = "pending"  # pending / running / completed / failed / cancelled
+        self.created_at = time.time()
+        self.start_time = None  # time.monotonic()
+        self.end_time = None
+        self.records = []
+        self.failed = 0
+        self.error = None
+        self.task = None  # 服务器上执行这个序列的 asyncio.Task
+
+    def done(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    async def run_async(self, execute):
+        """
+        execute(操作名, 解析后的参数) 为协程函数，返回 (结果, 指令发送到串口的 time.monotonic() 时刻或 None)
+        任务被取消时剩下的步骤不再执行
+        """
+        self.status = "running"
+        self.start_time = time.monotonic()
+        try:
+            for offset, op, parsed, path in self.timeline:
+                scheduled = self.start_time + offset
+                await sleep_until(scheduled)
+                called = time.monotonic()
+                try:
+                    result, sent = await execute(op, parsed)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    result, sent = {"code": -1, "msg": f"{type(e).__name__}: {e}"}, None
+                if result is None:
+                    result = {"code": -1, "msg": "No response from device"}
+                finished = time.monotonic()
+                # 没有发送指令（例如幂等模式下值没变）时按调用时刻计算延迟
+                actual = sent if sent is not None else called
+                self.records.append(dict(result, index=len(self.records), op=op, path=path,
+                                         scheduled_ms=_ms(offset), called_ms=_ms(called - self.start_time),
+                                         sent_ms=_ms(sent - self.start_time) if sent is not None else None,
+                                         finished_ms=_ms(finished - self.start_time),
+                                         late_ms=_ms(actual - scheduled)))
+                if result.get("code") == -1:
+                    self.failed += 1
+                    if self.stop_on_error:
+                        self.status = "failed"
+                        break
+            else:
+                self.status = "failed" if self.failed else "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.end_time = time.monotonic()
+        return self.report()
+
+    def report(self, steps=True):
+        """执行状态、延迟统计（毫秒），steps 为 True 时带上每一步的记录"""
+        elapsed = None
+        if self.start_time is not None:
+            elapsed = (self.end_time or time.monotonic()) - self.start_time
+        late = [record["late_ms"] for record in self.records]
+        report = {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "steps_total": len(self.timeline),
+            "steps_done": len(self.records),
+            "failed": self.failed,
+            "error": self.error,
+            "duration_ms": _ms(self.duration),
+            "elapsed_ms": _ms(elapsed),
+            "late_ms": summary(late, ndigits=3),
+        }
+        if steps:
+            report["steps"] = self.records
+        return report
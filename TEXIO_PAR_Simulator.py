@@ -0,0 +1,314 @@
+"""
+PAR20-4H 软件模拟器
+
+在 Linux 上打开一个伪终端(pty)，按照与 DeviceController 相同的 ENQ/ETX/校验和协议应答，
+用来在没有实物电源的情况下测试和压测驱动程序。
+
+用法：
+    python TEXIO_PAR_Simulator.py
+    # 输出类似 "模拟器串口: /dev/pts/3"，然后把驱动程序的串口号指向它即可，例如：
+    PAR_PORT=/dev/pts/3 python TEXIO_PAR_WebAPI_Server.py
+"""
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+import TEXIO_PAR_Codec as codec
+from TEXIO_PAR_Codec import ENQ, ETX, ACK, NAK, MEMORY_OBJECTS as PRESETS, calculate_checksum, encode_frame
+
+BAUDRATE = 9600
+BITS_PER_CHAR = 10  # 7E1：1起始位 + 7数据位 + 1偶校验位 + 1停止位
+CHAR_TIME = BITS_PER_CHAR / BAUDRATE  # 每个字符在线路上的传输时间（秒）
+
+# 设置指令中的存储区代码 -> 存储区，与 DeviceController.set_voltage / set_current 一致
+VOLTAGE_CODES = {code: name for name, code in codec.VOLTAGE_CODES.items()}
+CURRENT_CODES = {code: name for name, code in codec.CURRENT_CODES.items()}
+CURRENT_UA_CODES = {code: name for name, code in codec.CURRENT_UA_CODES.items()}
+
+MAX_VOLTAGE = 20.0
+MAX_CURRENT = 4.0
+MAX_CURRENT_UA = 1.0
+
+
+class SimulatedUnit:
+    """总线上的一台模拟电源，保存设备状态并执行指令"""
+
+    def __init__(self, address="01", load_ohms=100.0, ovp=21.5, slew_rate=0.0):
+        """
+        address: 响应帧中的2字符设备地址
+        load_ohms: 输出端挂的纯电阻负载，用来计算输出电流和CC状态
+        slew_rate: 输出电压变化的速度（V/s），0 表示设定后立刻到位；用来测试扫描时的稳定判断
+        """
+        self.address = address
+        self.load_ohms = load_ohms
+        self.ovp = ovp
+        self.slew_rate = slew_rate
+        self._output_voltage = 0.0  # 设置了 slew_rate 时输出端实际的电压
+        self._output_time = None
+
+        # 设备状态
+        self.voltage = {name: 0.0 for name in PRESETS}
+        self.current = {name: 0.0 for name in PRESETS}
+        self.current_ua = {name: 0.0 for name in PRESETS}
+        self.preset = "workspace"
+        self.output_on = False
+        self.protection_on = False
+        self.ua_accuracy = False
+        self.panel_locked = True
+        self.display = 1  # MS2 的 OVP/电压电流显示 字段
+        self.tracking = 0
+        self.command_count = 0
+
+    def execute(self, command):
+        """执行一条去掉单元字符后的指令，返回 (是否接受, 响应帧正文或None)"""
+        self.command_count += 1
+        if command.startswith("V"):
+            value = float(command[2:])
+            if command[1] not in VOLTAGE_CODES or not 0 <= value <= MAX_VOLTAGE:
+                return False, None
+            self.voltage[VOLTAGE_CODES[command[1]]] = round(value, 3)
+        elif command.startswith("A"):
+            value = float(command[2:])
+            if command[1] in CURRENT_CODES and 0 <= value <= MAX_CURRENT:
+                self.current[CURRENT_CODES[command[1]]] = round(value, 3)
+            elif command[1] in CURRENT_UA_CODES and 0 <= value <= MAX_CURRENT_UA:
+                self.current_ua[CURRENT_UA_CODES[command[1]]] = round(value, 4)
+            else:
+                return False, None
+        elif command in ("PR0", "PR1", "PR2", "PR3"):
+            self.preset = PRESETS[int(command[2])]
+        elif command in ("SW0", "SW1"):
+            self.output_on = command == "SW1"
+        elif command in ("PT0", "PT1"):
+            self.protection_on = command == "PT1"
+        elif command in ("RA0", "RA1"):
+            self.ua_accuracy = command == "RA1"
+        elif command in ("LC0", "LC1"):
+            self.panel_locked = command == "LC0"
+        elif command == "ST2":
+            return True, self.system_status()
+        elif command == "ST4":
+            return True, self.output_status()
+        elif command == "ST5":
+            return True, self.memory_preset()
+        else:
+            return False, None
+        return True, None
+
+    def measure(self):
+        """根据当前输出设定和电阻负载计算 (电压, 电流, 是否CC)"""
+        if not self.output_on:
+            self._output_voltage, self._output_time = 0.0, None
+            return 0.0, 0.0, False
+        voltage = self.voltage[self.preset]
+        if self.slew_rate > 0:
+            now = time.monotonic()
+            step = self.slew_rate * (now - self._output_time) if self._output_time is not None else 0.0
+            self._output_voltage += max(-step, min(step, voltage - self._output_voltage))
+            self._output_time = now
+            voltage = self._output_voltage
+        limit = self.current_ua[self.preset] if self.ua_accuracy else self.current[self.preset]
+        current = voltage / self.load_ohms if self.load_ohms > 0 else float('inf')
+        if current > limit:
+            return limit * self.load_ohms, limit, True
+        return voltage, current, False
+
+    def system_status(self):
+        return (f"@MS2,{self.address},{self.display},{int(self.output_on)},{int(self.protection_on)},"
+                f"{self.tracking},{PRESETS.index(self.preset)},{int(self.ua_accuracy)}")
+
+    def output_status(self):
+        voltage, current, is_cc = self.measure()
+        current_format = ".4f" if self.ua_accuracy else ".3f"
+        return (f"@MS4,{self.address},{voltage:.3f},{current:{current_format}},{self.ovp:.3f},"
+                f"{1000 if is_cc else 0:04d}")
+
+    def memory_preset(self):
+        fields = [f"{self.voltage[name]:.3f},{self.current[name]:.3f},{self.current_ua[name]:.4f}" for name in PRESETS]
+        return f"@MS5,{self.address}," + ",".join(fields)
+
+
+class PARSimulator:
+    def __init__(self, units=None, echo=True, processing_delay=0.02, wire_delay=True, load_ohms=100.0,
+                 verbose=False, min_gap=0.0, noise=0.0, seed=None, slew_rate=0.0):
+        """
+        units: 总线上的电源，{单元字符: 2字符设备地址}，默认只有一台 {"A": "01"}；
+            单元字符是每条指令开头的字符，同时也是ACK/NAK后面跟随的字符
+        echo: 是否像实物一样把收到的指令回显出来
+        processing_delay: 设备处理一条指令的时间（秒）
+        wire_delay: 是否模拟9600波特7E1的线路传输时间
+        load_ohms: 输出端挂的纯电阻负载，用来计算输出电流和CC状态
+        min_gap: 设备能接受的最小指令间隔（秒），距离上一次应答不到这个时间就收到的指令返回 NAK，用来测试指令间隔控制
+        noise: 每条应答受到线路干扰的概率，受干扰时随机丢掉一个字节或翻转一个字节的最低位，用来测试校验和检查和重发
+        seed: 干扰的随机数种子，指定后每次运行受干扰的应答相同
+        slew_rate: 输出电压变化的速度（V/s），0 表示设定后立刻到位
+        """
+        self.units = {unit: SimulatedUnit(address, load_ohms=load_ohms, slew_rate=slew_rate)
+                      for unit, address in (units or {"A": "01"}).items()}
+        self.echo = echo
+        self.processing_delay = processing_delay
+        self.wire_delay = wire_delay
+        self.verbose = verbose
+        self.min_gap = min_gap
+        self.nak_count = 0
+        self.noise = noise
+        self.corrupted_count = 0
+        self._random = random.Random(seed)
+        self._last_reply_time = {}  # 单元字符 -> 上一次应答完成的时刻
+
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self._running = False
+        self._thread = None
+
+    @property
+    def unit(self):
+        """第一台模拟电源，只有一台时可以直接用它查看设备状态"""
+        return next(iter(self.units.values()))
+
+    @property
+    def command_count(self):
+        return sum(unit.command_count for unit in self.units.values())
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="PARSimulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        接收缓冲区 = bytearray()
+        while self._running:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                接收缓冲区 += os.read(self.master_fd, 1024)
+            except OSError:
+                continue
+
+            # 从缓冲区里取出所有完整的指令帧：ENQ 数据正文 ETX 2字符校验和
+            while True:
+                enq_index = 接收缓冲区.find(ENQ)
+                if enq_index == -1:
+                    接收缓冲区.clear()
+                    break
+                etx_index = 接收缓冲区.find(ETX, enq_index)
+                if etx_index == -1 or len(接收缓冲区) < etx_index + 3:
+                    del 接收缓冲区[:enq_index]
+                    break
+                frame = bytes(接收缓冲区[enq_index:etx_index + 3])
+                del 接收缓冲区[:etx_index + 3]
+                self._handle_frame(frame)
+
+    def _write(self, data):
+        if self.noise and self._random.random() < self.noise:
+            data = bytearray(data)
+            index = self._random.randrange(len(data))
+            if self._random.random() < 0.5:
+                del data[index]  # 丢失一个字节
+            else:
+                data[index] ^= 0x01  # 一位错误
+            self.corrupted_count += 1
+        # 以整块的方式在传输完成的时刻送出，模拟线路上的传输时间
+        if self.wire_delay:
+            time.sleep(len(data) * CHAR_TIME)
+        os.write(self.master_fd, data)
+
+    def _handle_frame(self, frame):
+        body = frame[1:-3]
+        checksum_ok = frame[-2:] == calculate_checksum(body)
+        if self.wire_delay:
+            # 指令本身在线路上的传输时间
+            time.sleep(len(frame) * CHAR_TIME)
+        received_time = time.monotonic()
+        if self.echo:
+            os.write(self.master_fd, frame)
+
+        command = body.decode('ascii', errors='replace')
+        unit = self.units.get(command[:1])
+        if unit is None:
+            # 总线上没有这个单元，没有设备应答
+            return
+        time.sleep(self.processing_delay)
+
+        reply = None
+        ok = checksum_ok
+        # 设备还没准备好接收下一条指令
+        if received_time - self._last_reply_time.get(command[:1], 0) < self.min_gap:
+            ok = False
+        if ok:
+            try:
+                ok, reply = unit.execute(command[1:])
+            except (ValueError, IndexError):
+                ok = False
+        if self.verbose:
+            print(f"{command} -> {'ACK' if ok else 'NAK'}")
+
+        if not ok:
+            self.nak_count += 1
+        response = bytes([ACK if ok else NAK]) + command[:1].encode('ascii')
+        if ok and reply is not None:
+            response += encode_frame(reply)
+        self._write(response)
+        self._last_reply_time[command[:1]] = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 软件模拟器（Linux 伪终端）")
+    parser.add_argument("--link", help="额外创建一个指向伪终端的符号链接，例如 /tmp/ttyPAR")
+    parser.add_argument("--units", default="A:01", help="总线上的电源，单元字符:设备地址，逗号分隔，例如 A:01,B:02")
+    parser.add_argument("--no-echo", action="store_true", help="不回显收到的指令")
+    parser.add_argument("--processing-delay", type=float, default=0.02, help="设备处理延时（秒）")
+    parser.add_argument("--no-wire-delay", action="store_true", help="不模拟9600波特的线路传输时间")
+    parser.add_argument("--load-ohms", type=float, default=100.0, help="输出端电阻负载（欧姆）")
+    parser.add_argument("--min-gap", type=float, default=0.0, help="设备能接受的最小指令间隔（秒），间隔不够时返回 NAK")
+    parser.add_argument("--noise", type=float, default=0.0, help="每条应答受到线路干扰（丢字节/错一位）的概率")
+    parser.add_argument("--slew", type=float, default=0.0, help="输出电压变化的速度（V/s），0 表示设定后立刻到位")
+    parser.add_argument("-v", "--verbose", action="store_true", help="打印收到的每条指令")
+    args = parser.parse_args()
+
+    units = dict(item.split(":") for item in args.units.split(","))
+    simulator = PARSimulator(units=units, echo=not args.no_echo, processing_delay=args.processing_delay,
+                             wire_delay=not args.no_wire_delay, load_ohms=args.load_ohms,
+                             verbose=args.verbose, min_gap=args.min_gap, noise=args.noise,
+                             slew_rate=args.slew)
+    if args.link:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(simulator.port, args.link)
+    print(f"模拟器串口: {simulator.port}")
+    simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+
+if __name__ == "__main__":
+    main()
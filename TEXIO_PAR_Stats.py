@@ -0,0 +1,31 @@
+"""
+PAR20-4H 延时统计
+
+基准测试、命令交互器、波形回放、序列、扫描和抓包回放的报告共用这里的百分位数和 平均/p95/最大 汇总，
+保证各处报告的 p95 按同一种方法计算、可以直接对比
+"""
+
+
+def percentile(sorted_values, p):
+    """线性插值的百分位数，sorted_values 需已排序，p 为 0~100；没有数据时返回 None"""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(sorted_values) - 1)
+    return sorted_values[f] + (sorted_values[c] - sorted_values[f]) * (k - f)
+
+
+def summary(values, scale=1.0, ndigits=None):
+    """
+    返回 {"mean", "p95", "max"}，每个值都乘以 scale（例如秒换算成毫秒用 1000），ndigits 不为 None 时四舍五入
+    没有数据时三项都是 None
+    """
+    values = sorted(values)
+    if not values:
+        return {"mean": None, "p95": None, "max": None}
+    result = {"mean": sum(values) / len(values) * scale, "p95": percentile(values, 95) * scale,
+              "max": values[-1] * scale}
+    if ndigits is not None:
+        result = {name: round(value, ndigits) for name, value in result.items()}
+    return result
@@ -0,0 +1,302 @@
+"""
+PAR20-4H 伏安特性扫描
+
+依次把输出电压设到每个设定点，每个点设好后连续用 AST4 读取输出，最近 window 次读数的电压、电流变化都不超过容差
+（CC 状态也不变）时认为已经稳定，记下最后一次读数马上进入下一个点，不用每个点都固定等待一段时间。
+超过 settle_timeout 还没稳定的点记下最后一次读数并标记为未稳定。设定点写入工作区，扫描前先切换到工作区（PR0），
+否则记忆1～3 生效时输出不跟随设定点。可以先用 set_current 设置限流值，
+负载电流达到限流值的点读数里 cc 为 True，用来测量负载的伏安曲线和恒流转折点。
+
+结果按列保存（setpoint / voltage / current / cc / settle_ms / readings / settled 各一个数组），
+settle_ms 为设定值指令完成到稳定窗口第一次读数的时间，即输出稳定下来用了多久。
+
+同步控制器（呼吸灯DEMO）使用 Sweep.run()，Web API 服务器使用 Sweep.run_async()。
+
+用法：
+    python TEXIO_PAR_Sweep.py --port COM47 --start 0 --stop 5 --step 0.5 --current-limit 0.1 --output
+    python TEXIO_PAR_Sweep.py --port COM47 --points 1 2 3.3 5 --csv iv.csv
+"""
+import argparse
+import asyncio
+import csv
+import json
+import math
+import sys
+import time
+
+from TEXIO_PAR_Stats import summary
+
+MAX_POINTS = 10000  # 单次扫描最多的设定点数，防止参数写错时占满内存
+COLUMNS = ("setpoint", "voltage", "current", "cc", "settle_ms", "readings", "settled")
+
+
+def sweep_points(start, stop, step):
+    """从 start 到 stop（包含 stop）每隔 step 伏一个设定点，step 的正负号不影响方向"""
+    if step == 0:
+        raise ValueError("step 不能为0")
+    step = abs(step) if stop >= start else -abs(step)
+    count = int(math.floor(abs(stop - start) / abs(step) + 1e-9)) + 1
+    if count > MAX_POINTS:
+        raise ValueError(f"设定点数超过 {MAX_POINTS}")
+    points = [round(start + i * step, 3) for i in range(count)]
+    if points[-1] != round(stop, 3):
+        points.append(round(stop, 3))
+    return points
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def _reading(response):
+    """AST4 查询结果 -> (电压, 电流, 是否CC)，查询失败时返回 None；同步控制器的结果没有 data 这一层"""
+    if not isinstance(response, dict) or response.get("code") != 0:
+        return None
+    data = response.get("data", response)
+    return data["voltage"], data["current"], bool(data["is_CC"])
+
+
+class Sweep:
+    """
+    一次伏安特性扫描，扫描过程中可以随时用 report() 查看进度
+    points: 电压设定点（V）
+    current_limit: 扫描前用 set_current 设置的限流值（A），None 表示不改动
+    tolerance_v / tolerance_a: 最近 window 次读数的电压/电流最大值与最小值之差不超过这个值时认为已经稳定
+    window: 判断稳定需要的连续读数个数（至少2）
+    settle_timeout: 每个点最多等待的时间（秒）
+    output: 扫描前打开输出，结束后关闭
+    """
+
+    def __init__(self, points, current_limit=None, tolerance_v=0.01, tolerance_a=0.001, window=3,
+                 settle_timeout=2.0, output=False):
+        points = [float(point) for point in points]
+        if not points:
+            raise ValueError("至少需要一个设定点")
+        if len(points) > MAX_POINTS:
+            raise ValueError(f"设定点数超过 {MAX_POINTS}")
+        if any(point < 0 for point in points):
+            raise ValueError("设定点不能为负数")
+        if current_limit is not None and current_limit < 0:
+            raise ValueError("current_limit 不能为负数")
+        if tolerance_v < 0 or tolerance_a < 0:
+            raise ValueError("容差不能为负数")
+        if window < 2:
+            raise ValueError("window 至少为2")
+        if settle_timeout <= 0:
+            raise ValueError("settle_timeout 必须大于0")
+        self.points = points
+        self.current_limit = current_limit
+        self.tolerance_v = tolerance_v
+        self.tolerance_a = tolerance_a
+        self.window = window
+        self.settle_timeout = settle_timeout
+        self.output = output
+        self.status = "pending"  # pending / running / completed / failed / cancelled
+        self.start_time = None  # time.monotonic()
+        self.end_time = None
+        self.table = {name: [] for name in COLUMNS}
+        self.read_errors = 0  # 查询失败的 AST4 次数
+        self.error = None
+        self._point = None  # 正在测量的点：(设定点, 设定完成的时刻, 最近的读数 [(时刻, 电压, 电流, 是否CC)], 读数次数)
+
+    def done(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    def _start(self):
+        self.status = "running"
+        self.start_time = time.monotonic()
+
+    def _check_setup(self, result, what):
+        if isinstance(result, dict) and result.get("code") == -1:
+            raise RuntimeError(f"{what}: {result.get('msg')}")
+
+    def _begin(self, setpoint, result):
+        """设定值指令完成后开始测量这个点"""
+        self._check_setup(result, f"设定 {setpoint} V 失败")
+        self._point = (setpoint, time.monotonic(), [], 0)
+
+    def _add(self, response):
+        """加入一次 AST4 读数，这个点已经稳定或超时时记录结果并返回 True"""
+        setpoint, set_time, recent, count = self._point
+        now = time.monotonic()
+        reading = _reading(response)
+        if reading is None:
+            self.read_errors += 1
+        else:
+            count += 1
+            recent = (recent + [(now,) + reading])[-self.window:]
+            self._point = (setpoint, set_time, recent, count)
+        settled = len(recent) == self.window and self._stable(recent)
+        if not settled and now - set_time < self.settle_timeout:
+            return False
+        last = recent[-1] if recent else (None, None, None, None)
+        for name, value in zip(COLUMNS, (setpoint, last[1], last[2], last[3],
+                                         _ms(recent[0][0] - set_time) if settled else None, count, settled)):
+            self.table[name].append(value)
+        self._point = None
+        return True
+
+    def _stable(self, recent):
+        voltages = [reading[1] for reading in recent]
+        currents = [reading[2] for reading in recent]
+        return (max(voltages) - min(voltages) <= self.tolerance_v and max(currents) - min(currents) <= self.tolerance_a
+                and len({reading[3] for reading in recent}) == 1)
+
+    def _output_off(self, result):
+        """扫描结束后关闭输出的结果；失败时只打印和记录，不掩盖扫描本身的异常"""
+        if isinstance(result, dict) and result.get("code") == -1:
+            print(f"扫描结束后关闭输出失败: {result.get('msg')}")
+            self.error = self.error or f"关闭输出失败: {result.get('msg')}"
+
+    def _finish(self, status):
+        self.status = status
+        self.end_time = time.monotonic()
+
+    def run(self, controller):
+        """同步扫描，controller 为呼吸灯DEMO 的 DeviceController"""
+        self._start()
+        try:
+            self._check_setup(controller.select_output("workspace"), "切换到工作区失败")
+            if self.current_limit is not None:
+                self._check_setup(controller.set_current(self.current_limit), "设置限流值失败")
+            if self.output:
+                self._check_setup(controller.control_output(True), "打开输出失败")
+            for setpoint in self.points:
+                self._begin(setpoint, controller.set_voltage(setpoint))
+                while not self._add(controller.getOutputStatus()):
+                    pass
+            self._finish("completed")
+        except KeyboardInterrupt:
+            self._finish("cancelled")
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self._finish("failed")
+            raise
+        finally:
+            if self.output:
+                try:
+                    self._output_off(controller.control_output(False))
+                except Exception as e:
+                    self._output_off({"code": -1, "msg": f"{type(e).__name__}: {e}"})
+        return self.report()
+
+    async def run_async(self, controller):
+        """异步扫描，controller 为 Web API 服务器的 DeviceController；任务被取消时提前结束"""
+        self._start()
+        try:
+            self._check_setup(await controller.select_output("workspace"), "切换到工作区失败")
+            if self.current_limit is not None:
+                self._check_setup(await controller.set_current(self.current_limit), "设置限流值失败")
+            if self.output:
+                self._check_setup(await controller.control_output(True), "打开输出失败")
+            for setpoint in self.points:
+                self._begin(setpoint, await controller.set_voltage(setpoint))
+                while not self._add(await controller.getOutputStatus()):
+                    pass
+            self._finish("completed")
+        except asyncio.CancelledError:
+            self._finish("cancelled")
+            raise
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self._finish("failed")
+            raise
+        finally:
+            if self.output:
+                try:
+                    self._output_off(await controller.control_output(False))
+                except Exception as e:
+                    self._output_off({"code": -1, "msg": f"{type(e).__name__}: {e}"})
+        return self.report()
+
+    def report(self):
+        """扫描状态、按列保存的结果表和稳定时间统计（毫秒）"""
+        elapsed = None
+        if self.start_time is not None:
+            elapsed = (self.end_time or time.monotonic()) - self.start_time
+        settle = [value for value in self.table["settle_ms"] if value is not None]
+        done = len(self.table["setpoint"])
+        return {
+            "status": self.status,
+            "points_total": len(self.points),
+            "points_done": done,
+            "unsettled": done - len(settle),
+            "read_errors": self.read_errors,
+            "current_limit": self.current_limit,
+            "error": self.error,
+            "elapsed_ms": _ms(elapsed),
+            "settle_ms": summary(settle, ndigits=3),
+            "table": self.table,
+        }
+
+
+def print_report(report):
+    table = report["table"]
+    print(f"{'设定(V)':>8} {'电压(V)':>8} {'电流(A)':>8}  CC  {'稳定(ms)':>9}  读数")
+    for setpoint, voltage, current, cc, settle_ms, readings, settled in zip(*(table[name] for name in COLUMNS)):
+        voltage = f"{voltage:8.3f}" if voltage is not None else f"{'-':>8}"
+        current = f"{current:8.4f}" if current is not None else f"{'-':>8}"
+        settle_ms = f"{settle_ms:9.1f}" if settled else f"{'未稳定':>6}"
+        print(f"{setpoint:8.3f} {voltage} {current}  {'CC' if cc else '  '}  {settle_ms}  {readings}")
+    stats = report["settle_ms"]
+    print(f"\n{report['status']}：{report['points_done']}/{report['points_total']} 个点，"
+          f"未稳定 {report['unsettled']} 个，耗时 {(report['elapsed_ms'] or 0) / 1000:.2f} 秒")
+    if stats["mean"] is not None:
+        print(f"稳定时间 平均 {stats['mean']:.1f} ms，p95 {stats['p95']:.1f} ms，最大 {stats['max']:.1f} ms")
+    if report["error"]:
+        print(f"错误: {report['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 伏安特性扫描（同步控制器）")
+    parser.add_argument("--port", default="COM47", help="串口号")
+    parser.add_argument("--start", type=float, help="起始电压（V）")
+    parser.add_argument("--stop", type=float, help="结束电压（V），包含在扫描中")
+    parser.add_argument("--step", type=float, help="电压步长（V）")
+    parser.add_argument("--points", type=float, nargs="+", help="直接指定设定点（V），代替 --start/--stop/--step")
+    parser.add_argument("--current-limit", type=float, help="扫描前设置的限流值（A）")
+    parser.add_argument("--tolerance-v", type=float, default=0.01, help="判断稳定的电压容差（V）")
+    parser.add_argument("--tolerance-a", type=float, default=0.001, help="判断稳定的电流容差（A）")
+    parser.add_argument("--window", type=int, default=3, help="判断稳定需要的连续读数个数")
+    parser.add_argument("--settle-timeout", type=float, default=2.0, help="每个点最多等待的时间（秒）")
+    parser.add_argument("--output", action="store_true", help="扫描前打开输出，结束后关闭")
+    parser.add_argument("--csv", help="把结果表保存为 CSV 文件")
+    parser.add_argument("--json", help="把完整结果保存为 JSON 文件")
+    args = parser.parse_args()
+
+    if args.points:
+        points = args.points
+    elif None not in (args.start, args.stop, args.step):
+        points = sweep_points(args.start, args.stop, args.step)
+    else:
+        parser.error("需要指定 --points 或者 --start/--stop/--step")
+    try:
+        sweep = Sweep(points, args.current_limit, args.tolerance_v, args.tolerance_a, args.window,
+                      args.settle_timeout, args.output)
+    except ValueError as e:
+        parser.error(str(e))
+
+    from TEXIO_PAR呼吸灯DEMO import DeviceController
+    controller = DeviceController(port=args.port)
+    try:
+        sweep.run(controller)
+    except RuntimeError:
+        pass  # 设备拒绝了某条设定指令，错误信息在 report 的 error 里，已经测量的点照常输出
+    finally:
+        controller.close()
+    report = sweep.report()
+    print_report(report)
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            writer.writerows(zip(*(report["table"][name] for name in COLUMNS)))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report["status"] == "failed":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+PAR20-4H 波形回放
+
+按固定采样率预先计算好设定值序列（正弦、斜坡、阶梯、任意数组或 CSV 文件），再按截止时间回放：
+第 i 个采样点应在 开始时间 + i/采样率 发送，指令耗时较长来不及发送的旧采样点直接丢弃，只发送最新到期的那个，
+所以总时长不会因为串口延时而越拖越长。与上一次发送的值相同的采样点不重复发送。
+回放结束后返回实际达到的采样率、发送/丢弃的点数和发送时刻相对截止时间的抖动。
+
+同步控制器（呼吸灯DEMO）使用 play()，Web API 服务器使用 Playback.run_async()。
+
+用法：
+    python TEXIO_PAR_Waveform.py --port COM47 sine --low 2.5 --high 3.3 --period 2.5 --duration 15 --rate 2
+    python TEXIO_PAR_Waveform.py --port COM47 csv wave.csv --rate 2 --target current
+"""
+import argparse
+import asyncio
+import csv
+import math
+import time
+from array import array
+from collections import deque
+
+from TEXIO_PAR_Stats import summary
+
+MAX_SAMPLES = 1000000  # 单个波形最多的采样点数，防止参数写错时占满内存
+
+
+class Waveform:
+    """预先计算好的设定值序列，samples[i] 在第 i/rate 秒输出"""
+
+    def __init__(self, samples, rate):
+        if rate <= 0:
+            raise ValueError("采样率必须大于0")
+        self.samples = array('d', samples)
+        if not self.samples:
+            raise ValueError("波形没有采样点")
+        if len(self.samples) > MAX_SAMPLES:
+            raise ValueError(f"采样点过多（{len(self.samples)}），最多 {MAX_SAMPLES} 个")
+        self.rate = float(rate)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.rate
+
+    @staticmethod
+    def _count(duration, rate):
+        count = int(round(duration * rate))
+        if count > MAX_SAMPLES:
+            raise ValueError(f"采样点过多（{count}），最多 {MAX_SAMPLES} 个")
+        return max(count, 1)
+
+    @classmethod
+    def sine(cls, low, high, period, duration, rate, phase=0.0):
+        """在 low 和 high 之间按 period 秒的周期变化，从 low 开始，与原来呼吸灯的 sin² 曲线相同"""
+        if period <= 0:
+            raise ValueError("周期必须大于0")
+        count = cls._count(duration, rate)
+        w = 2 * math.pi / (period * rate)
+        return cls((low + (high - low) * (1 - math.cos(w * i + phase)) / 2 for i in range(count)), rate)
+
+    @classmethod
+    def ramp(cls, start, stop, duration, rate):
+        """在 duration 秒内从 start 线性变化到 stop，最后一个采样点正好是 stop"""
+        count = cls._count(duration, rate)
+        if count == 1:
+            return cls([stop], rate)
+        step = (stop - start) / (count - 1)
+        return cls((start + step * i for i in range(count)), rate)
+
+    @classmethod
+    def step(cls, levels, dwell, rate):
+        """依次输出 levels 中的每个值，每个值保持 dwell 秒"""
+        count = cls._count(dwell, rate)
+        if len(levels) * count > MAX_SAMPLES:
+            raise ValueError(f"采样点过多（{len(levels) * count}），最多 {MAX_SAMPLES} 个")
+        samples = array('d')
+        for level in levels:
+            samples.extend(array('d', [level]) * count)
+        return cls(samples, rate)
+
+    @classmethod
+    def from_array(cls, samples, rate):
+        """直接使用给定的设定值序列"""
+        return cls(samples, rate)
+
+    @classmethod
+    def from_csv(cls, path, rate=None):
+        """
+        从 CSV 文件读取波形，无法解析为数字的行（例如表头）会被跳过
+        一列：每行一个设定值，必须指定 rate
+        两列：时间（秒）,设定值，按 rate 线性插值重新采样；不指定 rate 时使用文件中相邻时间间隔的中位数
+        """
+        times, values = [], []
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                try:
+                    numbers = [float(cell) for cell in row if cell.strip()]
+                except ValueError:
+                    continue
+                if len(numbers) == 1:
+                    values.append(numbers[0])
+                elif len(numbers) >= 2:
+                    times.append(numbers[0])
+                    values.append(numbers[1])
+        if not values:
+            raise ValueError(f"{path} 中没有设定值")
+        if not times:
+            if rate is None:
+                raise ValueError("只有设定值一列时必须指定采样率")
+            return cls(values, rate)
+        if len(times) != len(values):
+            raise ValueError(f"{path} 中有的行缺少时间")
+        if any(b <= a for a, b in zip(times, times[1:])):
+            raise ValueError(f"{path} 中的时间必须递增")
+        if rate is None:
+            if len(times) < 2:
+                raise ValueError("只有一个采样点时必须指定采样率")
+            intervals = sorted(b - a for a, b in zip(times, times[1:]))
+            rate = 1 / intervals[len(intervals) // 2]
+        return cls.resample(times, values, rate)
+
+    @classmethod
+    def resample(cls, times, values, rate):
+        """把 (时间, 设定值) 折线按 rate 重新采样，时间从第一个点算起"""
+        count = cls._count(times[-1] - times[0], rate) + 1
+        samples = array('d')
+        j = 0
+        for i in range(count):
+            t = times[0] + i / rate
+            while j < len(times) - 2 and times[j + 1] < t:
+                j += 1
+            t0, t1 = times[j], times[min(j + 1, len(times) - 1)]
+            v0, v1 = values[j], values[min(j + 1, len(values) - 1)]
+            if t1 == t0 or t >= t1:
+                samples.append(v1)
+            else:
+                samples.append(v0 + (v1 - v0) * (t - t0) / (t1 - t0))
+        return cls(samples, rate)
+
+    @classmethod
+    def from_spec(cls, shape, rate, **params):
+        """按名称创建波形，供 Web API 和命令行使用：sine / ramp / step / array / csv"""
+        factories = {"sine": cls.sine, "ramp": cls.ramp, "step": cls.step, "array": cls.from_array,
+                     "csv": cls.from_csv}
+        if shape not in factories:
+            raise ValueError(f"未知的波形: {shape}，可选 {', '.join(factories)}")
+        try:
+            return factories[shape](rate=rate, **params)
+        except TypeError as e:
+            raise ValueError(f"{shape} 波形的参数错误: {e}") from None
+
+
+class Playback:
+    """
+    按截止时间回放一个波形，回放过程中可以随时用 report() 查看进度
+    loops: 重复次数，0 表示一直重复直到被停止
+    """
+
+    def __init__(self, waveform, loops=1):
+        self.waveform = waveform
+        self.loops = loops
+        self.total = len(waveform) * loops if loops else None
+        self.start_time = None
+        self.end_time = None
+        self.next_index = 0
+        self.last_value = None
+        self.sent = 0  # 实际发送的指令数
+        self.unchanged = 0  # 与上一次相同而没有发送的采样点
+        self.dropped = 0  # 来不及发送被丢弃的采样点
+        self.failed = 0  # 设备返回 code -1 的指令数
+        self.error = None
+        self.finished = False
+        self._lateness = deque(maxlen=4096)  # 最近的发送时刻相对截止时间的延迟（秒），用于计算抖动
+        self._lateness_max = 0.0
+
+    def due(self, now):
+        """返回现在应该发送的设定值，还没到时间、与上次相同或回放已结束时返回 None"""
+        if self.start_time is None:
+            self.start_time = now
+        index = int((now - self.start_time) * self.waveform.rate)
+        if self.total is not None and index >= self.total:
+            self.finished = True
+            self.end_time = now
+            return None
+        if index < self.next_index:
+            return None
+        # 中间没来得及发送的旧采样点直接丢弃，只发送最新到期的这个
+        self.dropped += index - self.next_index
+        self.next_index = index + 1
+        lateness = now - (self.start_time + index / self.waveform.rate)
+        self._lateness.append(lateness)
+        self._lateness_max = max(self._lateness_max, lateness)
+        value = self.waveform.samples[index % len(self.waveform)]
+        if value == self.last_value:
+            self.unchanged += 1
+            return None
+        self.last_value = value
+        self.sent += 1
+        return value
+
+    def wait_time(self, now):
+        """距离下一个采样点的截止时间还有多少秒"""
+        return max(0.0, self.start_time + self.next_index / self.waveform.rate - now)
+
+    def _check(self, result):
+        if isinstance(result, dict) and result.get("code") == -1:
+            self.failed += 1
+
+    def run(self, setter, stop_event=None):
+        """同步回放，setter(设定值) 发送一个采样点；stop_event（threading.Event）被设置时提前结束"""
+        try:
+            while stop_event is None or not stop_event.is_set():
+                value = self.due(time.monotonic())
+                if self.finished:
+                    break
+                if value is not None:
+                    self._check(setter(value))
+                time.sleep(self.wait_time(time.monotonic()))
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.end_time = self.end_time or time.monotonic()
+        return self.report()
+
+    async def run_async(self, setter):
+        """异步回放，setter(设定值) 为协程函数；任务被取消时提前结束"""
+        try:
+            while True:
+                value = self.due(time.monotonic())
+                if self.finished:
+                    break
+                if value is not None:
+                    self._check(await setter(value))
+                await asyncio.sleep(self.wait_time(time.monotonic()))
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.end_time = self.end_time or time.monotonic()
+        return self.report()
+
+    def report(self):
+        """回放统计：实际达到的采样率、发送/丢弃的点数和发送抖动（毫秒）"""
+        elapsed = 0.0
+        if self.start_time is not None:
+            elapsed = (self.end_time or time.monotonic()) - self.start_time
+        played = self.sent + self.unchanged
+        jitter = summary(self._lateness, scale=1000)
+        if self._lateness:
+            # 只保留最近的延迟用于计算平均值和 p95，最大值按整次回放统计
+            jitter["max"] = self._lateness_max * 1000
+        return {
+            "running": self.start_time is not None and self.end_time is None,
+            "finished": self.finished,
+            "samples": self.total,
+            "played": played,
+            "sent": self.sent,
+            "unchanged": self.unchanged,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "error": self.error,
+            "elapsed_s": elapsed,
+            "target_rate": self.waveform.rate,
+            "achieved_rate": played / elapsed if elapsed > 0 else None,
+            "command_rate": self.sent / elapsed if elapsed > 0 else None,
+            "jitter_ms": jitter,
+        }
+
+
+def play(waveform, setter, loops=1, stop_event=None):
+    """同步回放波形，返回回放统计，例如 play(Waveform.sine(...), controller.set_voltage)"""
+    return Playback(waveform, loops).run(setter, stop_event)
+
+
+def print_report(report):
+    jitter = report["jitter_ms"]
+    print(f"回放 {report['played']} 个采样点，发送 {report['sent']} 条指令，丢弃 {report['dropped']} 个，"
+          f"耗时 {report['elapsed_s']:.2f} 秒")
+    if report["achieved_rate"] is not None:
+        print(f"采样率 目标 {report['target_rate']:.2f} /秒，实际 {report['achieved_rate']:.2f} /秒")
+    if jitter["mean"] is not None:
+        print(f"发送抖动 平均 {jitter['mean']:.1f} ms，p95 {jitter['p95']:.1f} ms，最大 {jitter['max']:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PAR20-4H 波形回放（同步控制器）")
+    parser.add_argument("--port", default="COM47", help="串口号")
+    parser.add_argument("--target", choices=["voltage", "current"], default="voltage", help="回放的设定值")
+    parser.add_argument("--rate", type=float, help="采样率（点/秒），csv 两列格式可以不指定")
+    parser.add_argument("--loops", type=int, default=1, help="重复次数，0 表示一直重复（Ctrl+C 停止）")
+    parser.add_argument("--output", action="store_true", help="回放前打开输出，结束后关闭")
+    shapes = parser.add_subparsers(dest="shape", required=True)
+    sine = shapes.add_parser("sine", help="正弦（sin²）")
+    sine.add_argument("--low", type=float, required=True)
+    sine.add_argument("--high", type=float, required=True)
+    sine.add_argument("--period", type=float, required=True)
+    sine.add_argument("--duration", type=float, required=True)
+    ramp = shapes.add_parser("ramp", help="斜坡")
+    ramp.add_argument("--start", type=float, required=True)
+    ramp.add_argument("--stop", type=float, required=True)
+    ramp.add_argument("--duration", type=float, required=True)
+    step = shapes.add_parser("step", help="阶梯")
+    step.add_argument("levels", type=float, nargs="+")
+    step.add_argument("--dwell", type=float, required=True)
+    from_csv = shapes.add_parser("csv", help="CSV 文件：一列设定值，或 时间,设定值 两列")
+    from_csv.add_argument("path")
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("port", "target", "rate", "loops", "output", "shape")}
+    if args.shape != "csv" and args.rate is None:
+        parser.error("需要指定 --rate")
+    waveform = Waveform.from_spec(args.shape, args.rate, **params)
+
+    from TEXIO_PAR呼吸灯DEMO import DeviceController
+    controller = DeviceController(port=args.port)
+    setter = controller.set_voltage if args.target == "voltage" else controller.set_current
+    try:
+        if args.output:
+            controller.control_output(True)
+        playback = Playback(waveform, args.loops)
+        try:
+            playback.run(setter)
+        except KeyboardInterrupt:
+            pass
+        print_report(playback.report())
+    finally:
+        if args.output:
+            controller.control_output(False)
+        controller.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,111 @@
+import os
 import serial
 import time
-import math
-from scanf import scanf
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional
 import asyncio  # 添加 asyncio 模块
+import contextvars
+import heapq
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import asynccontextmanager
+from TEXIO_PAR_Codec import (VOLTAGE_CODES, CURRENT_CODES, CURRENT_UA_CODES, PRESET_CODES, ACK, NAK,
+                             ProtocolError, acknowledgement, answered, calculate_checksum, encode_frame,
+                             response_complete, response_valid, foreign_response, parse_system_status, parse_output_status,
+                             parse_memory_preset)
+from TEXIO_PAR_Waveform import Waveform, Playback
+from TEXIO_PAR_Sweep import Sweep, sweep_points
+from TEXIO_PAR_Sequence import SequenceRun, compile_steps
+from TEXIO_PAR_Pacing import CommandPacer
+from TEXIO_PAR_History import TelemetryHistory
+from TEXIO_PAR_Energy import EnergyMeter
+from TEXIO_PAR_Capture import CaptureWriter
+from TEXIO_PAR_Metrics import MetricsRegistry
 
-app = FastAPI()
+# 运行指标，GET /metrics 以 Prometheus 文本格式输出
+# 指令耗时（串口线路+设备处理）、总线和设备锁的等待时间（客户端之间的争用）分开统计，可以看出慢在哪里
+metrics = MetricsRegistry()
+COMMAND_SECONDS = metrics.histogram("par_command_duration_seconds", "从发送指令到收到完整应答（或超时）的时间",
+                                    ("device", "command"))
+COMMANDS_TOTAL = metrics.counter("par_commands_total", "发送的指令数，outcome 为 ack/nak/timeout/corrupt/address",
+                                 ("device", "command", "outcome"))
+EMPTY_RESPONSES = metrics.counter("par_empty_responses_total", "一个字节都没有收到的指令数", ("device", "command"))
+PARSE_ERRORS = metrics.counter("par_parse_errors_total", "响应帧解析失败的次数，reason 见 PARSE_ERROR_REASONS",
+                               ("device", "command", "reason"))
+BYTES_SENT = metrics.counter("par_bytes_sent_total", "发送到串口的字节数", ("device",))
+BYTES_RECEIVED = metrics.counter("par_bytes_received_total", "从串口收到的字节数（含设备回显的指令）", ("device",))
+PACING_DELAY = metrics.counter("par_pacing_delay_seconds_total", "按指令间隔控制主动等待的总时间", ("device",))
+BUS_WAIT_SECONDS = metrics.histogram("par_bus_wait_seconds", "等待轮到使用串口总线的时间（同一串口上的其他设备）",
+                                     ("device",))
+LOCK_WAIT_SECONDS = metrics.histogram("par_lock_wait_seconds", "等待设备锁的时间（其他客户端的请求）", ("device",),
+                                      buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0))
+# 解析错误信息 -> reason 标签
+PARSE_ERROR_REASONS = {"未找到有效数据起始位置": "no_frame", "校验和错误": "checksum", "设备地址不匹配": "address",
+                       "响应数据格式错误": "format"}
+# 重发的原因，打印到控制台
+RETRY_REASONS = {"nak": "设备返回 NAK", "corrupt": "应答不完整或校验和错误", "timeout": "设备没有应答"}
+SAFETY_SECONDS = metrics.histogram("par_safety_command_seconds", "安全指令（关闭输出、开启保护）从调用到收到应答的时间",
+                                   ("device", "command"),
+                                   buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0))
+SLOT_WAIT_SECONDS = metrics.histogram("par_slot_wait_seconds", "等待串口收发时段的时间，priority 为 safety/normal/bulk",
+                                      ("device", "priority"),
+                                      buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0))
+POLLS_DROPPED = metrics.counter("par_polls_dropped_total", "设备忙而跳过的后台轮询次数", ("device", "query"))
+HTTP_IN_FLIGHT = metrics.gauge("par_http_requests_in_flight", "正在处理的 HTTP 请求数")
+metrics.gauge("par_lock_queue_depth", "正在等待设备锁的请求数", ("device",),
+              function=lambda: {(device_id, ): device.lock.waiting
+                                for device_id, device in registry.controllers.items()})
+metrics.gauge("par_bus_queue_depth", "正在等待使用串口总线的指令数", ("device",),
+              function=lambda: {(device_id, ): bus.queue_depth() for device_id, bus in registry.bus_owners().items()})
+metrics.gauge("par_energy_watt_hours", "上次清零以来的输出电能（Wh），由每次 AST4 的结果梯形积分得到", ("device",),
+              function=lambda: {(device_id, ): device.energy.energy_wh for device_id, device in registry.controllers.items()})
+metrics.gauge("par_charge_amp_hours", "上次清零以来的输出电量（Ah）", ("device",),
+              function=lambda: {(device_id, ): device.energy.charge_ah for device_id, device in registry.controllers.items()})
+metrics.gauge("par_mode_seconds", "上次清零以来处于恒流/恒压状态的时间，mode 为 cc/cv", ("device", "mode"),
+              function=lambda: {(device_id, mode): getattr(device.energy, mode + "_s")
+                                for device_id, device in registry.controllers.items() for mode in ("cc", "cv")})
+metrics.gauge("par_pending_setpoints", "合并模式下排队中的设定值数", ("device",),
+              function=lambda: {(device_id, ): len(device._pending_setpoints)
+                                for device_id, device in registry.controllers.items()})
+
+# 指令优先级，数值越小越先执行：安全指令插到队首，后台轮询排在最后
+PRIORITY_SAFETY, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_SAFETY: "safety", PRIORITY_NORMAL: "normal", PRIORITY_BULK: "bulk"}
+# 当前任务发出的指令的优先级；后台轮询任务设为 PRIORITY_BULK，安全指令在发送期间设为 PRIORITY_SAFETY
+COMMAND_PRIORITY = contextvars.ContextVar("COMMAND_PRIORITY", default=PRIORITY_NORMAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 服务启动时开启后台轮询（如果已配置），退出时停止
+    if os.environ.get('PAR_LAZY_CONNECT', '0') != '1':
+        # 启动时打开所有串口；打不开也照常启动，在后台重连，/api/health 可以看到状态
+        for device_id, bus in registry.bus_owners().items():
+            try:
+                await bus.ensure_connected()
+            except SerialUnavailable as e:
+                print(f"{device_id}: {e}，将在后台重连")
+    for device in registry.controllers.values():
+        device.telemetry.start()
+    if os.environ.get('PAR_CAPTURE', '0') == '1':
+        # 启动时就开始抓包，每个串口一个文件
+        for device_id, bus in registry.bus_owners().items():
+            bus.start_capture(capture_path(device_id))
+    yield
+    for device in registry.controllers.values():
+        await device.stop_waveform()
+        await device.stop_sequences()
+        await device.stop_sweep()
+        await device.telemetry.stop()
+    for bus in registry.bus_owners().values():
+        bus.stop_capture()
+        bus.stop_reconnect()
+
+app = FastAPI(lifespan=lifespan)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -18,35 +117,729 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 串口参数：默认为 PAR20-4H 的 9600 波特 7E1，可以用环境变量或配置文件中每台设备的 "serial" 覆盖
+SERIAL_DEFAULTS = {"baudrate": 9600, "bytesize": serial.SEVENBITS, "parity": serial.PARITY_EVEN,
+                   "stopbits": serial.STOPBITS_ONE}
+SERIAL_ENV = (("baudrate", "PAR_BAUDRATE", int), ("bytesize", "PAR_BYTESIZE", int), ("parity", "PAR_PARITY", str),
+              ("stopbits", "PAR_STOPBITS", float))
+
+def serial_settings(overrides=None):
+    settings = dict(SERIAL_DEFAULTS)
+    for key, name, cast in SERIAL_ENV:
+        if os.environ.get(name):
+            settings[key] = cast(os.environ[name])
+    settings.update(overrides or {})
+    return settings
+
+# 串口被拔出时 pyserial 可能抛出 SerialException（OSError 的子类），POSIX 上还可能直接抛出 termios.error
+try:
+    import termios
+    SERIAL_ERRORS = (OSError, termios.error)
+except ImportError:  # Windows
+    SERIAL_ERRORS = (OSError,)
+
+class SerialUnavailable(ConnectionError):
+    """串口没有打开（拔出、被占用或正在重连），接口返回 503"""
+
+    def __init__(self, port, error=None):
+        super().__init__(f"Serial port {port} unavailable" + (f": {error}" if error else ""))
+        self.port = port
+
+class SerialTransport:
+    """
+    串口的 asyncio 传输层
+    POSIX 上把串口的文件描述符注册到事件循环（add_reader），数据到达时在回调里收下，收到完整应答后唤醒等待的协程；
+    Windows 的 COM 口没有可供事件循环监听的文件描述符，改为在这个串口专用的工作线程里阻塞读取。
+    两种方式都不会阻塞事件循环，不同串口之间的指令也可以并行执行
+    """
+
+    def __init__(self, ser=None):
+        self.ser = ser
+        self.on_lost = None  # 检测到串口断开时调用 on_lost(异常)
+        self._executor = None  # 无法使用事件循环读取时，这个串口专用的工作线程
+        self._loop = None
+        self._fd = None
+        self._buffer = bytearray()
+        self._is_complete = None  # 当前指令的应答完整判断函数
+        self._future = None  # 当前指令等待应答的 future
+        self._drain = None  # 被取消的指令还没收完的应答：(future, 截止时刻 time.monotonic())
+        self.capture = None  # 正在进行的抓包（CaptureWriter），收发的原始数据都会写进去
+
+    def _attach(self):
+        """把串口注册到当前运行的事件循环，返回是否可以使用事件循环读取"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return self._fd is not None
+        self.detach()
+        self._loop = loop
+        try:
+            fd = self.ser.fileno()
+            loop.add_reader(fd, self._on_readable)
+            self._fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            self._fd = None
+        return self._fd is not None
+
+    def detach(self):
+        """从事件循环上注销串口"""
+        if self._loop is not None and self._fd is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._fd)
+        self._loop = None
+        self._fd = None
+
+    def reset(self, ser):
+        """换成重新打开的串口（断开时为 None），正在等待应答的指令会失败"""
+        self.detach()
+        if self._future is not None and not self._future.done():
+            self._future.set_exception(ConnectionError("串口已断开"))
+        self._future = None
+        self._drain = None
+        self.ser = ser
+
+    def close(self):
+        self.detach()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            data = b""
+            error = e
+        else:
+            error = None
+            if self.capture is not None:
+                self.capture.rx(data)
+        if not data:
+            # 串口被拔出/关闭，停止监听并让正在等待的指令失败
+            self.detach()
+            error = error or ConnectionError("串口已断开")
+            if self._future is not None and not self._future.done():
+                self._future.set_exception(error)
+            if self.on_lost is not None:
+                self.on_lost(error)
+            return
+        if self._future is None:
+            # 没有指令在等待应答，丢弃多余的数据
+            return
+        self._buffer += data
+        if not self._future.done() and self._is_complete(self._buffer):
+            self._future.set_result(None)
+
+    async def exchange(self, instruction, is_complete, timeout):
+        """
+        发送指令并等待应答，返回 (接收到的数据, 应答是否完整)
+        is_complete: 判断接收缓冲区中的应答是否已经完整的函数
+        """
+        if not self._attach():
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"serial-{self.ser.port}")
+            return await self._loop.run_in_executor(
+                self._executor, self._exchange_blocking, instruction, is_complete, timeout)
+
+        if self._drain is not None:
+            # 上一条指令等应答时被取消，设备的应答还在路上，先等它收完（最多等到它的超时时刻），
+            # 否则会把它的 ACK 当成这条指令的应答
+            future, deadline = self._drain
+            try:
+                await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - time.monotonic()))
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            self._drain = None
+            self._future = None
+
+        # 清空接收缓冲区
+        self.ser.reset_input_buffer()
+        self._buffer = bytearray()
+        self._is_complete = is_complete
+        self._future = self._loop.create_future()
+        if self.capture is not None:
+            self.capture.tx(instruction)
+        cancelled = False
+        try:
+            self.ser.write(instruction)
+            # shield：超时或被取消时 future 本身不取消，被取消后还可以继续接收这条指令的应答
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            完整 = True
+        except asyncio.TimeoutError:
+            完整 = False
+        except asyncio.CancelledError:
+            cancelled = True
+            self._drain = (self._future, time.monotonic() + timeout)
+            raise
+        finally:
+            if not cancelled:
+                self._future = None
+        return self._buffer, 完整
+
+    def _exchange_blocking(self, instruction, is_complete, timeout):
+        # 清空接收缓冲区
+        self.ser.reset_input_buffer()
+        capture = self.capture
+        if capture is not None:
+            capture.tx(instruction)
+        self.ser.write(instruction)
+        截止时间 = time.time() + timeout
+        接收缓冲区 = bytearray()
+        while not is_complete(接收缓冲区):
+            if time.time() >= 截止时间:
+                return 接收缓冲区, False
+            # 串口的 timeout 很短，read 在有数据时立刻返回，没有数据时阻塞等待而不是空转
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if data and capture is not None:
+                capture.rx(data)
+            接收缓冲区 += data
+        return 接收缓冲区, True
+
+class SerialBus:
+    """
+    一条串口总线，可以挂多台电源，用每条指令开头的单元字符区分
+    总线上同一时间只能有一条指令在传输；多台电源都有指令在排队时按单元轮流发送，
+    某一台电源的大量指令不会让其他电源等太久，每台电源的轮询频率也可以预期
+    串口在第一次使用时（或服务启动时）才打开；断开后在后台按指数退避重新打开，串口恢复后几秒内接口就能继续使用
+    """
+
+    def __init__(self, port, settings=None, reconnect_min=None, reconnect_max=None):
+        """
+        settings: 串口参数，覆盖 serial_settings() 的默认值，例如 {"baudrate": 9600, "parity": "E"}
+        reconnect_min / reconnect_max: 重新连接的最短/最长间隔（秒），
+            不指定时读取环境变量 PAR_RECONNECT_MIN（默认 0.2）/ PAR_RECONNECT_MAX（默认 5）
+        """
+        self.port = port
+        self.settings = serial_settings(settings)
+        if reconnect_min is None:
+            reconnect_min = float(os.environ.get('PAR_RECONNECT_MIN', 0.2))
+        if reconnect_max is None:
+            reconnect_max = float(os.environ.get('PAR_RECONNECT_MAX', 5))
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.ser = None
+        self.transport = SerialTransport()
+        self.transport.on_lost = self.connection_lost
+        self.state = "idle"  # idle 还没有打开过；connected 已连接；reconnecting 断开后正在重连；closed 已关闭
+        self.last_error = None
+        self.connected_since = None
+        self.disconnects = 0
+        self.reconnect_attempts = 0
+        self.on_connect = []  # 每次打开串口后调用的函数，例如清空影子状态（设备可能在断开期间重启过）
+        self._reconnect_task = None
+        self._next_attempt = None
+        self._waiters = {}  # 单元字符 -> 等待使用总线的 future 队列，按单元第一次出现的顺序轮转
+        self._urgent = deque()  # 安全指令的 future 队列，先于所有单元的普通指令
+        self._busy = False
+        self._last_unit = None
+
+    @asynccontextmanager
+    async def turn(self, unit, urgent=False):
+        """等待轮到 unit 使用总线，urgent 为 True（安全指令）时排在所有普通指令前面"""
+        if self._busy or self._urgent or any(self._waiters.values()):
+            future = asyncio.get_running_loop().create_future()
+            if urgent:
+                self._urgent.append(future)
+            else:
+                self._waiters.setdefault(unit, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # 已经轮到了但调用方被取消，把总线交给下一个
+                    self._release()
+                raise
+        else:
+            self._busy = True
+        self._last_unit = unit
+        try:
+            yield
+        finally:
+            self._release()
+
+    def queue_depth(self):
+        """正在排队等待使用总线的指令数"""
+        return sum(1 for queue in [self._urgent, *self._waiters.values()] for future in queue if not future.done())
+
+    def _release(self):
+        while self._urgent:
+            future = self._urgent.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        # 从上一次使用总线的单元的下一个开始，找到第一个有指令在排队的单元
+        units = list(self._waiters)
+        start = units.index(self._last_unit) + 1 if self._last_unit in units else 0
+        for k in range(len(units)):
+            queue = self._waiters[units[(start + k) % len(units)]]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self._busy = False
+
+    def connect(self):
+        """打开串口，失败时抛出 OSError（serial.SerialException）或 ValueError（串口参数错误）"""
+        if self.ser is not None:
+            return
+        ser = serial.Serial(port=self.port, timeout=0.05, **self.settings)  # 单次read的最长阻塞时间，整体超时由send_instruction控制
+        self.ser = ser
+        self.transport.reset(ser)
+        self.state = "connected"
+        self.connected_since = time.time()
+        self.last_error = None
+        for callback in self.on_connect:
+            callback()
+
+    async def ensure_connected(self):
+        """串口还没打开时立刻打开；正在后台重连时直接失败，不让请求等待"""
+        if self.ser is not None:
+            return
+        if self._reconnect_task is None and self.state != "closed":
+            try:
+                self.connect()
+                return
+            except SERIAL_ERRORS + (ValueError,) as e:
+                self.connection_lost(e)
+        raise SerialUnavailable(self.port, self.last_error)
+
+    def connection_lost(self, error):
+        """串口出错或断开：关闭串口，在后台开始重连"""
+        if self.state == "closed":
+            return
+        if self.ser is not None:
+            self.disconnects += 1
+            try:
+                self.ser.close()
+            except SERIAL_ERRORS:
+                pass
+            self.ser = None
+            print(f"串口 {self.port} 断开: {error}")
+        self.transport.reset(None)
+        self.state = "reconnecting"
+        self.last_error = str(error)
+        self.connected_since = None
+        if self._reconnect_task is None:
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.reconnect_min
+        try:
+            while True:
+                self._next_attempt = time.monotonic() + delay
+                await asyncio.sleep(delay)
+                self.reconnect_attempts += 1
+                try:
+                    self.connect()
+                except SERIAL_ERRORS + (ValueError,) as e:
+                    self.last_error = str(e)
+                    delay = min(self.reconnect_max, delay * 2)
+                    continue
+                print(f"串口 {self.port} 已重新连接")
+                return
+        finally:
+            self._reconnect_task = None
+            self._next_attempt = None
+
+    def stop_reconnect(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+    def health(self):
+        return {
+            "port": self.port,
+            "state": self.state,
+            "connected": self.ser is not None,
+            "connected_since": self.connected_since,
+            "last_error": self.last_error,
+            "disconnects": self.disconnects,
+            "reconnect_attempts": self.reconnect_attempts,
+            "next_retry_in": max(0.0, self._next_attempt - time.monotonic()) if self._next_attempt else None,
+        }
+
+    def start_capture(self, path):
+        """开始把这条总线上收发的原始数据写入抓包文件，之前的抓包会先结束"""
+        self.stop_capture()
+        self.transport.capture = CaptureWriter(path)
+        return self.transport.capture
+
+    def stop_capture(self):
+        """结束抓包，返回结束的 CaptureWriter，没有在抓包时返回 None"""
+        capture, self.transport.capture = self.transport.capture, None
+        if capture is not None:
+            capture.close()
+        return capture
+
+    def close(self):
+        self.state = "closed"
+        self.stop_reconnect()
+        self.stop_capture()
+        self.transport.close()
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+class PriorityLock:
+    """按优先级排队的异步锁（不可重入）：释放时交给优先级最高（数值最小）的等待者，同一优先级先到先得"""
+
+    def __init__(self):
+        self._locked = False
+        self._waiters = []  # 堆：(优先级, 到达序号, future)
+        self._arrivals = itertools.count()
+
+    def locked(self):
+        return self._locked
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if not self._locked:
+            self._locked = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经轮到了但调用方被取消，把锁交给下一个
+                self.release()
+            raise
+
+    def release(self):
+        # 锁直接交给下一个等待者，中间不会被新来的请求抢走
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._locked = False
+
+    @asynccontextmanager
+    async def hold(self, priority=PRIORITY_NORMAL):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+class DeviceLock:
+    """
+    设备的异步锁，可重入：持有锁的任务再次进入时直接通过
+    批量指令（/api/batch）在一次持有锁期间依次调用各个方法，中间不会插入其他客户端的指令
+    等待者按当前任务的 COMMAND_PRIORITY 排队，普通请求排在后台轮询前面
+    on_acquire: 拿到锁时调用 on_acquire(等待的秒数)，用来统计锁等待时间
+    """
+
+    def __init__(self, on_acquire=None):
+        self._lock = PriorityLock()
+        self._owner = None
+        self._depth = 0
+        self.on_acquire = on_acquire
+        self.waiting = 0  # 正在等待这把锁的任务数
+
+    def owned(self):
+        """当前任务是否已经持有这把锁"""
+        return self._owner is not None and self._owner is asyncio.current_task()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def busy(self):
+        """有请求持有锁或正在排队"""
+        return self._lock.locked() or self.waiting > 0
+
+    async def __aenter__(self):
+        if self.owned():
+            self._depth += 1
+            return self
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._lock.acquire(COMMAND_PRIORITY.get())
+        finally:
+            self.waiting -= 1
+        self._owner = asyncio.current_task()
+        self._depth = 1
+        if self.on_acquire is not None:
+            self.on_acquire(time.monotonic() - start)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+class TelemetrySubscription:
+    """
+    一个实时数据订阅者（例如一个 SSE 连接）的队列
+    队列长度有上限，客户端读得慢时丢弃最旧的数据，发布数据的一方永远不会因为某个客户端而阻塞
+    """
+
+    def __init__(self, cache, keys, maxlen):
+        self.cache = cache
+        self.keys = keys
+        self.queue = deque(maxlen=maxlen)
+        self.dropped = 0  # 因为客户端读得慢被丢弃的数据条数
+        self._event = asyncio.Event()
+
+    def push(self, item):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(item)
+        self._event.set()
+
+    async def get(self):
+        """取出最旧的一条数据，没有数据时等待，返回 (序号, key, 设备返回结果)"""
+        while not self.queue:
+            self._event.clear()
+            await self._event.wait()
+        return self.queue.popleft()
+
+    def close(self):
+        self.cache.unsubscribe(self)
+
+class TelemetryCache:
+    """
+    设备状态缓存
+    后台轮询 AST4、AST2（AST5 频率更低）保存最新的结果，GET 接口在 max_age 秒以内直接返回缓存；
+    缓存过期时，同时到来的多个请求共享同一次设备查询，而不是各自占用一次串口
+    每次从设备得到的新结果还会推送给所有订阅者（实时数据流），订阅者再多也只有这一份设备查询
+    """
+    QUERIES = {
+        "output_status": "getOutputStatus",  # AST4
+        "system_status": "getSystemStatus",  # AST2
+        "memory_preset": "getMemoryPreset",  # AST5
+    }
+
+    def __init__(self, controller, interval=0, slow_interval=5, max_age=None, stream_interval=0.5):
+        """
+        interval: AST4/AST2 的轮询间隔（秒），0 表示不开启后台轮询
+        slow_interval: AST5 的轮询间隔（秒）
+        max_age: 默认允许返回的缓存最大时长（秒），不指定时开启轮询为两倍轮询间隔，否则为0
+        stream_interval: 没有开启后台轮询时，有订阅者期间临时开启的轮询间隔（秒）
+        """
+        self.controller = controller
+        self.interval = interval
+        self.slow_interval = slow_interval
+        self.stream_interval = stream_interval
+        self.max_age = max_age if max_age is not None else interval * 2
+        self.snapshot = {}  # key -> (时间戳, 设备返回结果)
+        self._inflight = {}  # key -> (正在进行的设备查询, 它的优先级)
+        self._task = None
+        self._on_demand = False  # 当前的轮询是不是因为有订阅者才临时开启的
+        self._subscribers = set()
+        self._sequence = 0  # 推送给订阅者的数据序号，客户端可以据此发现丢掉的数据
+        self.dropped = 0  # 设备忙而跳过的后台轮询次数
+
+    async def get(self, key, max_age=None):
+        """获取状态，缓存足够新时直接返回，否则查询设备"""
+        max_age = self.max_age if max_age is None else max_age
+        entry = self.snapshot.get(key)
+        if entry is not None and time.time() - entry[0] <= max_age:
+            return dict(entry[1], timestamp=entry[0])
+        return await self.refresh(key)
+
+    async def refresh(self, key):
+        """
+        查询设备并更新缓存，同一时间对同一个 key 的请求共享一次设备查询
+        正在进行的是优先级更低的查询（后台轮询）时不共享，按调用方的优先级另外查询一次，普通请求不会排到后台轮询的位置上
+        """
+        priority = COMMAND_PRIORITY.get()
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[1] <= priority:
+            task = inflight[0]
+        else:
+            # 任务创建时复制当前的 COMMAND_PRIORITY，查询按调用方的优先级排队
+            task = asyncio.ensure_future(self._query(key))
+            self._inflight[key] = (task, priority)
+
+            def forget(done):
+                if self._inflight.get(key, (None,))[0] is done:
+                    del self._inflight[key]
+            task.add_done_callback(forget)
+        # shield：某个请求被取消时不影响其他共享这次查询的请求
+        return await asyncio.shield(task)
+
+    async def _query(self, key):
+        response = await getattr(self.controller, self.QUERIES[key])()
+        timestamp = time.time()
+        if response and response.get("code") == 0:
+            self.snapshot[key] = (timestamp, response)
+            self._publish(key, dict(response, timestamp=timestamp))
+        return dict(response, timestamp=timestamp) if response else response
+
+    def _publish(self, key, response):
+        self._sequence += 1
+        for subscriber in self._subscribers:
+            if key in subscriber.keys:
+                subscriber.push((self._sequence, key, response))
+
+    def subscribe(self, keys=("output_status", "system_status"), maxlen=16):
+        """
+        订阅实时数据，返回 TelemetrySubscription，用完之后调用它的 close()
+        没有开启后台轮询时，在有订阅者期间按 stream_interval 临时开启
+        """
+        subscriber = TelemetrySubscription(self, set(keys), maxlen)
+        # 先推送缓存中已有的最新结果，客户端连接后立刻就有数据
+        for key in keys:
+            entry = self.snapshot.get(key)
+            if entry is not None:
+                subscriber.push((self._sequence, key, dict(entry[1], timestamp=entry[0])))
+        self._subscribers.add(subscriber)
+        if self._task is None:
+            self._on_demand = True
+            self._task = asyncio.create_task(self._run(self.stream_interval))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and self._on_demand and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._on_demand = False
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(self.interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._on_demand = False
+
+    async def _poll(self, key, interval):
+        """
+        后台轮询一项状态：设备锁有人持有或排队时跳过这一次，返回是否查询了设备
+        缓存已经超过两个轮询间隔没有更新时不再跳过，改为按普通优先级排队，设备一直忙时轮询也不会完全停止
+        """
+        entry = self.snapshot.get(key)
+        stale = entry is None or time.time() - entry[0] > max(interval * 2, self.max_age)
+        if not stale and self.controller.lock.busy():
+            self.dropped += 1
+            POLLS_DROPPED.inc(device=self.controller.name, query=key)
+            return False
+        token = COMMAND_PRIORITY.set(PRIORITY_NORMAL if stale else PRIORITY_BULK)
+        try:
+            await self.refresh(key)
+        finally:
+            COMMAND_PRIORITY.reset(token)
+        return True
+
+    async def _run(self, interval):
+        last_slow_time = 0
+        while True:
+            try:
+                await self._poll("output_status", interval)
+                await self._poll("system_status", interval)
+                if time.time() - last_slow_time >= self.slow_interval:
+                    if await self._poll("memory_preset", self.slow_interval):
+                        last_slow_time = time.time()
+            except Exception as e:
+                print(f"后台轮询出错: {e}")
+            await asyncio.sleep(interval)
+
 class DeviceController:
-    def __init__(self, port):
+    ack_timeout = 0.5  # 设置类指令等待ACK的超时时间（秒）
+    response_timeout = 1.0  # 查询类指令等待响应帧的超时时间（秒）
+    # 影子状态中每类设定由哪个查询得到：电压/电流来自 AST5，这几项来自 AST2；LC（解锁面板）没有对应的状态，总是发送
+    SHADOW_SYSTEM_KEYS = ("PR", "SW", "PT", "RA")
+    # 幂等模式下也总是发送的指令：设备会因为 OVP 等保护自行关闭输出，影子状态中的 SW1 可能已经过时
+    ALWAYS_SEND = ("SW1",)
+
+    def __init__(self, port=None, coalesce=None, poll_interval=None, poll_slow_interval=None, cache_max_age=None,
+                 bus=None, unit="A", address="01", pacing=None, pacing_gap=None, history_size=None,
+                 history_path=None, idempotent=None, shadow_resync=None, echo=None, retries=None, serial_options=None):
         """
         初始化设备控制器
+        coalesce: 是否开启设定值合并模式，不指定时读取环境变量 PAR_COALESCE
+        poll_interval / poll_slow_interval / cache_max_age: 后台轮询和缓存的配置，见 TelemetryCache，
+            不指定时读取环境变量 PAR_POLL_INTERVAL / PAR_POLL_SLOW_INTERVAL / PAR_CACHE_MAX_AGE
+        bus: 多台电源共用一个串口时传入共享的 SerialBus，否则按 port 单独打开串口（第一次发送指令时才打开）
+        serial_options: 不传入 bus 时的串口参数，见 SerialBus
+        unit: 每条指令开头的单元字符，设备的 ACK/NAK 后面也会带上这个字符
+        address: 设备响应帧（@MS2/@MS4/@MS5）中的2字符设备地址
+        pacing: 指令间隔模式，adaptive 按指令类型自适应，fixed 固定间隔，见 CommandPacer；
+            不指定时读取环境变量 PAR_PACING（默认 adaptive）
+        pacing_gap: 固定模式的间隔（秒），不指定时读取环境变量 PAR_PACING_GAP（默认 0.5）
+        history_size / history_path: 输出状态历史记录的容量和保存文件，见 TelemetryHistory，
+            不指定时读取环境变量 PAR_HISTORY_SIZE（默认 100000）/ PAR_HISTORY_PATH（默认只保存在内存中）
+        idempotent: 幂等写入模式，影子状态显示设备已经是这个值时不发送设置类指令，不指定时读取环境变量 PAR_IDEMPOTENT
+        shadow_resync: 影子状态的有效时间（秒），过期后在下一次写入前重新查询设备（可以发现面板上的手动修改），
+            不指定时读取环境变量 PAR_SHADOW_RESYNC（默认 30）
+        echo: 是否在控制台打印每条指令的收发数据（HEX/ASCII）和查询结果，不指定时读取环境变量 PAR_ECHO（默认关闭）；
+            需要离线分析通信时使用抓包（SerialBus.start_capture）
+        retries: 收到 NAK、校验和错误或应答不完整时最多重发的次数，不指定时读取环境变量 PAR_RETRIES（默认 2）
         """
-        self.ser = serial.Serial(
-            port=port,
-            baudrate=9600,
-            bytesize=serial.SEVENBITS,
-            parity=serial.PARITY_EVEN,
-            stopbits=serial.STOPBITS_ONE,
-            timeout=0
-        )
-        if not self.ser.isOpen():
-            raise Exception(f"无法打开串口 {port}")
+        self.bus = bus if bus is not None else SerialBus(port, serial_options)
+        self._owns_bus = bus is None
+        self.bus.on_connect.append(self.invalidate_shadow)  # 设备可能在断开期间被改动或重启过
+        self.unit = unit
+        self.address = address
         
         self.last_send_time = 0  # 上次发送指令的时间
-        self.lock = asyncio.Lock()  # 添加异步锁
+        if pacing is None:
+            pacing = os.environ.get('PAR_PACING', 'adaptive')
+        if pacing_gap is None:
+            pacing_gap = float(os.environ.get('PAR_PACING_GAP', 0.5))
+        self.pacer = CommandPacer(pacing, fixed_gap=pacing_gap)
+        if history_size is None:
+            history_size = int(os.environ.get('PAR_HISTORY_SIZE', 100000))
+        if history_path is None:
+            history_path = os.environ.get('PAR_HISTORY_PATH') or None
+        self.history = TelemetryHistory(history_size, history_path)  # 每次 AST4 的结果都追加到这里
+        # 每次 AST4 的结果还参与电能/电量积分，相邻采样点间隔超过 PAR_ENERGY_MAX_GAP 秒时视为数据空白
+        self.energy = EnergyMeter(float(os.environ.get('PAR_ENERGY_MAX_GAP', 5)))
+        self.transport = self.bus.transport
+        self.name = "default"  # 指标中的 device 标签，加入 ControllerRegistry 时设为设备ID
+        self.lock = DeviceLock(on_acquire=lambda wait: LOCK_WAIT_SECONDS.observe(wait, device=self.name))  # 添加异步锁（可重入）
+        # 串口收发时段：每次收发（含重发的每一次）前按优先级排队，安全指令不经过设备锁，直接在这里插到队首
+        self._slot = PriorityLock()
         self.last_get_output_status_time = 0  # 添加记录上次调用get_output_status的时间
+        # 合并模式：同一目标还在排队的设定值只发送最新的一个
+        self.coalesce = os.environ.get('PAR_COALESCE', '0') == '1' if coalesce is None else coalesce
+        self._pending_setpoints = {}  # 指令前缀 -> (排队中的最新指令, 等待结果的future)
+        if poll_interval is None:
+            poll_interval = float(os.environ.get('PAR_POLL_INTERVAL', 0))
+        if poll_slow_interval is None:
+            poll_slow_interval = float(os.environ.get('PAR_POLL_SLOW_INTERVAL', 5))
+        if cache_max_age is None and 'PAR_CACHE_MAX_AGE' in os.environ:
+            cache_max_age = float(os.environ['PAR_CACHE_MAX_AGE'])
+        self.telemetry = TelemetryCache(self, interval=poll_interval, slow_interval=poll_slow_interval,
+                                        max_age=cache_max_age,
+                                        stream_interval=float(os.environ.get('PAR_STREAM_INTERVAL', 0.5)))
+        self.playback = None  # 最近一次的波形回放，见 TEXIO_PAR_Waveform
+        # 影子状态：设备当前的设定，指令前两个字母 -> (指令后面的值, 得到这个值的时刻)，例如 VA -> ("1.500", t)、SW -> ("1", t)
+        # 由 AST5/AST2 的查询结果和收到 ACK 的设置类指令更新
+        self.shadow = {}
+        self.idempotent = os.environ.get('PAR_IDEMPOTENT', '0') == '1' if idempotent is None else idempotent
+        if shadow_resync is None:
+            shadow_resync = float(os.environ.get('PAR_SHADOW_RESYNC', 30))
+        self.shadow_resync = shadow_resync
+        self.skipped_writes = 0  # 幂等模式下因为设备已经是这个值而没有发送的指令数
+        self._playback_task = None
+        self.sweep = None  # 最近一次的伏安特性扫描，见 TEXIO_PAR_Sweep
+        self._sweep_task = None
+        self.sequences = {}  # 序列ID -> SequenceRun，见 TEXIO_PAR_Sequence，只保留最近 MAX_SEQUENCE_RUNS 次
+        self.last_sent = None  # 最近一条指令（第一次尝试）发送到串口的时刻，time.monotonic()
+        self.echo = os.environ.get('PAR_ECHO', '0') == '1' if echo is None else echo
+        if retries is None:
+            retries = int(os.environ.get('PAR_RETRIES', 2))
+        if retries < 0:
+            raise ValueError(f"重发次数不能为负数（retries / PAR_RETRIES）: {retries}")
+        self.retries = retries
 
-    @staticmethod
-    def calculate_checksum(data):
-        etx = 0x03  # ETX字节
-        checksum = (sum(data) + etx) & 0xFF  # 校验和是数据正文与ETX的和的低8位
-        hex_str = format(checksum, '02X')
-    
-    # 将每个字符转换为其ASCII值，并形成bytearray
-        byte_array = bytearray([ord(hex_str[0])]) + bytearray([ord(hex_str[1])])
-        return byte_array
+    calculate_checksum = staticmethod(calculate_checksum)
     
     @staticmethod
     def print_echo(data):
@@ -55,220 +848,545 @@ class DeviceController:
         print(f"数据 (ASCII): {ascii_data}")
         print(f"数据 (HEX): {hex_data}\n")
     
+    def frame_complete(self, buffer, need_response):
+        """判断接收缓冲区里本设备的应答是否已经完整，其他单元的应答不算数"""
+        return response_complete(buffer, need_response, self.unit)
+
     async def send_instruction(self, command, need_response=False):  # 修改为异步方法
-        data = bytearray(command, 'ascii')
-        checksum = self.calculate_checksum(data)
-        enq, etx = 0x05, 0x03
-        instruction = bytearray([enq]) + data + bytearray([etx]) + checksum
+        """command 为不含单元字符的指令，例如 ST4，发送时会在前面加上本设备的单元字符"""
+        instruction = encode_frame(self.unit + command)
 
-        # 清空接收缓冲区
-        self.ser.reset_input_buffer()
-        
-        print("发送的指令:")
-        self.print_echo(instruction)
-        self.ser.write(instruction)
+        if self.echo:
+            print("发送的指令:")
+            self.print_echo(instruction)
+        发送时间 = time.time()
 
-        接收缓冲区 = bytearray()
-        最后接收时间 = time.time()
-        接收超时时间 = 0.1
-        
-        #find发送指令，如果包含关键词ST，则超时0.5
-        if command.find("ST") != -1:
-            接收超时时间 = 0.5
-        
-        while (time.time() - 最后接收时间) < 接收超时时间:
-            # 从串口读取一个字节
-            byte = self.ser.read(1)
-            if byte:
-                接收缓冲区 += byte
-                最后接收时间 = time.time()
-                    
-        print(f"接收数据耗时: {time.time() - 最后接收时间:.3f} 秒")
-                
-        print("接收到的数据:")
-        self.print_echo(接收缓冲区)
+        # 超时只用来兜底设备无应答的情况，正常情况下收到完整应答帧就立刻返回
+        接收超时时间 = self.response_timeout if need_response else self.ack_timeout
+        command_type = self.pacer.command_type(command)
+        优先级 = COMMAND_PRIORITY.get()
+        # NAK、校验和错误或应答不完整时重发：查询指令只读，设置指令都是绝对值，重发是安全的
+        for 尝试 in range(1 + self.retries):
+            最后一次 = 尝试 == self.retries
+            # 还可以重发时只等按平均延时估算的时间，丢了字节很快就能重发；最后一次等满超时时间
+            等待时间 = 接收超时时间 if 最后一次 else self.pacer.deadline(command_type, 接收超时时间)
+            # 每次尝试都重新排队：安全指令不持有设备锁，最多等正在进行的这一次收发结束就能发送
+            排队时间 = time.monotonic()
+            async with self._slot.hold(优先级):
+                SLOT_WAIT_SECONDS.observe(time.monotonic() - 排队时间, device=self.name,
+                                          priority=PRIORITY_NAMES[优先级])
+                # 按这类指令当前的间隔等待，持有收发时段期间同一台设备的其他指令不会同时在这里等待
+                间隔 = self.pacer.delay(command_type)
+                if 间隔 > 0:
+                    PACING_DELAY.inc(间隔, device=self.name)
+                    await asyncio.sleep(间隔)
+                排队时间 = time.monotonic()
+                async with self.bus.turn(self.unit, urgent=优先级 == PRIORITY_SAFETY):
+                    await self.bus.ensure_connected()
+                    开始时间 = time.monotonic()
+                    if 尝试 == 0:
+                        self.last_sent = 开始时间
+                    BUS_WAIT_SECONDS.observe(开始时间 - 排队时间, device=self.name)
+                    空闲时间 = 开始时间 - self.pacer.last_complete
+                    try:
+                        接收缓冲区, 完整 = await self.transport.exchange(
+                            instruction, lambda buffer: self.frame_complete(buffer, need_response), 等待时间)
+                    except SERIAL_ERRORS as e:
+                        # 串口被拔出等错误：在后台重连，这次请求直接失败
+                        self.bus.connection_lost(e)
+                        raise SerialUnavailable(self.bus.port, e) from e
+            耗时 = time.monotonic() - 开始时间
+            if acknowledgement(接收缓冲区, self.unit) == NAK:
+                结果 = "nak"
+            elif not 完整:
+                # 设备应答了但没收完整（丢了字节）是线路干扰，与指令间隔无关
+                结果 = "corrupt" if answered(接收缓冲区, instruction) else "timeout"
+            elif response_valid(接收缓冲区, need_response, self.unit, self.address):
+                结果 = "ack"
+            elif need_response and foreign_response(接收缓冲区, self.address):
+                # 应答完整、校验和正确但设备地址不符：是地址配置错误，重发没有用，也与指令间隔无关
+                结果 = "address"
+            else:
+                结果 = "corrupt"
+            if 结果 != "address":
+                self.pacer.record(command_type, 结果, 耗时, 空闲时间)
+            COMMAND_SECONDS.observe(耗时, device=self.name, command=command_type)
+            COMMANDS_TOTAL.inc(device=self.name, command=command_type, outcome=结果)
+            BYTES_SENT.inc(len(instruction), device=self.name)
+            BYTES_RECEIVED.inc(len(接收缓冲区), device=self.name)
+            if 结果 in ("ack", "address") or 最后一次:
+                break
+            print(f"{self.unit + command}: {RETRY_REASONS[结果]}，重发")
+        if not 完整:
+            print(f"接收超时: {等待时间:.3f} 秒内未收到完整应答")
+            if not 接收缓冲区:
+                EMPTY_RESPONSES.inc(device=self.name, command=command_type)
+
+        if self.echo:
+            print(f"接收数据耗时: {time.time() - 发送时间:.3f} 秒")
+            print("接收到的数据:")
+            self.print_echo(接收缓冲区)
         
-        return 接收缓冲区 if need_response else None
+        return 接收缓冲区
+
+    def _parse_failed(self, command, error):
+        """记录一次响应帧解析失败，返回给调用方的结果"""
+        PARSE_ERRORS.inc(device=self.name, command=command, reason=PARSE_ERROR_REASONS.get(str(error), "other"))
+        return {"code": -1, "msg": str(error)}
+
+    def _reply_result(self, received_data):
+        """设置类指令的结果：收到 ACK 为成功，NAK 或没有应答为失败"""
+        reply = acknowledgement(received_data, self.unit)
+        if reply == ACK:
+            return {"code": 0, "msg": "Success"}
+        if reply == NAK:
+            return {"code": -1, "msg": "Device returned NAK"}
+        return {"code": -1, "msg": "No acknowledgement from device"}
+
+    async def _command(self, command):
+        """在锁内发送一条设置类指令，返回结果"""
+        async with self.lock:  # 使用异步锁
+            return await self._write(command)
+
+    async def _safety_command(self, command):
+        """
+        安全指令（关闭输出、开启保护）：不等待设备锁，也不跳过与影子状态相同的值，
+        排在下一次收发，最多等正在进行的一次收发（批量指令、定时序列中的也一样）结束
+        """
+        start = time.monotonic()
+        token = COMMAND_PRIORITY.set(PRIORITY_SAFETY)
+        try:
+            received_data = await self.send_instruction(command)
+        finally:
+            COMMAND_PRIORITY.reset(token)
+        result = self._reply_result(received_data)
+        if result["code"] == 0:
+            self.shadow[command[:2]] = (command[2:], time.monotonic())
+        else:
+            self.shadow.pop(command[:2], None)
+        SAFETY_SECONDS.observe(time.monotonic() - start, device=self.name, command=command)
+        return result
+
+    async def _write(self, command):
+        """发送设置类指令（调用方持有锁）并更新影子状态；幂等模式下设备已经是这个值时不发送"""
+        key, value = command[:2], command[2:]
+        if self.idempotent and command not in self.ALWAYS_SEND and await self._shadow_matches(key, value):
+            self.skipped_writes += 1
+            return {"code": 0, "msg": "Unchanged"}
+        received_data = await self.send_instruction(command)
+        result = self._reply_result(received_data)
+        if result["code"] == 0:
+            self.shadow[key] = (value, time.monotonic())
+        else:
+            # 没有收到 ACK 时不知道设备是不是执行了这条指令
+            self.shadow.pop(key, None)
+        return result
+
+    def _shadow_source(self, key):
+        if key[0] in "VA":
+            return self.getMemoryPreset
+        if key in self.SHADOW_SYSTEM_KEYS:
+            return self.getSystemStatus
+        return None
+
+    async def _shadow_matches(self, key, value):
+        """影子状态中这项设定是否已经是 value，没有记录或已过期时先查询设备"""
+        source = self._shadow_source(key)
+        if source is None:
+            return False
+        entry = self.shadow.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.shadow_resync:
+            await source()
+            entry = self.shadow.get(key)
+        return entry is not None and entry[0] == value
+
+    def _update_shadow_from_system_status(self, status):
+        now = time.monotonic()
+        self.shadow["PR"] = (str(status.memory_preset), now)
+        self.shadow["SW"] = ("1" if status.is_output_on else "0", now)
+        self.shadow["PT"] = ("1" if status.is_protection_on else "0", now)
+        self.shadow["RA"] = ("1" if status.is_ua_accuracy else "0", now)
+
+    def _update_shadow_from_memory_preset(self, preset):
+        now = time.monotonic()
+        for name in PRESET_CODES:
+            values = getattr(preset, name)
+            # 与设置指令使用相同的格式，才能直接比较
+            self.shadow["V" + VOLTAGE_CODES[name]] = (f"{values.voltage:.3f}", now)
+            self.shadow["A" + CURRENT_CODES[name]] = (f"{values.current:.3f}", now)
+            self.shadow["A" + CURRENT_UA_CODES[name]] = (f"{values.current_ua:.3f}", now)
+
+    def invalidate_shadow(self):
+        """清空影子状态，下一次写入前会重新查询设备"""
+        self.shadow.clear()
+
+    async def sync_shadow(self):
+        """立刻用 AST5/AST2 重新读取设备的设定"""
+        async with self.lock:
+            memory = await self.getMemoryPreset()
+            system = await self.getSystemStatus()
+        for response in (memory, system):
+            if not response or response.get("code") != 0:
+                return response or {"code": -1, "msg": "No response from device"}
+        return {"code": 0, "msg": "Success", "data": self.shadow_report()}
+
+    def shadow_report(self):
+        now = time.monotonic()
+        return {
+            "idempotent": self.idempotent,
+            "resync_interval": self.shadow_resync,
+            "skipped_writes": self.skipped_writes,
+            "state": {key: {"value": value, "age_s": now - timestamp} for key, (value, timestamp) in sorted(self.shadow.items())},
+        }
     
-    async def set_voltage(self, voltage, memoryObj="workspace"):  # 修改为异步方法
-        memoryObjCode = ""
-        if (memoryObj == "workspace"):
-            memoryObjCode = "A"
-        elif (memoryObj == "memory1"):
-            memoryObjCode = "E"
-        elif (memoryObj == "memory2"):
-            memoryObjCode = "J"
-        elif (memoryObj == "memory3"):
-            memoryObjCode = "N"
+    async def _send_setpoint(self, prefix, value):
+        """
+        发送设定值指令，prefix 包含了电压/电流、存储区和微安档，例如 VA、AB
+        合并模式下，同一个 prefix 还在排队的旧设定值会被新值替换，只发送最新的值，被替换的调用立刻返回 code 1
+        """
+        command = prefix + value
+        # 已经持有锁（批量指令中）时按顺序直接发送，不参与合并
+        if not self.coalesce or self.lock.owned():
+            return await self._command(command)
+
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending_setpoints.get(prefix)
+        self._pending_setpoints[prefix] = (command, future)
+        if pending is None:
+            # 发送放在独立的任务里，调用方被取消时排队中的设定值也不会丢失
+            asyncio.ensure_future(self._flush_setpoint(prefix))
         else:
+            old_command, old_future = pending
+            old_future.set_result({"code": 1, "msg": "Superseded by a newer setpoint",
+                                   "data": {"command": old_command, "replaced_by": command}})
+        return await future
+
+    async def _flush_setpoint(self, prefix):
+        future = None
+        try:
+            async with self.lock:
+                # 拿到锁之后才取出排队的指令，等待期间到来的新值都会被合并
+                command, future = self._pending_setpoints.pop(prefix)
+                result = await self._write(command)
+        except BaseException as e:
+            if future is None:
+                # 还在等锁时被取消：排队的设定值也要取出，否则之后同一目标的新值不会再启动发送
+                future = self._pending_setpoints.pop(prefix, (None, None))[1]
+            if future is not None and not future.done():
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                else:
+                    # 服务关闭等原因被取消，等待结果的请求照常返回，不会一直挂起
+                    future.set_result({"code": -1, "msg": "Setpoint flush was cancelled"})
+            if not isinstance(e, Exception):
+                raise
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def set_voltage(self, voltage, memoryObj="workspace"):  # 修改为异步方法
+        memoryObjCode = VOLTAGE_CODES.get(memoryObj)
+        if memoryObjCode is None:
             return {"code": -1, "msg": "Invalid memory object"}
         
-        async with self.lock:  # 使用异步锁
-            await self.send_instruction(f"AV{memoryObjCode}{voltage:.3f}")
-        return {"code": 0, "msg": "Success"}
+        return await self._send_setpoint(f"V{memoryObjCode}", f"{voltage:.3f}")
     
     async def set_current(self, current, is_uaAccuracy = False, memoryObj="workspace"):  # 修改为异步方法
-        memoryObjCode = ""
         if (is_uaAccuracy == False):
-            if (memoryObj == "workspace"):
-                memoryObjCode = "A"
-            elif (memoryObj == "memory1"):
-                memoryObjCode = "E"
-            elif (memoryObj == "memory2"):
-                memoryObjCode = "J"
-            elif (memoryObj == "memory3"):
-                memoryObjCode = "N"
-            else:
-                return {"code": -1, "msg": "Invalid memory object"}
+            memoryObjCode = CURRENT_CODES.get(memoryObj)
         else:
             # 检查一下输入电流是否小于等于1A
             if (current > 1):
                 return {"code": -1, "msg": "In uaAccuracy, The current value should be less than or equal to 1A"}
-            
-            if (memoryObj == "workspace"):
-                memoryObjCode = "B"
-            elif (memoryObj == "memory1"):
-                memoryObjCode = "F"
-            elif (memoryObj == "memory2"):
-                memoryObjCode = "K"
-            elif (memoryObj == "memory3"):
-                memoryObjCode = "P"
-            else:
-                return {"code": -1, "msg": "Invalid memory object"}
+            memoryObjCode = CURRENT_UA_CODES.get(memoryObj)
+        if memoryObjCode is None:
+            return {"code": -1, "msg": "Invalid memory object"}
         
-        async with self.lock:  # 使用异步锁
-            await self.send_instruction(f"AA{memoryObjCode}{current:.3f}")
-        return {"code": 0, "msg": "Success"}
+        return await self._send_setpoint(f"A{memoryObjCode}", f"{current:.3f}")
 
     #写一个函数用于选择输出，之行为PR0/PR1/PR2/PR3 分别为：工作区、记忆1、记忆2、记忆3，传入参数memoryObj
     async def select_output(self, memoryObj):  # 修改为异步方法
-        if (memoryObj == "workspace"):
-            await self.send_instruction("APR0")
-        elif (memoryObj == "memory1"):
-            await self.send_instruction("APR1")
-        elif (memoryObj == "memory2"):
-            await self.send_instruction("APR2")
-        elif (memoryObj == "memory3"):
-            await self.send_instruction("APR3")
-        else:
+        if memoryObj not in PRESET_CODES:
             return {"code": -1, "msg": "Invalid memory object"}
-        return {"code": 0, "msg": "Success"}
+        return await self._command("PR" + PRESET_CODES[memoryObj])
     
     async def control_output(self, enable):  # 修改为异步方法
-        """控制电源输出，enable为True时开启输出，False时关闭"""
-        async with self.lock:  # 使用异步锁
-            await self.send_instruction("ASW1" if enable else "ASW0")
-        return {"code": 0, "msg": "Success"}
+        """控制电源输出，enable为True时开启输出，False时关闭（关闭输出为安全指令，优先发送）"""
+        if not enable:
+            return await self._safety_command("SW0")
+        return await self._command("SW1")
     
     async def unlock_panel(self):  # 修改为异步方法
-        await self.send_instruction("ALC1")
+        return await self._command("LC1")
     
     async def toggle_protection(self, enable=True):  # 修改为异步方法
-        await self.send_instruction("APT1" if enable else "APT0")
+        # 开启保护为安全指令，优先发送
+        if enable:
+            return await self._safety_command("PT1")
+        return await self._command("PT0")
         
     # RA0 和 RA1 来切换是否使用微安模式，RA1为激活
     async def set_ua_accuracy(self, enable):
-        await self.send_instruction("ARA1" if enable else "ARA0")
+        return await self._command("RA1" if enable else "RA0")
         
         
     #增加方法，获取系统状态，指令ST2，响应数据为：.AST2.1D.A.@MS2,01,1,0,1,0,0,0 响应数据含义：@MS2,2字符设备地址，1字符OVP状态，1字符输出是否开启，1字符输出保护是否开启，1字符未知，1字符记忆预设选择（0：工作区，1：记忆1，2：记忆2，3：记忆3），1字符微安精度是否选择
     async def getSystemStatus(self):  # 修改为异步方法
         async with self.lock:
-            received_data = await self.send_instruction("AST2", need_response=True)
+            received_data = await self.send_instruction("ST2", need_response=True)
         if received_data:
-            # 找到实际数据的起始位置
-            start_index = received_data.find(b'MS2')
-            if start_index == -1:
-                return {"code": -1, "msg": "未找到有效数据起始位置"}
-            
-            # 解析返回的数据
-            raw_result = scanf("MS2,%d,%d,%d,%d,%d,%d,%d", received_data[start_index:].decode())
-            return {"code": 0, "msg": "Success", "data": {"OVP/电压电流显示": raw_result[1], "is_output_on": raw_result[2], "is_protection_on": raw_result[3], "トラッキング": raw_result[4], "memory_preset": raw_result[5], "is_ua_accuracy": raw_result[6]}}
+            try:
+                status = parse_system_status(received_data, self.address)
+            except ProtocolError as e:
+                return self._parse_failed("ST2", e)
+            self._update_shadow_from_system_status(status)
+            return {"code": 0, "msg": "Success", "data": status.to_dict()}
     
     async def getOutputStatus(self):  # 修改为异步方法
         async with self.lock:  # 使用异步锁
-            received_data = await self.send_instruction("AST4", need_response=True)
+            received_data = await self.send_instruction("ST4", need_response=True)
         if received_data:
-            # 找到实际数据的起始位置
-            start_index = received_data.find(b'MS4')
-            if start_index == -1:
-                return {"code": -1, "msg": "未找到有效数据起始位置"}
-            
-            # 解析返回的数据
-            raw_result = scanf("MS4,%d,%f,%f,%f,%d", received_data[start_index:].decode())
-            voltage = raw_result[1]
-            current = raw_result[2]
-            OVP = raw_result[3]
-            is_CC = raw_result[4]==1000
-            # 调试打印
-            print(f"电压: {voltage} V")
-            print(f"电流: {current} A")
-            print(f"OVP: {OVP} V")
-            print(f"CC状态: {is_CC}")
-            return {"code": 0, "msg": "Success", "data":{"voltage": voltage, "current": current, "OVP": OVP, "is_CC": is_CC}}
+            try:
+                status = parse_output_status(received_data, self.address)
+            except ProtocolError as e:
+                return self._parse_failed("ST4", e)
+            if self.echo:
+                # 调试打印
+                print(f"电压: {status.voltage} V")
+                print(f"电流: {status.current} A")
+                print(f"OVP: {status.ovp} V")
+                print(f"CC状态: {status.is_cc}")
+            self.history.append(time.time(), status.voltage, status.current, status.ovp, status.is_cc)
+            self.energy.add(status.voltage, status.current, status.is_cc)
+            return {"code": 0, "msg": "Success", "data": status.to_dict()}
     
     async def getMemoryPreset(self):  # 修改为异步方法
         async with self.lock:  # 使用异步锁
-            received_data = await self.send_instruction("AST5", need_response=True)
+            received_data = await self.send_instruction("ST5", need_response=True)
         if received_data:
-            # 找到实际数据的起始位置
-            start_index = received_data.find(b'MS5')
-            # 有没有类似C语言的scanf函数，可以直接从字符串中提取数字？
-            # @MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
-            # @MS5,设备地址,工作区电压，工作区电流1ma档，工作区电流0.1ma档，记忆1电压，记忆1电流1ma档，记忆1电流0.1ma档，记忆2电压，记忆2电流1ma档，记忆2电流0.1ma档，记忆3电压，记忆3电流1ma档，记忆3电流0.1ma档
-            if start_index == -1:
-                return {"code": -1, "msg": "未找到有效数据起始位置"}
-            # 删除末尾的0x03
-            received_data = received_data[:-1]
-            raw_result = scanf("MS5,%d,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f", received_data[start_index:].decode())
-            print(raw_result)
-            #需要输出一个树形结构，首先一开始有4个节点分别是工作区、记忆1、记忆2、记忆3，每个节点下面有3个子节点分别是电压、电流1ma档、电流0.1ma档
-            reselt = {
-                "workspace": {
-                    "voltage": raw_result[1],
-                    "current": raw_result[2],
-                    "current_ua": raw_result[3]
-                },
-                "memory1": {
-                    "voltage": raw_result[4],
-                    "current": raw_result[5],
-                    "current_ua": raw_result[6]
-                },
-                "memory2": {
-                    "voltage": raw_result[7],
-                    "current": raw_result[8],
-                    "current_ua": raw_result[9]
-                },
-                "memory3": {
-                    "voltage": raw_result[10],
-                    "current": raw_result[11],
-                    "current_ua": raw_result[12]
-                }
-            }
-            print(reselt)
+            try:
+                preset = parse_memory_preset(received_data, self.address)
+            except ProtocolError as e:
+                return self._parse_failed("ST5", e)
+            self._update_shadow_from_memory_preset(preset)
+            #输出一个树形结构，4个节点分别是工作区、记忆1、记忆2、记忆3，每个节点下面有3个子节点分别是电压、电流1ma档、电流0.1ma档
+            reselt = preset.to_dict()
+            if self.echo:
+                print(reselt)
             return {"code": 0, "msg": "Success", "data": reselt}
             
+    async def play_waveform(self, waveform, target="voltage", loops=1):
+        """在后台回放波形，target 为 voltage 或 current；正在回放的波形会先被停止"""
+        setters = {"voltage": self.set_voltage, "current": self.set_current}
+        if target not in setters:
+            return {"code": -1, "msg": "Invalid target"}
+        await self.stop_waveform()
+        self.playback = Playback(waveform, loops)
+        self._playback_task = asyncio.create_task(self.playback.run_async(setters[target]))
+        # 回放出错时错误信息已经记录在 playback.error 里，这里只取出异常避免未处理的警告
+        self._playback_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return {"code": 0, "msg": "Success", "data": self.playback.report()}
+
+    async def stop_waveform(self):
+        """停止正在回放的波形，返回回放统计"""
+        if self._playback_task is not None and not self._playback_task.done():
+            self._playback_task.cancel()
+            try:
+                await self._playback_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._playback_task = None
+        return self.playback.report() if self.playback is not None else None
+
+    def start_sweep(self, sweep):
+        """
+        在后台执行伏安特性扫描，同一台设备同时只能执行一个扫描
+        扫描不长时间持有设备锁，每条设定/查询指令各自排队，其他客户端的请求可以插在两次查询之间
+        """
+        if self._sweep_task is not None and not self._sweep_task.done():
+            return {"code": -1, "msg": "A sweep is still running"}
+        self.sweep = sweep
+        self._sweep_task = asyncio.create_task(sweep.run_async(self))
+        # 出错时错误信息已经记录在 sweep.error 里，这里只取出异常避免未处理的警告
+        self._sweep_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return {"code": 0, "msg": "Success", "data": sweep.report()}
+
+    async def stop_sweep(self):
+        """停止正在执行的扫描，返回已经测量的点"""
+        if self._sweep_task is not None and not self._sweep_task.done():
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._sweep_task = None
+        return self.sweep.report() if self.sweep is not None else None
+
+    def start_sequence(self, run, exclusive=False):
+        """
+        在后台执行一个测试序列（SequenceRun），同一台设备同时只能执行一个序列
+        exclusive: 整个序列期间持有设备锁，其他客户端和后台轮询的指令要等序列结束，步骤的时刻不会被它们推迟
+        """
+        running = [other.id for other in self.sequences.values() if not other.done()]
+        if running:
+            return {"code": -1, "msg": f"Sequence {running[0]} is still running"}
+
+        async def execute(op, parsed):
+            sent_before = self.last_sent
+            result = await BATCH_OPERATIONS[op][1](self, parsed)
+            # 幂等模式下值没变、合并模式下被更新的设定值取代时不会发送指令
+            return result, self.last_sent if self.last_sent != sent_before else None
+
+        async def run_sequence():
+            if exclusive:
+                async with self.lock:
+                    return await run.run_async(execute)
+            return await run.run_async(execute)
+
+        finished = [run_id for run_id, other in self.sequences.items() if other.done()]
+        for run_id in finished[:max(0, len(self.sequences) + 1 - MAX_SEQUENCE_RUNS)]:
+            del self.sequences[run_id]
+        self.sequences[run.id] = run
+        run.task = asyncio.create_task(run_sequence())
+        # 出错时错误信息已经记录在 run.error 里，这里只取出异常避免未处理的警告
+        run.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return {"code": 0, "msg": "Success", "data": run.report(steps=False)}
+
+    async def cancel_sequence(self, run):
+        """取消正在执行的序列，已经执行的步骤的记录保留"""
+        if run.task is not None and not run.task.done():
+            run.task.cancel()
+            try:
+                await run.task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if run.status == "pending":
+            run.status = "cancelled"
+        return run.report()
+
+    async def stop_sequences(self):
+        for run in list(self.sequences.values()):
+            await self.cancel_sequence(run)
+
     def close(self):
-        self.ser.close()
-
-# 创建全局的 DeviceController 实例
-controller = DeviceController(port='COM47')
-
-def breathing_light(controller, duration, min_voltage, max_voltage, cycle_time):#@MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
-    start_time = time.time()
-    controller.set_current(0.05)
-    while time.time() - start_time < duration:
-        elapsed = time.time() - start_time
-        t = (elapsed % cycle_time) / cycle_time  # Normalize to [0, 1]
-        voltage = min_voltage + (max_voltage - min_voltage) * (math.sin(math.pi * t) ** 2)
-        controller.set_voltage(voltage)
+        self.history.close()
+        if self._owns_bus:
+            self.bus.close()
+
+class ControllerRegistry:
+    """
+    多台电源的控制器注册表，按设备ID管理 DeviceController
+    每台电源使用独立的串口和传输层，发给不同电源的指令互不等待，可以并行执行
+    """
+
+    def __init__(self):
+        self.controllers = {}
+        self.buses = {}  # 串口号 -> 共享的 SerialBus
+        self.default_id = None
+
+    @classmethod
+    def from_config(cls, path):
+        """
+        从 JSON 配置文件创建，格式：
+        {"default": "psu1", "devices": {"psu1": {"port": "COM47"}, "psu2": {"port": "COM48", "coalesce": true}}}
+        "serial" 为串口参数（例如 {"baudrate": 9600}），共用一个串口的设备以第一台的为准；
+        每台设备的其余字段会作为参数传给 DeviceController；多台设备共用一个串口时用 unit/address 区分
+        """
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        registry = cls()
+        for device_id, options in config["devices"].items():
+            # 串口相同的设备挂在同一条总线上，通过 unit/address 区分
+            options = dict(options)
+            port = options.pop("port")
+            settings = options.pop("serial", None)
+            if os.environ.get('PAR_HISTORY_PATH') and "history_path" not in options:
+                # 每台设备的历史记录保存在各自的文件里
+                options["history_path"] = f"{os.environ['PAR_HISTORY_PATH']}.{device_id}"
+            if port not in registry.buses:
+                registry.buses[port] = SerialBus(port, settings)
+            registry.add(device_id, DeviceController(bus=registry.buses[port], **options))
+        if config.get("default"):
+            registry.default_id = config["default"]
+        return registry
+
+    @classmethod
+    def from_env(cls):
+        """环境变量 PAR_DEVICES 指定配置文件；没有配置文件时只创建一台设备，串口号由 PAR_PORT 指定"""
+        if os.environ.get('PAR_DEVICES'):
+            return cls.from_config(os.environ['PAR_DEVICES'])
+        registry = cls()
+        registry.add("default", DeviceController(port=os.environ.get('PAR_PORT', 'COM47')))
+        return registry
+
+    def add(self, device_id, device):
+        self.controllers[device_id] = device
+        device.name = device_id
+        if self.default_id is None:
+            self.default_id = device_id
+
+    def get(self, device_id=None):
+        device_id = self.default_id if device_id is None else device_id
+        if device_id not in self.controllers:
+            raise HTTPException(status_code=404, detail=f"Unknown device: {device_id}")
+        return self.controllers[device_id]
+
+    async def fan_out(self, operation):
+        """在所有电源上同时执行 operation(controller)，返回每台设备的结果"""
+        device_ids = list(self.controllers)
+        results = await asyncio.gather(*(operation(self.controllers[i]) for i in device_ids), return_exceptions=True)
+        data = {}
+        code = 0
+        for device_id, result in zip(device_ids, results):
+            if isinstance(result, Exception):
+                result = {"code": -1, "msg": f"{type(result).__name__}: {result}"}
+            if result is None:
+                result = {"code": 0, "msg": "Success"}
+            if result.get("code") != 0:
+                code = -1
+            data[device_id] = result
+        return {"code": code, "msg": "Success" if code == 0 else "Some devices failed", "data": data}
+
+    def bus_owners(self):
+        """每条串口总线和挂在上面的第一台设备的ID，{设备ID: SerialBus}"""
+        owners = {}
+        for device_id, device in self.controllers.items():
+            if all(bus is not device.bus for bus in owners.values()):
+                owners[device_id] = device.bus
+        return owners
+
+    def close(self):
+        for device in self.controllers.values():
+            device.close()
+        for bus in self.buses.values():
+            bus.close()
+
+# 创建全局的控制器注册表，没有配置文件时只有一台设备，串口号可以用环境变量 PAR_PORT 覆盖（例如指向模拟器的伪终端）
+registry = ControllerRegistry.from_env()
+controller = registry.get()  # 默认设备，兼容只有一台电源的用法
+
+def capture_path(device_id, name=None):
+    """抓包文件保存在 PAR_CAPTURE_DIR 目录（默认 captures）下，不指定文件名时用 设备ID-时间.parcap"""
+    directory = os.environ.get('PAR_CAPTURE_DIR', 'captures')
+    os.makedirs(directory, exist_ok=True)
+    if not name:
+        name = f"{device_id}-{time.strftime('%Y%m%d-%H%M%S')}.parcap"
+    # 只取文件名部分，不允许写到抓包目录以外
+    return os.path.join(directory, os.path.basename(name))
+
+async def breathing_light(controller, duration, min_voltage, max_voltage, cycle_time, rate=5):#@MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
+    """电压在 min_voltage 和 max_voltage 之间按 sin² 变化，rate 为每秒的采样点数，返回回放统计"""
+    await controller.set_current(0.05)
+    waveform = Waveform.sine(min_voltage, max_voltage, cycle_time, duration, rate)
+    report = await Playback(waveform).run_async(controller.set_voltage)
     
     # Safety shutdown after the demo
-    controller.control_output(False)
-    controller.set_voltage(0)
-    controller.set_current(0)
-    controller.toggle_protection(False)
-    controller.unlock_panel()
+    await controller.control_output(False)
+    await controller.set_voltage(0)
+    await controller.set_current(0)
+    await controller.toggle_protection(False)
+    await controller.unlock_panel()
+    return report
 
 class SetVoltageRequest(BaseModel):
     voltage: float
@@ -282,56 +1400,474 @@ class SetCurrentRequest(BaseModel):
 class SelectOutputRequest(BaseModel):
     memoryObj: str
 
+class WaveformRequest(BaseModel):
+    shape: str  # sine / ramp / step / array
+    rate: float  # 每秒的采样点数
+    target: str = "voltage"  # voltage / current
+    loops: int = 1  # 重复次数，0 表示一直重复直到停止
+    # sine: low, high, period, duration；ramp: start, stop, duration；step: levels, dwell；array: samples
+    low: Optional[float] = None
+    high: Optional[float] = None
+    period: Optional[float] = None
+    duration: Optional[float] = None
+    start: Optional[float] = None
+    stop: Optional[float] = None
+    levels: Optional[List[float]] = None
+    dwell: Optional[float] = None
+    samples: Optional[List[float]] = None
+
+class EnableRequest(BaseModel):
+    enable: bool
+
+class ProtectionRequest(BaseModel):
+    enable: bool = True
+
+class EmptyRequest(BaseModel):
+    pass
+
+class BatchOperation(BaseModel):
+    op: str  # 操作名，见 BATCH_OPERATIONS
+    args: dict = {}  # 操作的参数，与对应的单独接口相同
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+    stop_on_error: bool = True  # 某一步失败后跳过剩下的步骤
+
+# 批量指令支持的操作：操作名 -> (参数模型, 执行函数)
+BATCH_OPERATIONS = {
+    "set_voltage": (SetVoltageRequest, lambda device, r: device.set_voltage(r.voltage, r.memoryObj)),
+    "set_current": (SetCurrentRequest, lambda device, r: device.set_current(r.current, r.is_uaAccuracy, r.memoryObj)),
+    "select_output": (SelectOutputRequest, lambda device, r: device.select_output(r.memoryObj)),
+    "control_output": (EnableRequest, lambda device, r: device.control_output(r.enable)),
+    "toggle_protection": (ProtectionRequest, lambda device, r: device.toggle_protection(r.enable)),
+    "set_ua_accuracy": (EnableRequest, lambda device, r: device.set_ua_accuracy(r.enable)),
+    "unlock_panel": (EmptyRequest, lambda device, r: device.unlock_panel()),
+    # 批量指令中的查询总是直接查询设备，不使用缓存
+    "get_output_status": (EmptyRequest, lambda device, r: device.getOutputStatus()),
+    "getSystemStatus": (EmptyRequest, lambda device, r: device.getSystemStatus()),
+    "get_memory_preset": (EmptyRequest, lambda device, r: device.getMemoryPreset()),
+}
+MAX_BATCH_OPERATIONS = 100  # 一次批量指令最多的步骤数，避免长时间占用设备
+MAX_SEQUENCE_RUNS = 20  # 每台设备保留的序列执行记录数（含正在执行的）
+
+def check_batch_operation(operation):
+    """检查一个批量操作，返回 (解析后的参数, 错误信息)"""
+    if operation.op not in BATCH_OPERATIONS:
+        return None, f"Unknown operation: {operation.op}"
+    model = BATCH_OPERATIONS[operation.op][0]
+    try:
+        request = model(**operation.args)
+    except ValidationError as e:
+        return None, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    memoryObj = getattr(request, "memoryObj", None)
+    if memoryObj is not None and memoryObj not in PRESET_CODES:
+        return None, "Invalid memory object"
+    if isinstance(request, SetCurrentRequest) and request.is_uaAccuracy and request.current > 1:
+        return None, "In uaAccuracy, The current value should be less than or equal to 1A"
+    return request, None
+
+class SequenceRequest(BaseModel):
+    steps: list  # 步骤数组，格式见 TEXIO_PAR_Sequence
+    name: Optional[str] = None
+    stop_on_error: bool = True  # 某一步失败后跳过剩下的步骤
+    exclusive: bool = False  # 整个序列期间持有设备锁
+
+class SweepRequest(BaseModel):
+    # 设定点：points 直接给出，或者 start/stop/step（包含 stop）
+    points: Optional[List[float]] = None
+    start: Optional[float] = None
+    stop: Optional[float] = None
+    step: Optional[float] = None
+    current_limit: Optional[float] = None  # 扫描前设置的限流值（A）
+    tolerance_v: float = Field(0.01, ge=0, le=20)
+    tolerance_a: float = Field(0.001, ge=0, le=4)
+    window: int = Field(3, ge=2, le=20)  # 判断稳定需要的连续读数个数
+    settle_timeout: float = Field(2.0, gt=0, le=60)  # 每个点最多等待的时间（秒）
+    output: bool = False  # 扫描前打开输出，结束后关闭
+
+def check_sequence_operation(op, args):
+    """序列中操作步骤的检查，规则与批量指令相同"""
+    try:
+        operation = BatchOperation(op=op, args=args)
+    except ValidationError as e:
+        return None, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    return check_batch_operation(operation)
+
+# 每个接口都有两个路径：/api/xxx 操作默认设备，/api/devices/{device_id}/xxx 操作指定的设备
+@app.get("/api/devices")
+async def list_devices():
+    return {"code": 0, "msg": "Success", "data": {"default": registry.default_id, "devices": {
+        device_id: {"port": device.bus.port, "unit": device.unit, "address": device.address} for device_id, device in registry.controllers.items()}}}
+
 @app.post("/api/set_voltage")
-async def set_voltage(request: SetVoltageRequest):
-    response = await controller.set_voltage(request.voltage, request.memoryObj)  # 使用异步调用
+@app.post("/api/devices/{device_id}/set_voltage")
+async def set_voltage(request: SetVoltageRequest, device_id: Optional[str] = None):
+    response = await registry.get(device_id).set_voltage(request.voltage, request.memoryObj)  # 使用异步调用
     return response
 
 @app.post("/api/set_current")
-async def set_current(request: SetCurrentRequest):
-    response = await controller.set_current(request.current, request.is_uaAccuracy, request.memoryObj)  # 使用异步调用
+@app.post("/api/devices/{device_id}/set_current")
+async def set_current(request: SetCurrentRequest, device_id: Optional[str] = None):
+    response = await registry.get(device_id).set_current(request.current, request.is_uaAccuracy, request.memoryObj)  # 使用异步调用
     return response
 
 @app.post("/api/select_output")
-async def select_output(request: SelectOutputRequest):
-    response = await controller.select_output(request.memoryObj)  # 使用异步调用
+@app.post("/api/devices/{device_id}/select_output")
+async def select_output(request: SelectOutputRequest, device_id: Optional[str] = None):
+    response = await registry.get(device_id).select_output(request.memoryObj)  # 使用异步调用
     return response
 
 @app.post("/api/control_output")
-async def control_output(enable: bool):
-    response = await controller.control_output(enable)  # 使用异步调用
+@app.post("/api/devices/{device_id}/control_output")
+async def control_output(enable: bool, device_id: Optional[str] = None):
+    response = await registry.get(device_id).control_output(enable)  # 使用异步调用
     return response
 
 @app.post("/api/unlock_panel")
-async def unlock_panel():
-    await controller.unlock_panel()  # 使用异步调用
-    return {"code": 0, "msg": "Success"}
+@app.post("/api/devices/{device_id}/unlock_panel")
+async def unlock_panel(device_id: Optional[str] = None):
+    response = await registry.get(device_id).unlock_panel()  # 使用异步调用
+    return response
 
 @app.post("/api/toggle_protection")
-async def toggle_protection(enable: bool = True):
-    await controller.toggle_protection(enable)  # 使用异步调用
-    return {"code": 0, "msg": "Success"}
+@app.post("/api/devices/{device_id}/toggle_protection")
+async def toggle_protection(enable: bool = True, device_id: Optional[str] = None):
+    response = await registry.get(device_id).toggle_protection(enable)  # 使用异步调用
+    return response
 
 @app.post("/api/set_ua_accuracy")
-async def set_ua_accuracy(enable: bool):
-    await controller.set_ua_accuracy(enable)  # 使用 await 关键字调用异步方法
-    return {"code": 0, "msg": "Success"}
+@app.post("/api/devices/{device_id}/set_ua_accuracy")
+async def set_ua_accuracy(enable: bool, device_id: Optional[str] = None):
+    response = await registry.get(device_id).set_ua_accuracy(enable)  # 使用 await 关键字调用异步方法
+    return response
+
+# 批量指令：先检查所有步骤，有任何一步不合法时一条指令都不发送；然后在一次持有设备锁期间依次执行，中间不会插入其他请求的指令
+@app.post("/api/batch")
+@app.post("/api/devices/{device_id}/batch")
+async def batch(request: BatchRequest, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    if len(request.operations) > MAX_BATCH_OPERATIONS:
+        return {"code": -1, "msg": f"At most {MAX_BATCH_OPERATIONS} operations in one batch"}
+    steps = []
+    errors = []
+    for index, operation in enumerate(request.operations):
+        parsed, error = check_batch_operation(operation)
+        if error is not None:
+            errors.append({"index": index, "op": operation.op, "msg": error})
+        steps.append((operation.op, parsed))
+    if errors:
+        return {"code": -1, "msg": "Invalid operations, nothing was sent", "data": errors}
+
+    results = []
+    code = 0
+    start_time = time.monotonic()
+    async with device.lock:
+        for index, (name, parsed) in enumerate(steps):
+            if code != 0 and request.stop_on_error:
+                results.append({"index": index, "op": name, "code": 1, "msg": "Skipped"})
+                continue
+            try:
+                result = await BATCH_OPERATIONS[name][1](device, parsed)
+            except Exception as e:
+                result = {"code": -1, "msg": f"{type(e).__name__}: {e}"}
+            if result is None:
+                result = {"code": -1, "msg": "No response from device"}
+            if result.get("code") == -1:
+                code = -1
+            results.append(dict(result, index=index, op=name))
+    return {"code": code, "msg": "Success" if code == 0 else "Some operations failed",
+            "data": {"results": results, "elapsed_ms": (time.monotonic() - start_time) * 1000}}
 
+# 定时测试序列：先展开并检查所有步骤，有任何一步不合法时一条指令都不发送；然后在后台按时间表执行，
+# 返回序列ID，GET 查看进度和每一步实际发送的时刻，DELETE 取消
+@app.post("/api/sequence")
+@app.post("/api/devices/{device_id}/sequence")
+async def start_sequence(request: SequenceRequest, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    try:
+        timeline, duration = compile_steps(request.steps, check_sequence_operation)
+    except ValueError as e:
+        return {"code": -1, "msg": f"Invalid sequence, nothing was sent: {e}"}
+    if not timeline:
+        return {"code": -1, "msg": "Sequence has no operations"}
+    return device.start_sequence(SequenceRun(timeline, duration, request.name, request.stop_on_error), request.exclusive)
+
+@app.get("/api/sequences")
+@app.get("/api/devices/{device_id}/sequences")
+async def list_sequences(device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    return {"code": 0, "msg": "Success", "data": [run.report(steps=False) for run in device.sequences.values()]}
+
+def get_sequence_run(device, run_id):
+    run = device.sequences.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Unknown sequence: {run_id}")
+    return run
+
+@app.get("/api/sequence/{run_id}")
+@app.get("/api/devices/{device_id}/sequence/{run_id}")
+async def get_sequence(run_id: str, device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": get_sequence_run(registry.get(device_id), run_id).report()}
+
+@app.delete("/api/sequence/{run_id}")
+@app.delete("/api/devices/{device_id}/sequence/{run_id}")
+async def cancel_sequence(run_id: str, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    return {"code": 0, "msg": "Success", "data": await device.cancel_sequence(get_sequence_run(device, run_id))}
+
+# 查询接口优先返回后台轮询的缓存，max_age 为允许的缓存最大时长（秒），不传时使用服务器配置
 @app.get("/api/get_output_status")
-async def get_output_status():
-    response = await controller.getOutputStatus()  # 使用异步调用
+@app.get("/api/devices/{device_id}/get_output_status")
+async def get_output_status(max_age: Optional[float] = None, device_id: Optional[str] = None):
+    response = await registry.get(device_id).telemetry.get("output_status", max_age)
     return response
 
 @app.get("/api/get_memory_preset")
-async def get_memory_preset():
-    response = await controller.getMemoryPreset()  # 使用异步调用
+@app.get("/api/devices/{device_id}/get_memory_preset")
+async def get_memory_preset(max_age: Optional[float] = None, device_id: Optional[str] = None):
+    response = await registry.get(device_id).telemetry.get("memory_preset", max_age)
     return response
 
 @app.get("/api/getSystemStatus")
-async def getSystemStatus():
-    response = await controller.getSystemStatus()  # 使用异步调用
+@app.get("/api/devices/{device_id}/getSystemStatus")
+async def getSystemStatus(max_age: Optional[float] = None, device_id: Optional[str] = None):
+    response = await registry.get(device_id).telemetry.get("system_status", max_age)
     return response
 
+# 实时数据流（Server-Sent Events）：每次从设备得到新的输出状态/系统状态都推送给所有连接，所有连接共用同一份设备轮询
+# keys 为逗号分隔的 output_status / system_status / memory_preset；queue 为每个连接最多缓存的条数，客户端读得慢时丢弃最旧的
+# 每条事件的 id 是递增的序号，序号不连续说明中间有数据被丢弃
+@app.get("/api/stream")
+@app.get("/api/devices/{device_id}/stream")
+async def stream(keys: str = "output_status,system_status", queue: int = 16, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    keys = [key for key in keys.split(",") if key]
+    if not keys or any(key not in TelemetryCache.QUERIES for key in keys):
+        raise HTTPException(status_code=400, detail=f"keys should be chosen from {', '.join(TelemetryCache.QUERIES)}")
+    if not 1 <= queue <= 1000:
+        raise HTTPException(status_code=400, detail="queue should be between 1 and 1000")
+
+    async def events():
+        # 在开始发送时才订阅，请求还没开始响应就断开时不会留下订阅者
+        subscriber = device.telemetry.subscribe(keys, queue)
+        try:
+            while True:
+                try:
+                    sequence, key, response = await asyncio.wait_for(subscriber.get(), 15)
+                except asyncio.TimeoutError:
+                    # 定期发送注释行保持连接，同时及时发现已经断开的客户端
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {sequence}\nevent: {key}\ndata: {json.dumps(response, ensure_ascii=False)}\n\n"
+        finally:
+            subscriber.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 输出状态历史：返回 [start, end]（Unix 时间戳，秒）范围内的记录，按时间降采样到最多 points 个点，每个点给出最小/最大/平均值
+@app.get("/api/history")
+@app.get("/api/devices/{device_id}/history")
+async def get_history(start: Optional[float] = None, end: Optional[float] = None, points: int = 500,
+                      device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    if not 1 <= points <= 10000:
+        return {"code": -1, "msg": "points should be between 1 and 10000"}
+    return {"code": 0, "msg": "Success", "data": device.history.query(start, end, points)}
+
+# 影子状态：设备当前设定的本地副本，幂等写入模式（PAR_IDEMPOTENT=1）下据此跳过不会改变设备状态的设置类指令
+@app.get("/api/shadow")
+@app.get("/api/devices/{device_id}/shadow")
+async def get_shadow(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": registry.get(device_id).shadow_report()}
+
+@app.post("/api/shadow/resync")
+@app.post("/api/devices/{device_id}/shadow/resync")
+async def resync_shadow(device_id: Optional[str] = None):
+    return await registry.get(device_id).sync_shadow()
+
+@app.post("/api/shadow/invalidate")
+@app.post("/api/devices/{device_id}/shadow/invalidate")
+async def invalidate_shadow(device_id: Optional[str] = None):
+    registry.get(device_id).invalidate_shadow()
+    return {"code": 0, "msg": "Success"}
+
+# 电能/电量累计：由每次 AST4 的结果梯形积分得到，开启后台轮询（PAR_POLL_INTERVAL）时不需要客户端轮询
+@app.get("/api/energy")
+@app.get("/api/devices/{device_id}/energy")
+async def get_energy(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": registry.get(device_id).energy.report()}
+
+# 清零，返回清零前的累计值
+@app.post("/api/energy/reset")
+@app.post("/api/devices/{device_id}/energy/reset")
+async def reset_energy(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": registry.get(device_id).energy.reset()}
+
+# 指令间隔：每类指令当前使用的间隔、学到的下限、平均延时和 NAK/超时次数
+@app.get("/api/pacing")
+@app.get("/api/devices/{device_id}/pacing")
+async def get_pacing(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": registry.get(device_id).pacer.report()}
+
+@app.exception_handler(SerialUnavailable)
+async def serial_unavailable(request, exc):
+    return JSONResponse(status_code=503, content={"code": -1, "msg": str(exc)})
+
+# 健康状态：每台设备所在串口的连接状态，有串口断开（正在重连）时返回 503
+@app.get("/api/health")
+async def get_health():
+    data = {device_id: dict(device.bus.health(), unit=device.unit, address=device.address)
+            for device_id, device in registry.controllers.items()}
+    healthy = all(item["state"] != "reconnecting" for item in data.values())
+    return JSONResponse(status_code=200 if healthy else 503, content={
+        "code": 0 if healthy else -1, "msg": "Success" if healthy else "Some serial ports are disconnected", "data": data})
+
+@app.get("/api/devices/{device_id}/health")
+async def get_device_health(device_id: str):
+    device = registry.get(device_id)
+    health = dict(device.bus.health(), unit=device.unit, address=device.address)
+    healthy = health["state"] != "reconnecting"
+    return JSONResponse(status_code=200 if healthy else 503, content={
+        "code": 0 if healthy else -1, "msg": "Success" if healthy else "Serial port disconnected", "data": health})
+
+class InFlightMiddleware:
+    """统计正在处理的 HTTP 请求数；实时数据流（/stream）是长连接，不计算在内"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].endswith("/stream"):
+            return await self.app(scope, receive, send)
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+
+app.add_middleware(InFlightMiddleware)
+
+# Prometheus 抓取接口，所有设备的指标都在这里，用 device 标签区分
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# 抓包：把设备所在串口上收发的原始数据写入二进制文件，用 TEXIO_PAR_Capture.py 查看和回放
+# 同一串口上的多台设备共用一个抓包文件
+class CaptureRequest(BaseModel):
+    name: Optional[str] = None  # 文件名，保存在 PAR_CAPTURE_DIR 目录下
+
+@app.post("/api/capture")
+@app.post("/api/devices/{device_id}/capture")
+async def start_capture(request: Optional[CaptureRequest] = None, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    path = capture_path(device_id or registry.default_id, request.name if request else None)
+    try:
+        capture = device.bus.start_capture(path)
+    except OSError as e:
+        return {"code": -1, "msg": str(e)}
+    return {"code": 0, "msg": "Success", "data": capture.status()}
+
+@app.get("/api/capture")
+@app.get("/api/devices/{device_id}/capture")
+async def get_capture(device_id: Optional[str] = None):
+    capture = registry.get(device_id).bus.transport.capture
+    if capture is None:
+        return {"code": 0, "msg": "Success", "data": None}
+    # 把缓冲区里的数据写入文件，抓包进行中也可以用 TEXIO_PAR_Capture.py 读取
+    capture.flush()
+    return {"code": 0, "msg": "Success", "data": capture.status()}
+
+@app.delete("/api/capture")
+@app.delete("/api/devices/{device_id}/capture")
+async def stop_capture(device_id: Optional[str] = None):
+    capture = registry.get(device_id).bus.stop_capture()
+    return {"code": 0, "msg": "Success", "data": capture.status() if capture else None}
+
+# 波形回放：在后台按采样率发送设定值，GET 查看进度和实际采样率/抖动，DELETE 停止
+@app.post("/api/waveform")
+@app.post("/api/devices/{device_id}/waveform")
+async def play_waveform(request: WaveformRequest, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    if request.shape == "csv":
+        return {"code": -1, "msg": "CSV waveforms are only supported from Python, send the samples as an array"}
+    params = request.model_dump(exclude_none=True, exclude={"shape", "rate", "target", "loops"})
+    try:
+        waveform = Waveform.from_spec(request.shape, request.rate, **params)
+    except ValueError as e:
+        return {"code": -1, "msg": str(e)}
+    return await device.play_waveform(waveform, request.target, request.loops)
+
+@app.get("/api/waveform")
+@app.get("/api/devices/{device_id}/waveform")
+async def get_waveform(device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    return {"code": 0, "msg": "Success", "data": device.playback.report() if device.playback else None}
+
+@app.delete("/api/waveform")
+@app.delete("/api/devices/{device_id}/waveform")
+async def stop_waveform(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": await registry.get(device_id).stop_waveform()}
+
+@app.post("/api/sweep")
+@app.post("/api/devices/{device_id}/sweep")
+async def start_sweep(request: SweepRequest, device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    try:
+        if request.points is not None:
+            points = request.points
+        elif None not in (request.start, request.stop, request.step):
+            points = sweep_points(request.start, request.stop, request.step)
+        else:
+            return {"code": -1, "msg": "Either points or start/stop/step is required"}
+        sweep = Sweep(points, request.current_limit, request.tolerance_v, request.tolerance_a, request.window,
+                      request.settle_timeout, request.output)
+    except ValueError as e:
+        return {"code": -1, "msg": str(e)}
+    return device.start_sweep(sweep)
+
+@app.get("/api/sweep")
+@app.get("/api/devices/{device_id}/sweep")
+async def get_sweep(device_id: Optional[str] = None):
+    device = registry.get(device_id)
+    return {"code": 0, "msg": "Success", "data": device.sweep.report() if device.sweep is not None else None}
+
+@app.delete("/api/sweep")
+@app.delete("/api/devices/{device_id}/sweep")
+async def stop_sweep(device_id: Optional[str] = None):
+    return {"code": 0, "msg": "Success", "data": await registry.get(device_id).stop_sweep()}
+
+# 群发接口：在所有电源上同时执行，返回每台设备的结果
+@app.post("/api/all/control_output")
+async def all_control_output(enable: bool):
+    return await registry.fan_out(lambda device: device.control_output(enable))
+
+@app.post("/api/all/toggle_protection")
+async def all_toggle_protection(enable: bool = True):
+    return await registry.fan_out(lambda device: device.toggle_protection(enable))
+
+@app.post("/api/all/set_voltage")
+async def all_set_voltage(request: SetVoltageRequest):
+    return await registry.fan_out(lambda device: device.set_voltage(request.voltage, request.memoryObj))
+
+@app.post("/api/all/set_current")
+async def all_set_current(request: SetCurrentRequest):
+    return await registry.fan_out(
+        lambda device: device.set_current(request.current, request.is_uaAccuracy, request.memoryObj))
+
+@app.post("/api/all/select_output")
+async def all_select_output(request: SelectOutputRequest):
+    return await registry.fan_out(lambda device: device.select_output(request.memoryObj))
+
+@app.get("/api/all/get_output_status")
+async def all_get_output_status(max_age: Optional[float] = None):
+    return await registry.fan_out(lambda device: device.telemetry.get("output_status", max_age))
+
+@app.get("/api/all/getSystemStatus")
+async def all_getSystemStatus(max_age: Optional[float] = None):
+    return await registry.fan_out(lambda device: device.telemetry.get("system_status", max_age))
+
 #启动服务
 if __name__ == "__main__":
     import uvicorn
@@ -1,12 +1,26 @@
+import os
 import serial
 import time
-import math
-from scanf import scanf
+from TEXIO_PAR_Codec import (VOLTAGE_CODES, CURRENT_CODES, CURRENT_UA_CODES, PRESET_CODES, ACK, NAK, ProtocolError,
+                             acknowledgement, answered, calculate_checksum, encode_frame, response_complete,
+                             response_valid, parse_system_status, parse_output_status, parse_memory_preset)
+from TEXIO_PAR_Pacing import CommandPacer
+from TEXIO_PAR_Waveform import Waveform, play, print_report
+from TEXIO_PAR_Capture import CaptureWriter
+from TEXIO_PAR_Energy import EnergyMeter
 
 class DeviceController:
-    def __init__(self, port):
+    ack_timeout = 0.5  # 设置类指令等待 ACK/NAK 的最长时间（秒）
+    response_timeout = 1.0  # 查询类指令等待响应帧的最长时间（秒）
+    retry_reasons = {"nak": "设备返回 NAK", "corrupt": "应答不完整或校验和错误", "timeout": "设备没有应答"}
+
+    def __init__(self, port, pacing="adaptive", pacing_gap=0.5, echo=None, capture=None, retries=2):
         """
         初始化设备控制器
+        pacing: 指令间隔模式，adaptive 按指令类型自适应，fixed 固定间隔（pacing_gap 秒，日文版手册推荐500ms）
+        echo: 是否在控制台打印每条指令的收发数据，不指定时读取环境变量 PAR_ECHO（默认关闭）
+        capture: 抓包文件路径，收发的原始数据都写入这个文件，见 TEXIO_PAR_Capture；也可以之后调用 start_capture
+        retries: 收到 NAK、校验和错误或应答不完整时最多重发的次数
         """
         self.ser = serial.Serial(
             port=port,
@@ -14,22 +28,34 @@ class DeviceController:
             bytesize=serial.SEVENBITS,
             parity=serial.PARITY_EVEN,
             stopbits=serial.STOPBITS_ONE,
-            timeout=1
+            timeout=0.05  # 单次read的最长阻塞时间，整体超时由send_instruction控制
         )
         if not self.ser.isOpen():
             raise Exception(f"无法打开串口 {port}")
         
-        self.last_send_time = 0  # 上次发送指令的时间
+        self.pacer = CommandPacer(pacing, fixed_gap=pacing_gap)
+        if retries < 0:
+            raise ValueError(f"重发次数不能为负数: {retries}")
+        self.retries = retries
+        self.echo = os.environ.get('PAR_ECHO', '0') == '1' if echo is None else echo
+        self.energy = EnergyMeter()  # 每次 AST4 的结果都参与电能/电量积分，见 TEXIO_PAR_Energy
+        self.capture = None
+        if capture is not None:
+            self.start_capture(capture)
         
-    @staticmethod
-    def calculate_checksum(data):
-        etx = 0x03  # ETX字节
-        checksum = (sum(data) + etx) & 0xFF  # 校验和是数据正文与ETX的和的低8位
-        hex_str = format(checksum, '02X')
-    
-    # 将每个字符转换为其ASCII值，并形成bytearray
-        byte_array = bytearray([ord(hex_str[0])]) + bytearray([ord(hex_str[1])])
-        return byte_array
+    def start_capture(self, path):
+        """开始抓包，之前的抓包会先结束"""
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        return capture
+
+    calculate_checksum = staticmethod(calculate_checksum)
     
     @staticmethod
     def print_echo(data):
@@ -39,117 +65,95 @@ class DeviceController:
         print(f"回显数据 (HEX): {hex_data}\n")
     
     def send_instruction(self, command, need_response=False):
-        # 确保命令之间的延迟大于等于500ms
-        current_time = time.time()
-        delay = current_time - self.last_send_time
-        if delay < 0.5:  # 如果上次发送时间小于500ms之前
-            time.sleep(0.5 - delay) #日文版手册推荐指令时间500ms
+        instruction = encode_frame(command)
+        command_type = self.pacer.command_type(command[1:])
+        timeout = self.response_timeout if need_response else self.ack_timeout
+        # NAK、校验和错误或应答不完整时重发：查询指令只读，设置指令都是绝对值，重发是安全的
+        for attempt in range(1 + self.retries):
+            last_attempt = attempt == self.retries
+            # 还可以重发时只等按平均延时估算的时间，丢了字节很快就能重发；最后一次等满超时时间
+            deadline = timeout if last_attempt else self.pacer.deadline(command_type, timeout)
+            # 按这类指令当前的间隔等待，间隔从上一条指令收到应答时算起
+            time.sleep(self.pacer.delay(command_type))
+
+            # 清空接收缓冲区
+            self.ser.reset_input_buffer()
             
-        data = bytearray(command, 'ascii')
-        checksum = self.calculate_checksum(data)
-        enq, etx = 0x05, 0x03
-        instruction = bytearray([enq]) + data + bytearray([etx]) + checksum
+            if self.echo:
+                print(f"发送的指令: {instruction.hex(' ')}")
+            start_time = time.monotonic()
+            idle = start_time - self.pacer.last_complete
+            capture = self.capture
+            if capture is not None:
+                capture.tx(instruction, start_time)
+            self.ser.write(instruction)
 
-        # 清空接收缓冲区
-        self.ser.reset_input_buffer()
-        
-        print(f"发送的指令: {instruction.hex(' ')}")
-        self.ser.write(instruction)
+            received_data = bytearray()
+            # 设置类指令收到 ACK/NAK 就结束，查询类指令等到完整的响应帧
+            while not response_complete(received_data, need_response, command[0]):
+                data = self.ser.read(max(1, self.ser.in_waiting))
+                if data and capture is not None:
+                    capture.rx(data)
+                received_data.extend(data)
+                if time.monotonic() - start_time > deadline:
+                    break
 
-        received_data = bytearray()
-        start_time = time.time()
-        first_etx_received = False
-        ack_received_count = 0
+            if acknowledgement(received_data, command[0]) == NAK:
+                outcome = "nak"
+            elif not response_complete(received_data, need_response, command[0]):
+                # 设备应答了但没收完整（丢了字节）是线路干扰，与指令间隔无关
+                outcome = "corrupt" if answered(received_data, instruction) else "timeout"
+            elif response_valid(received_data, need_response, command[0]):
+                outcome = "ack"
+            else:
+                outcome = "corrupt"
+            self.pacer.record(command_type, outcome, time.monotonic() - start_time, idle)
 
-        while True:
-            if self.ser.in_waiting > 0:
-                byte = self.ser.read(1)
-                received_data.extend(byte)
-                if byte == b'\x03':
-                    if not first_etx_received:
-                        first_etx_received = True
-                    else:
-                        break
-                        
-                elif not need_response and ack_received_count >= 2:
-                    break
-                else:
-                    ack_received_count += 1  # 增加ACK计数器
-                    
-            if time.time() - start_time > 5:
-                received_data = bytearray()
+            if self.echo:
+                self.print_echo(received_data)
+            if outcome == "ack" or last_attempt:
                 break
-
-        self.print_echo(received_data)
-        self.last_send_time = time.time()  # 更新最后一次发送的时间
+            print(f"{command}: {self.retry_reasons[outcome]}，重发")
         
         return received_data
+
+    def _command(self, command):
+        """发送设置类指令，收到 ACK 为成功，NAK 或没有应答为失败"""
+        reply = acknowledgement(self.send_instruction(command), command[0])
+        if reply == ACK:
+            return {"code": 0, "msg": "Success"}
+        if reply == NAK:
+            return {"code": -1, "msg": "Device returned NAK"}
+        return {"code": -1, "msg": "No acknowledgement from device"}
     
     def set_voltage(self, voltage, memoryObj="workspace"):
-        memoryObjCode = ""
-        if (memoryObj == "workspace"):
-            memoryObjCode = "A"
-        elif (memoryObj == "memory1"):
-            memoryObjCode = "E"
-        elif (memoryObj == "memory2"):
-            memoryObjCode = "J"
-        elif (memoryObj == "memory3"):
-            memoryObjCode = "N"
-        else:
+        memoryObjCode = VOLTAGE_CODES.get(memoryObj)
+        if memoryObjCode is None:
             return {"code": -1, "msg": "Invalid memory object"}
         
-        self.send_instruction(f"AV{memoryObjCode}{voltage:.3f}")
-        return {"code": 0, "msg": "Success"}
+        return self._command(f"AV{memoryObjCode}{voltage:.3f}")
     def set_current(self, current, is_uaAccuracy = False, memoryObj="workspace"):
-        memoryObjCode = ""
         if (is_uaAccuracy == False):
-            if (memoryObj == "workspace"):
-                memoryObjCode = "A"
-            elif (memoryObj == "memory1"):
-                memoryObjCode = "E"
-            elif (memoryObj == "memory2"):
-                memoryObjCode = "J"
-            elif (memoryObj == "memory3"):
-                memoryObjCode = "N"
-            else:
-                return {"code": -1, "msg": "Invalid memory object"}
+            memoryObjCode = CURRENT_CODES.get(memoryObj)
         else:
             # 检查一下输入电流是否小于等于1A
             if (current > 1):
                 return {"code": -1, "msg": "In uaAccuracy, The current value should be less than or equal to 1A"}
-            
-            if (memoryObj == "workspace"):
-                memoryObjCode = "B"
-            elif (memoryObj == "memory1"):
-                memoryObjCode = "F"
-            elif (memoryObj == "memory2"):
-                memoryObjCode = "K"
-            elif (memoryObj == "memory3"):
-                memoryObjCode = "P"
-            else:
-                return {"code": -1, "msg": "Invalid memory object"}
+            memoryObjCode = CURRENT_UA_CODES.get(memoryObj)
+        if memoryObjCode is None:
+            return {"code": -1, "msg": "Invalid memory object"}
         
-        self.send_instruction(f"AA{memoryObjCode}{current:.3f}")
-        return {"code": 0, "msg": "Success"}
+        return self._command(f"AA{memoryObjCode}{current:.3f}")
 
     #写一个函数用于选择输出，之行为PR0/PR1/PR2/PR3 分别为：工作区、记忆1、记忆2、记忆3，传入参数memoryObj
     def select_output(self, memoryObj):
-        if (memoryObj == "workspace"):
-            self.send_instruction("APR0")
-        elif (memoryObj == "memory1"):
-            self.send_instruction("APR1")
-        elif (memoryObj == "memory2"):
-            self.send_instruction("APR2")
-        elif (memoryObj == "memory3"):
-            self.send_instruction("APR3")
-        else:
+        if memoryObj not in PRESET_CODES:
             return {"code": -1, "msg": "Invalid memory object"}
-        return {"code": 0, "msg": "Success"}
+        return self._command("APR" + PRESET_CODES[memoryObj])
     
     def control_output(self, enable):
         """控制电源输出，enable为True时开启输出，False时关闭"""
-        self.send_instruction("ASW1" if enable else "ASW0")
-        return {"code": 0, "msg": "Success"}
+        return self._command("ASW1" if enable else "ASW0")
     
     def unlock_panel(self):
         self.send_instruction("ALC1")
@@ -161,6 +165,16 @@ class DeviceController:
     def set_ua_accuracy(self, enable):
         self.send_instruction("ARA1" if enable else "ARA0")
     
+    # 获取系统状态，指令ST2，响应数据为：@MS2,2字符设备地址，OVP/电压电流显示，输出是否开启，输出保护是否开启，トラッキング，记忆预设选择，微安精度是否选择
+    def getSystemStatus(self):
+        received_data = self.send_instruction("AST2", need_response=True)
+        if received_data:
+            try:
+                status = parse_system_status(received_data)
+            except ProtocolError as e:
+                return {"code": -1, "msg": str(e)}
+            return {"code": 0, "msg": "Success", "data": status.to_dict()}
+
     def getOutputStatus(self):
         # 执行指令ST0，返回：
         # 回显数据 (ASCII): .AST0.1B.A.@MS0,01,1200,0200,2150,0000.5D
@@ -168,75 +182,45 @@ class DeviceController:
         # MS0, 2字符地址，4字符电压（换算到实际的电压需要先/100,然后用第二位小数四舍五入得到第三位小数），4字符电流（换算到实际的电流需要先/100,然后用第二位小数四舍五入得到第三位小鼠）
         received_data = self.send_instruction("AST4", need_response=True)
         if received_data:
-            # 找到实际数据的起始位置
-            start_index = received_data.find(b'MS4')
-            if start_index == -1:
-                return {"code": -1, "msg": "未找到有效数据起始位置"}
-            
-            # 解析返回的数据
-            raw_result = scanf("MS4,%d,%f,%f,%f,%d", received_data[start_index:].decode())
-            voltage = raw_result[1]
-            current = raw_result[2]
-            OVP = raw_result[3]
-            is_CC = raw_result[4]
-            # 调试打印
-            print(f"电压: {voltage} V")
-            print(f"电流: {current} A")
-            print(f"OVP: {OVP} V")
-            print(f"CC状态: {is_CC}")
-            return {"code": 0, "msg": "Success", "voltage": voltage, "current": current, "OVP": OVP, "is_CC": is_CC}
+            try:
+                status = parse_output_status(received_data)
+            except ProtocolError as e:
+                return {"code": -1, "msg": str(e)}
+            if self.echo:
+                # 调试打印
+                print(f"电压: {status.voltage} V")
+                print(f"电流: {status.current} A")
+                print(f"OVP: {status.ovp} V")
+                print(f"CC状态: {status.is_cc}")
+            self.energy.add(status.voltage, status.current, status.is_cc)
+            return {"code": 0, "msg": "Success", "voltage": status.voltage, "current": status.current, "OVP": status.ovp, "is_CC": status.is_cc}
         
     def getMemoryPreset(self):
         received_data = self.send_instruction("AST5", need_response=True)
         if received_data:
-            # 找到实际数据的起始位置
-            start_index = received_data.find(b'MS5')
-            # 有没有类似C语言的scanf函数，可以直接从字符串中提取数字？
-            # @MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
-            # @MS5,设备地址,工作区电压，工作区电流1ma档，工作区电流0.1ma档，记忆1电压，记忆1电流1ma档，记忆1电流0.1ma档，记忆2电压，记忆2电流1ma档，记忆2电流0.1ma档，记忆3电压，记忆3电流1ma档，记忆3电流0.1ma档
-            if start_index == -1:
-                return {"code": -1, "msg": "未找到有效数据起始位置"}
-            # 删除末尾的0x03
-            received_data = received_data[:-1]
-            raw_result = scanf("MS5,%d,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f", received_data[start_index:].decode())
-            print(raw_result)
-            #需要输出一个树形结构，首先一开始有4个节点分别是工作区、记忆1、记忆2、记忆3，每个节点下面有3个子节点分别是电压、电流1ma档、电流0.1ma档
-            reselt = {
-                "workspace": {
-                    "voltage": raw_result[1],
-                    "current": raw_result[2],
-                    "current_ua": raw_result[3]
-                },
-                "memory1": {
-                    "voltage": raw_result[4],
-                    "current": raw_result[5],
-                    "current_ua": raw_result[6]
-                },
-                "memory2": {
-                    "voltage": raw_result[7],
-                    "current": raw_result[8],
-                    "current_ua": raw_result[9]
-                },
-                "memory3": {
-                    "voltage": raw_result[10],
-                    "current": raw_result[11],
-                    "current_ua": raw_result[12]
-                }
-            }
-            print(reselt)
+            try:
+                preset = parse_memory_preset(received_data)
+            except ProtocolError as e:
+                return {"code": -1, "msg": str(e)}
+            #输出一个树形结构，4个节点分别是工作区、记忆1、记忆2、记忆3，每个节点下面有3个子节点分别是电压、电流1ma档、电流0.1ma档
+            reselt = preset.to_dict()
+            if self.echo:
+                print(reselt)
             return {"code": 0, "msg": "Success", "data": reselt}
             
     def close(self):
+        self.stop_capture()
         self.ser.close()
 
-def breathing_light(controller, duration, min_voltage, max_voltage, cycle_time):#@MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
-    start_time = time.time()
+def breathing_light(controller, duration, min_voltage, max_voltage, cycle_time, rate=5):#@MS5,01,1.234,2.333,0.0000,3.300,0.500,0.5000,5.000,0.150,0.1500,12.000,2.000,0.3152.13
+    """
+    电压在 min_voltage 和 max_voltage 之间按 sin² 变化，rate 为每秒的采样点数
+    默认的自适应指令间隔下每条 VA 指令只占几十毫秒，5 点/秒不会丢点；pacing="fixed"（500ms）时超过 2 点/秒会丢弃采样点
+    """
     controller.set_current(0.05)
-    while time.time() - start_time < duration:
-        elapsed = time.time() - start_time
-        t = (elapsed % cycle_time) / cycle_time  # Normalize to [0, 1]
-        voltage = min_voltage + (max_voltage - min_voltage) * (math.sin(math.pi * t) ** 2)
-        controller.set_voltage(voltage)
+    waveform = Waveform.sine(min_voltage, max_voltage, cycle_time, duration, rate)
+    report = play(waveform, controller.set_voltage)
+    print_report(report)
     
     # Safety shutdown after the demo
     controller.control_output(False)
@@ -270,7 +254,7 @@ if __name__ == "__main__":
     controller.set_current(1, is_uaAccuracy=True, memoryObj="memory3")
     time.sleep(1)
     #获取预设值
-    controller.getMemoryPreset()
+    print(controller.getMemoryPreset())
     
     #演示打开输出保护，切换到记忆1，打开输出，3秒后关闭输出
     controller.toggle_protection(True)
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TEXIO_PAR_Simulator import PARSimulator  # noqa: E402
+
+
+@pytest.fixture
+def simulator(request):
+    """启动一个软件模拟器，测试结束后停止；参数通过 @pytest.mark.simulator(...) 传给 PARSimulator"""
+    if not hasattr(os, "openpty"):
+        pytest.skip("模拟器需要伪终端（pty）")
+    marker = request.node.get_closest_marker("simulator")
+    sim = PARSimulator(**(marker.kwargs if marker else {})).start()
+    yield sim
+    sim.stop()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "simulator(**kwargs): PARSimulator 的参数")
@@ -0,0 +1,139 @@
+"""
+用软件模拟器测试 Web API 服务器控制器里容易悄悄退化的收发路径：
+重发、设定值合并、幂等写入、安全指令优先和取消后的应答排空
+"""
+import asyncio
+import time
+
+import pytest
+
+import TEXIO_PAR_WebAPI_Server as srv
+
+
+def run(simulator, test, **options):
+    """在新的事件循环里创建连接模拟器的控制器，执行 test(controller)，结束后关闭串口"""
+    async def main():
+        controller = srv.DeviceController(port=simulator.port, **options)
+        try:
+            return await test(controller)
+        finally:
+            controller.close()
+    return asyncio.run(main())
+
+
+@pytest.mark.simulator(noise=0.2, seed=1)
+def test_corrupted_replies_are_retried(simulator):
+    async def test(controller):
+        return [await controller.getOutputStatus() for _ in range(20)]
+
+    results = run(simulator, test, retries=3)
+    assert simulator.corrupted_count > 0
+    assert all(result["code"] == 0 for result in results)
+
+
+@pytest.mark.simulator(min_gap=0.15)
+def test_nak_is_retried(simulator):
+    async def test(controller):
+        return [await controller.set_voltage(1 + i * 0.1) for i in range(5)]
+
+    results = run(simulator, test, retries=3)
+    assert simulator.nak_count > 0
+    assert all(result["code"] == 0 for result in results)
+    assert simulator.unit.voltage["workspace"] == 1.4
+
+
+@pytest.mark.simulator(units={"B": "02"})
+def test_wrong_address_is_not_retried(simulator):
+    async def test(controller):
+        start = time.monotonic()
+        return await controller.getOutputStatus(), time.monotonic() - start
+
+    result, elapsed = run(simulator, test, unit="B", address="05", retries=2)
+    assert result == {"code": -1, "msg": "设备地址不匹配"}
+    assert simulator.unit.command_count == 1
+    assert elapsed < 1.0
+
+
+@pytest.mark.simulator()
+def test_coalescing_sends_only_the_latest_setpoint(simulator):
+    async def test(controller):
+        # 持有设备锁期间到来的设定值都在排队，只有最后一个会被发送
+        async with controller.lock:
+            tasks = [asyncio.ensure_future(controller.set_voltage(voltage)) for voltage in (1.0, 2.0, 3.0)]
+            await asyncio.sleep(0.05)
+            count = simulator.unit.command_count
+        return await asyncio.gather(*tasks), simulator.unit.command_count - count
+
+    results, sent = run(simulator, test, coalesce=True)
+    assert [result["code"] for result in results] == [1, 1, 0]
+    assert results[1]["data"]["replaced_by"] == "VA3.000"
+    assert sent == 1
+    assert simulator.unit.voltage["workspace"] == 3.0
+
+
+@pytest.mark.simulator()
+def test_idempotent_writes_skip_unchanged_values(simulator):
+    async def test(controller):
+        first = await controller.set_voltage(2.0)
+        count = simulator.unit.command_count
+        second = await controller.set_voltage(2.0)
+        return first, second, simulator.unit.command_count - count, controller.skipped_writes
+
+    first, second, sent, skipped = run(simulator, test, idempotent=True)
+    assert first == {"code": 0, "msg": "Success"}
+    assert second == {"code": 0, "msg": "Unchanged"}
+    assert sent == 0
+    assert skipped == 1
+
+
+@pytest.mark.simulator()
+def test_idempotent_mode_always_sends_output_on(simulator):
+    async def test(controller):
+        await controller.control_output(True)
+        # 过流保护等原因让设备自己关闭了输出，影子状态还认为输出开着
+        simulator.unit.output_on = False
+        return await controller.control_output(True)
+
+    result = run(simulator, test, idempotent=True)
+    assert result == {"code": 0, "msg": "Success"}
+    assert simulator.unit.output_on
+
+
+@pytest.mark.simulator()
+def test_safety_command_preempts_queued_commands(simulator):
+    async def test(controller):
+        await controller.control_output(True)
+        load = [asyncio.ensure_future(controller.getMemoryPreset()) for _ in range(20)]
+        await asyncio.sleep(0.2)
+        start = time.monotonic()
+        result = await controller.control_output(False)
+        elapsed = time.monotonic() - start
+        output_on = simulator.unit.output_on
+        pending = sum(not task.done() for task in load)
+        await asyncio.gather(*load)
+        return result, elapsed, output_on, pending
+
+    result, elapsed, output_on, pending = run(simulator, test)
+    assert result["code"] == 0
+    assert not output_on
+    # 排在前面的查询还没有执行完，关闭输出最多等正在进行的一次收发
+    assert pending > 10
+    assert elapsed < 0.5
+
+
+@pytest.mark.simulator(processing_delay=0.2)
+def test_reply_of_cancelled_exchange_is_drained(simulator):
+    async def test(controller):
+        await controller.control_output(True)
+        query = asyncio.ensure_future(controller.getOutputStatus())
+        await asyncio.sleep(0.05)
+        query.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await query
+        # 被取消的查询的 ACK 还在路上，不能把它当成关闭输出的应答
+        result = await controller.control_output(False)
+        return result, simulator.unit.output_on
+
+    result, output_on = run(simulator, test)
+    assert result == {"code": 0, "msg": "Success"}
+    assert not output_on